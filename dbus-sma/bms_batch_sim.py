@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bms_batch_sim.py: The bms_test.py charge cycle simulation for many
+                controller and battery parameter sets at once, on numpy
+                arrays. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import argparse
+import itertools
+import os
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+import yaml
+
+from bms_state_machine import SimulatedClock
+from bms_test import SimulatedBattery, create_controller, simulate
+
+# python bms_batch_sim.py -p charge_absorb_voltage=55.8:56.6:0.1 -p current_p_gain=25,50,100,200 \
+#   -p current_d_gain=0,10,20,40 -p time_min_absorb=30,60,120 -o sweep.csv
+# python bms_batch_sim.py ... --verify 20   (also runs 20 of the sets through the real controller)
+#
+# Every parameter set is one BMSChargeController and SimulatedBattery from
+# bms_test.py, built from the config with the set's values replaced. The
+# engine takes their parameters into arrays and runs BMSChargeModel's
+# check_*_state, do_current_logic and the battery model for all of them in
+# one numpy step, the same scenario as bms_test.simulate(). Every float
+# operation is done in the same order as in the scalar code and round() is
+# reproduced exactly (see py_round), so each set's trajectory is the one the
+# scalar controller gives, bit for bit. --verify checks that.
+#
+# Metrics per parameter set (-o writes them with the parameters):
+#   complete:        rebulked from float --cycles times
+#   time_to_absorb_h: first absorb
+#   absorb_min, float_min: time spent in the state
+#   overshoot_v:     highest battery voltage above charge_absorb_voltage in absorb
+#   ripple_a:        largest charge current step while regulating (absorb/float)
+#   rebulks:         back to bulk from absorb or float
+
+# sweepable parameters: config section of the controller ones, None for the battery
+PARAMS = {
+  "charge_bulk_amps": "BMSData",
+  "charge_absorb_voltage": "BMSData",
+  "charge_float_voltage": "BMSData",
+  "time_min_absorb": "BMSData",
+  "rebulk_voltage": "BMSData",
+  "current_p_gain": "BmsControl",
+  "current_d_gain": "BmsControl",
+  "capacity": None,
+  "soc": None,
+  "resistance": None,
+}
+
+METRICS = ("complete", "time_to_absorb_h", "absorb_min", "float_min", "overshoot_v", "ripple_a", "rebulks")
+
+IDLE, BULK, ABSORB, FLOAT = 0, 1, 2, 3
+STATE_NAMES = ("idle", "bulk_chg", "absorb_chg", "float_chg")
+
+OCV_SOC = np.array([soc for soc, volt in SimulatedBattery.OCV_CURVE])
+OCV_VOLT = np.array([volt for soc, volt in SimulatedBattery.OCV_CURVE])
+
+def py_round(values, digits):
+  """round(value, digits) of every element, the same floats as Python's
+     round(). Both give the float nearest to k / 10**digits, but Python
+     picks k from the exact binary value and np.round from the scaled one,
+     which can land on the other side of a tie. Elements close to a tie are
+     done with round()."""
+  scale = 10.0 ** digits
+  scaled = values * scale
+  rounded = np.rint(scaled)
+  result = rounded / scale
+  # distance to the nearest integer, in place: this runs 3 times per step
+  np.subtract(scaled, rounded, out=scaled)
+  np.absolute(scaled, out=scaled)
+  if (scaled.size and np.maximum.reduce(scaled) > 0.5 - 1e-6):
+    for i in np.flatnonzero(scaled > 0.5 - 1e-6):
+      result[i] = round(float(values[i]), digits)
+  return result
+
+# the segments of SimulatedBattery.OCV_CURVE, differences taken as ocv() does
+OCV_SOC_LO, OCV_SOC_HI = OCV_SOC[:-1], OCV_SOC[1:]
+OCV_VOLT_LO = OCV_VOLT[:-1]
+OCV_VOLT_SPAN = OCV_VOLT[1:] - OCV_VOLT[:-1]
+OCV_SOC_SPAN = OCV_SOC[1:] - OCV_SOC[:-1]
+
+def ocv(soc):
+  """SimulatedBattery.ocv() of every element, soc in 0-1"""
+  segment = np.minimum(OCV_SOC_HI.searchsorted(soc, side='left'), len(OCV_SOC_HI) - 1) # first soc_hi >= soc
+  return OCV_VOLT_LO[segment] + OCV_VOLT_SPAN[segment] * (soc - OCV_SOC_LO[segment]) / OCV_SOC_SPAN[segment]
+
+# bms_test.simulate() for a list of controllers and their batteries. The
+# controllers are only read, they need to be idle. record: keep every step
+# for trajectory()
+#
+# One element per controller in every array, a controller that is done is
+# dropped from them at the end of its last step.
+#
+# The cost is the python loop, not the arithmetic (profiled): a step is about
+# 80 numpy calls, each close to a microsecond of call overhead on arrays this
+# small, ~60us per step for 100 controllers. The scalar simulate() takes
+# ~12us per step and controller, so the batch is ahead by about (controllers
+# still running) / 5: ~10x for a few hundred sets, ~100x for tens of
+# thousands. Sets that never complete run to max_hours and set the length of
+# the whole run. What only changes with the state (time to absorb, float
+# start, rebulks, done) is done in _transitions(), on the few steps that have
+# a state change.
+class BatchSimulation(object):
+  # per controller arrays, in the order they are dropped
+  ARRAYS = ("bulk_current", "absorb_voltage", "float_voltage", "absorb_time", "rebulk_voltage", "p_gain", "d_gain", \
+    "scale", "capacity", "resistance", "state", "set_current", "last_error", "last_voltage", "absorb_start", "soc", \
+    "voltage", "current", "float_start", "float_rebulks", "prev_regulating", "prev_set", "absorb_steps", "float_steps", \
+    "rebulks", "time_to_absorb", "overshoot", "ripple", "index")
+  # kept for run()'s result
+  TOTALS = ("float_rebulks", "time_to_absorb", "absorb_steps", "float_steps", "overshoot", "ripple", "rebulks")
+
+  def __init__(self, controllers, batteries, step_s=2.0, load_a=60.0, load_after_float_min=30.0, \
+    max_hours=24.0, cycles=1, record=False):
+    models = [controller.model for controller in controllers]
+    if (any(controller.get_state() != "idle" for controller in controllers)):
+      raise ValueError("controllers must be idle")
+    self.size = len(models)
+    self.step_s = step_s
+    self.load_a = load_a
+    self.load_after_float_min = load_after_float_min
+    self.max_hours = max_hours
+    self.cycles = cycles
+    self.record = record
+    self.steps = []
+
+    field = lambda objects, name: np.array([getattr(obj, name) for obj in objects], dtype=float)
+    self.bulk_current = field(models, "charge_bulk_current")
+    self.absorb_voltage = field(models, "charge_absorb_voltage")
+    self.float_voltage = field(models, "charge_float_voltage")
+    self.absorb_time = field(models, "time_min_absorb") * 60
+    self.rebulk_voltage = field(models, "rebulk_voltage")
+    self.p_gain = field(models, "current_p_gain")
+    self.d_gain = field(models, "current_d_gain")
+    control_period = field(models, "control_period")
+    self.scale = np.minimum(max(step_s, 0.0), control_period) / control_period
+    self.capacity = field(batteries, "capacity_ah")
+    self.resistance = field(batteries, "resistance")
+
+    size = self.size
+    self.state = np.full(size, BULK) # start_charging()
+    self.set_current = field(models, "set_current")
+    self.last_error = field(models, "last_error")
+    self.last_voltage = field(models, "last_voltage")
+    self.absorb_start = np.full(size, np.nan)
+    self.soc = field(batteries, "soc")
+    self.voltage = field(batteries, "voltage")
+    self.current = field(batteries, "current")
+    self.float_start = np.full(size, np.nan) # nan: not in float
+    self.float_rebulks = np.zeros(size, dtype=int)
+
+    self.prev_regulating = np.zeros(size, dtype=bool)
+    self.prev_set = np.full(size, np.nan)
+    self.absorb_steps = np.zeros(size, dtype=int)
+    self.float_steps = np.zeros(size, dtype=int)
+    self.rebulks = np.zeros(size, dtype=int)
+    self.time_to_absorb = np.full(size, np.nan)
+    self.overshoot = np.full(size, -np.inf)
+    self.ripple = np.zeros(size)
+
+    self.index = np.arange(size)
+    self._totals = dict((name, getattr(self, name).copy()) for name in self.TOTALS)
+
+  def run(self):
+    """Returns {metric: array}, one element per controller"""
+    now = 0.0
+    while (now < self.max_hours * 3600 and self.index.size):
+      self._step(now)
+      now += self.step_s
+    self._keep_totals(np.ones(self.index.size, dtype=bool))
+
+    totals = self._totals
+    return {
+      "complete": totals["float_rebulks"] == self.cycles,
+      "time_to_absorb_h": totals["time_to_absorb"] / 3600.0,
+      "absorb_min": totals["absorb_steps"] * self.step_s / 60.0,
+      "float_min": totals["float_steps"] * self.step_s / 60.0,
+      "overshoot_v": np.where(np.isinf(totals["overshoot"]), np.nan, totals["overshoot"]),
+      "ripple_a": totals["ripple"],
+      "rebulks": totals["rebulks"],
+    }
+
+  def _step(self, now):
+    # BMSChargeController.update_battery_data(), check_state()
+    actual_voltage = py_round(self.voltage, 2)
+    actual_current = py_round(self.current, 1)
+    state = self.state
+    bulk = state == BULK
+    absorb = state == ABSORB
+    regulating = state >= ABSORB # absorb or float
+    np.copyto(self.set_current, self.bulk_current, where=bulk)
+    to_absorb = bulk & (actual_voltage >= self.absorb_voltage)
+    np.copyto(self.last_voltage, actual_voltage, where=to_absorb)
+    rebulk = regulating & (actual_voltage < self.rebulk_voltage)
+    to_float = absorb & ~rebulk & (now - self.absorb_start > self.absorb_time)
+    regulate = regulating & ~(rebulk | to_float)
+
+    # do_current_logic()
+    error = np.where(absorb, self.absorb_voltage, self.float_voltage) - actual_voltage
+    set_current = np.minimum(self.set_current, actual_current)
+    set_current += self.p_gain * error * self.scale + self.d_gain * (error - self.last_error)
+    np.maximum(set_current, 0.6, out=set_current)
+    np.minimum(set_current, self.bulk_current, out=set_current)
+    set_current = py_round(set_current, 1)
+    np.copyto(self.set_current, set_current, where=regulate)
+    np.copyto(self.last_error, error, where=regulate)
+    np.copyto(self.last_voltage, actual_voltage, where=regulate)
+
+    # state machine
+    changed = to_absorb | to_float | rebulk
+    done = None
+    if (np.maximum.reduce(changed)):
+      np.copyto(self.absorb_start, now, where=to_absorb)
+      np.copyto(state, ABSORB, where=to_absorb)
+      np.copyto(state, FLOAT, where=to_float)
+      np.copyto(state, BULK, where=rebulk)
+      done = self._transitions(now, to_absorb, to_float, rebulk)
+
+    # metrics of this step's row
+    if (self.record):
+      self.steps.append((now, self.index, state.copy(), self.voltage, self.current, self.set_current.copy()))
+    in_absorb = state == ABSORB
+    in_float = state == FLOAT
+    self.absorb_steps += in_absorb
+    self.float_steps += in_float
+    np.copyto(self.overshoot, np.maximum(self.overshoot, self.voltage - self.absorb_voltage), where=in_absorb)
+    regulating = in_absorb | in_float
+    np.copyto(self.ripple, np.maximum(self.ripple, np.abs(self.set_current - self.prev_set)), \
+      where=regulating & self.prev_regulating)
+    self.prev_regulating = regulating
+    self.prev_set = self.set_current.copy()
+
+    # simulate(): load in float
+    load = np.where(now - self.float_start >= self.load_after_float_min * 60, self.load_a, 0.0)
+
+    # SimulatedBattery.step(), new arrays: a recorded step keeps the old ones
+    self.current = self.set_current - load
+    soc = self.soc + self.current * self.step_s / 3600.0 / self.capacity
+    self.soc = np.minimum(np.maximum(soc, 0.0, out=soc), 1.0, out=soc) # np.clip has more call overhead
+    self.voltage = ocv(self.soc) + self.current * self.resistance
+
+    if (done is not None):
+      self._keep_totals(done)
+      keep = ~done
+      for name in self.ARRAYS:
+        setattr(self, name, getattr(self, name)[keep])
+
+  def _transitions(self, now, to_absorb, to_float, rebulk):
+    """Metrics that change with the state, returns the controllers that are
+       done after this step or None"""
+    np.copyto(self.time_to_absorb, now, where=to_absorb & np.isnan(self.time_to_absorb))
+    self.rebulks += rebulk
+    np.copyto(self.float_start, now, where=to_float)
+
+    # simulate(): done after cycles rebulks from float
+    ended = rebulk & ~np.isnan(self.float_start)
+    if (not ended.any()):
+      return None
+    self.float_rebulks += ended
+    np.copyto(self.float_start, np.nan, where=ended)
+    done = ended & (self.float_rebulks == self.cycles)
+    return done if done.any() else None
+
+  def _keep_totals(self, rows):
+    for name in self.TOTALS:
+      self._totals[name][self.index[rows]] = getattr(self, name)[rows]
+
+  def trajectory(self, index):
+    """bms_test.simulate()'s trajectory of one controller, needs record"""
+    rows = []
+    for now, indexes, state, voltage, current, set_current in self.steps:
+      row = np.flatnonzero(indexes == index)
+      if (row.size):
+        row = row[0]
+        rows.append((now, STATE_NAMES[state[row]], voltage[row], current[row], set_current[row]))
+    return rows
+
+def trajectory_metrics(trajectory, absorb_voltage, step_s, cycles):
+  """The metrics of a bms_test.simulate() trajectory, as BatchSimulation.run()"""
+  metrics = {"complete": False, "time_to_absorb_h": np.nan, "absorb_min": 0.0, "float_min": 0.0, \
+    "overshoot_v": np.nan, "ripple_a": 0.0, "rebulks": 0}
+  regulating = ("absorb_chg", "float_chg")
+  float_rebulks = 0
+  absorb_steps = float_steps = 0
+  prev_state, prev_set = "idle", None
+  for seconds, state, voltage, current, charge_current in trajectory:
+    if (state == "absorb_chg"):
+      absorb_steps += 1
+      if (np.isnan(metrics["time_to_absorb_h"])):
+        metrics["time_to_absorb_h"] = seconds / 3600.0
+      if (np.isnan(metrics["overshoot_v"]) or voltage - absorb_voltage > metrics["overshoot_v"]):
+        metrics["overshoot_v"] = voltage - absorb_voltage
+    elif (state == "float_chg"):
+      float_steps += 1
+    if (state in regulating and prev_state in regulating):
+      metrics["ripple_a"] = max(metrics["ripple_a"], abs(charge_current - prev_set))
+    if (state == "bulk_chg" and prev_state in regulating):
+      metrics["rebulks"] += 1
+      if (prev_state == "float_chg"):
+        float_rebulks += 1
+    prev_state, prev_set = state, charge_current
+  metrics["complete"] = float_rebulks == cycles
+  metrics["absorb_min"] = absorb_steps * step_s / 60.0
+  metrics["float_min"] = float_steps * step_s / 60.0
+  return metrics
+
+def parse_values(spec):
+  """"a,b,c" or "start:stop:step" (stop included)"""
+  if (":" in spec):
+    start, stop, step = [float(part) for part in spec.split(":")]
+    return [round(start + i * step, 9) for i in range(int(round((stop - start) / step)) + 1)]
+  return [float(part) for part in spec.split(",")]
+
+def parameter_sets(base, sweeps):
+  """Every combination of the swept values, on top of base"""
+  names = sorted(sweeps)
+  sets = []
+  for values in itertools.product(*[sweeps[name] for name in names]):
+    params = dict(base)
+    params.update(zip(names, values))
+    sets.append(params)
+  return sets
+
+def build(cfg, params):
+  """The scalar controller, its clock and the battery of one parameter set"""
+  cfg = dict(cfg, BMSData=dict(cfg['BMSData']), BmsControl=dict(cfg.get('BmsControl') or {}))
+  for name, section in PARAMS.items():
+    if (section is not None):
+      cfg[section][name] = params[name]
+  clock = SimulatedClock()
+  return create_controller(cfg, clock), clock, SimulatedBattery(params["capacity"], params["soc"], params["resistance"])
+
+def same(a, b):
+  return a == b or (isinstance(a, float) and isinstance(b, float) and np.isnan(a) and np.isnan(b))
+
+def verify(cfg, sets, results, args):
+  """Runs sets through bms_test.simulate() with the real controller and
+     compares trajectories and metrics. Returns (mismatches, scalar seconds)"""
+  mismatches = 0
+  scalar_time = 0.0
+  built = [build(cfg, params) for params in sets]
+  batch = BatchSimulation([controller for controller, clock, battery in built], \
+    [battery for controller, clock, battery in built], args.step, args.load, args.load_after, args.max_hours, \
+    args.cycles, record=True)
+  batch.run()
+  for i, (params, result) in enumerate(zip(sets, results)):
+    controller, clock, battery = build(cfg, params)
+    start = timer()
+    trajectory = simulate(controller, battery, clock, args.step, args.load, args.load_after, args.max_hours, args.cycles)
+    scalar_time += timer() - start
+    problems = []
+    batch_trajectory = batch.trajectory(i)
+    if (batch_trajectory != trajectory):
+      step = next((n for n, (a, b) in enumerate(zip(batch_trajectory, trajectory)) if a != b), \
+        min(len(batch_trajectory), len(trajectory)))
+      problems.append("trajectory differs at step {0}: {1} / scalar {2}".format(step, \
+        batch_trajectory[step] if step < len(batch_trajectory) else "end", \
+        trajectory[step] if step < len(trajectory) else "end"))
+    expected = trajectory_metrics(trajectory, controller.model.charge_absorb_voltage, args.step, args.cycles)
+    for metric in METRICS:
+      if (not same(result[metric], expected[metric])):
+        problems.append("{0}: {1} / scalar {2}".format(metric, result[metric], expected[metric]))
+    if (problems):
+      mismatches += 1
+      print("MISMATCH {0}".format(dict((name, params[name]) for name in sorted(PARAMS))))
+      for problem in problems:
+        print("  " + problem)
+  return mismatches, scalar_time
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Charge controller parameter sweep on a simulated battery.')
+  parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "dbus-sma.yaml"), \
+    help='driver config, BMSData and BmsControl are the defaults')
+  parser.add_argument('-p', '--param', action='append', default=[], metavar='NAME=VALUES', \
+    help='sweep a parameter, a,b,c or start:stop:step. One of: ' + ", ".join(sorted(PARAMS)))
+  parser.add_argument('--capacity', type=float, default=280.0, help='battery capacity (Ah)')
+  parser.add_argument('--soc', type=float, default=0.2, help='state of charge at the start (0-1)')
+  parser.add_argument('--resistance', type=float, default=0.008, help='battery internal resistance (ohm)')
+  parser.add_argument('--step', type=float, default=2.0, help='seconds per step')
+  parser.add_argument('--load', type=float, default=60.0, help='load switched on in float (A)')
+  parser.add_argument('--load-after', type=float, default=30.0, help='minutes in float before the load starts')
+  parser.add_argument('--max-hours', type=float, default=24.0, help='simulated time limit')
+  parser.add_argument('--cycles', type=int, default=1, help='stop after this many rebulks from float')
+  parser.add_argument('-o', '--output', help='write parameters and metrics of every set to this csv')
+  parser.add_argument('--sort', default='overshoot_v', choices=METRICS, help='order of the printed sets')
+  parser.add_argument('--show', type=int, default=10, help='sets printed')
+  parser.add_argument('--verify', type=int, default=0, metavar='N', \
+    help='run N of the sets through the scalar controller too, exit 1 on any difference')
+  args = parser.parse_args()
+
+  with open(args.config, "r") as yamlfile:
+    cfg = yaml.safe_load(yamlfile)
+  control = cfg.get('BmsControl', {})
+  base = {"current_p_gain": control.get('current_p_gain', 100.0), "current_d_gain": control.get('current_d_gain', 20.0), \
+    "capacity": args.capacity, "soc": args.soc, "resistance": args.resistance}
+  for name, section in PARAMS.items():
+    if (section == "BMSData"):
+      base[name] = cfg['BMSData'][name]
+
+  sweeps = {}
+  for spec in args.param:
+    name, _, values = spec.partition("=")
+    if (name not in PARAMS):
+      parser.error("unknown parameter {0}".format(name))
+    sweeps[name] = parse_values(values)
+  sets = parameter_sets(base, sweeps)
+
+  start = timer()
+  built = [build(cfg, params) for params in sets]
+  batch = BatchSimulation([controller for controller, clock, battery in built], \
+    [battery for controller, clock, battery in built], args.step, args.load, args.load_after, args.max_hours, args.cycles)
+  metrics = batch.run()
+  elapsed = timer() - start
+  results = [dict((metric, metrics[metric][i].item()) for metric in METRICS) for i in range(len(sets))]
+  print("{0} parameter sets in {1:.2f}s".format(len(sets), elapsed))
+
+  names = sorted(sweeps) if sweeps else ["charge_absorb_voltage"]
+  order = sorted(range(len(sets)), key=lambda i: (not results[i]["complete"], \
+    np.inf if np.isnan(results[i][args.sort]) else results[i][args.sort]))
+  print(" ".join("{0:>22}".format(name) for name in names) + " " + " ".join("{0:>16}".format(m) for m in METRICS))
+  for i in order[:args.show]:
+    print(" ".join("{0:>22g}".format(sets[i][name]) for name in names) + " " + \
+      " ".join("{0:>16}".format(results[i][m] if isinstance(results[i][m], (bool, int)) else "{0:.3f}".format(results[i][m])) \
+        for m in METRICS))
+
+  if (args.output):
+    with open(args.output, "w") as csvfile:
+      csvfile.write(",".join(sorted(PARAMS) + list(METRICS)) + "\n")
+      for params, result in zip(sets, results):
+        csvfile.write(",".join(["{0!r}".format(params[name]) for name in sorted(PARAMS)] + \
+          ["{0!r}".format(result[metric]) for metric in METRICS]) + "\n")
+
+  if (args.verify):
+    picked = sorted(set(int(round(i * (len(sets) - 1) / float(max(args.verify - 1, 1)))) \
+      for i in range(min(args.verify, len(sets)))))
+    mismatches, scalar_time = verify(cfg, [sets[i] for i in picked], [results[i] for i in picked], args)
+    print("verify: {0} of {1} sets match the scalar controller, scalar {2:.0f}ms per set, the sweep would take {3:.1f}s" \
+      .format(len(picked) - mismatches, len(picked), scalar_time / len(picked) * 1000, scalar_time / len(picked) * len(sets)))
+    sys.exit(1 if mismatches else 0)
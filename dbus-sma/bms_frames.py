@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bms_frames.py: Builds the BMS frames the SMA SunnyIsland expects in
+                LiIon_Ext-BMS mode (see NOTES_sendbms_sma_can_msgs). """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import struct
+import can
+
+CAN_tx_msg = {"BatChg": 0x351, "BatSoC": 0x355, "BatVoltageCurrent" : 0x356, "AlarmWarning": 0x35a, "BMSOem": 0x35e, "BatData": 0x35f}
+
+# 0x351: charge voltage 0.1V, charge current 0.1A, discharge current 0.1A, discharge voltage 0.1V
+_BAT_CHG = struct.Struct("<HHHH")
+# 0x355: SoC 1%, SoH 1%, SoC 0.01%
+_BAT_SOC = struct.Struct("<HHH")
+
+def _u16(value):
+  return min(max(int(value), 0), 0xFFFF)
+
+# The four constant frames are built once, 0x351 and 0x355 keep their
+# can.Message and are re-packed in place only when an input changed.
+class BmsFrameBuilder(object):
+  def __init__(self):
+    self.bat_chg = can.Message(arbitration_id=CAN_tx_msg["BatChg"], data=bytearray(_BAT_CHG.size), is_extended_id=False)
+    self.bat_soc = can.Message(arbitration_id=CAN_tx_msg["BatSoC"], data=bytearray(_BAT_SOC.size), is_extended_id=False)
+
+    self.bat_voltage_current = can.Message(arbitration_id=CAN_tx_msg["BatVoltageCurrent"],
+      data=[0x00, 0x00, 0x00, 0x0, 0xf0, 0x00], is_extended_id=False)
+    self.alarm_warning = can.Message(arbitration_id=CAN_tx_msg["AlarmWarning"],
+      data=[0x00, 0x00, 0x00, 0x0, 0x00, 0x00, 0x00, 0x00], is_extended_id=False)
+    # "BATRIUM "
+    self.bms_oem = can.Message(arbitration_id=CAN_tx_msg["BMSOem"],
+      data=[0x42, 0x41, 0x54, 0x52, 0x49, 0x55, 0x4d, 0x20], is_extended_id=False)
+    self.bat_data = can.Message(arbitration_id=CAN_tx_msg["BatData"],
+      data=[0x03, 0x04, 0x0a, 0x04, 0x76, 0x02, 0x00, 0x00], is_extended_id=False)
+
+    # in the order they go on the bus
+    self.frames = (self.bat_chg, self.bat_soc, self.bat_voltage_current, \
+      self.alarm_warning, self.bms_oem, self.bat_data)
+
+    self._chg_inputs = None
+    self._soc_inputs = None
+
+  def update_charge(self, max_voltage, charge_current, discharge_current, min_voltage):
+    """Re-packs 0x351, returns True if the payload changed"""
+    inputs = (_u16(max_voltage*10), _u16(charge_current*10), _u16(discharge_current*10), _u16(min_voltage*10))
+    if (inputs == self._chg_inputs):
+      return False
+    _BAT_CHG.pack_into(self.bat_chg.data, 0, *inputs)
+    self._chg_inputs = inputs
+    return True
+
+  def update_soc(self, state_of_charge):
+    """Re-packs 0x355, returns True if the payload changed"""
+    inputs = (_u16(state_of_charge), 100, _u16(state_of_charge*100))
+    if (inputs == self._soc_inputs):
+      return False
+    _BAT_SOC.pack_into(self.bat_soc.data, 0, *inputs)
+    self._soc_inputs = inputs
+    return True
@@ -10,55 +10,115 @@ __license__     = "MIT"
 __version__     = "0.1"
 
 import logging
-from statemachine import StateMachine, State
-from datetime import datetime, timedelta
-
-# State machine class, handles state changes as uses 
-# https://github.com/rschrader/python-statemachine
-# install with pip:
-# $ pip install python-statemachine
-#
+from timeit import default_timer as timer
 
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.INFO)
 
-class BMSChargeStateMachine(StateMachine):
-  idle = State("Idle", initial=True)#, value=1)
-  bulk_chg = State("ConstCurChg")#, value=2)
-  absorb_chg = State("ConstVoltChg")#, value=3)
-  float_chg = State("FloatChg")#, value=4)
-  canceled = State("CancelChg")#, value=5)
-
-  bulk = idle.to(bulk_chg)
-  absorb = bulk_chg.to(absorb_chg)
-  floating = absorb_chg.to(float_chg)
-  rebulk = bulk_chg.from_(absorb_chg, float_chg)
-  cancel = canceled.from_(bulk_chg, absorb_chg, float_chg)
-
+# Clocks for the charge model, now() in seconds. Only differences are used
+# (time in absorb), the origin does not matter.
+class WallClock(object):
+  def now(self):
+    return timer()
+
+# Time moves only when advance() is called, a simulation can run hours of
+# absorb in as many steps as it needs.
+class SimulatedClock(object):
+  def __init__(self, start=0.0):
+    self._now = start
+
+  def now(self):
+    return self._now
+
+  def advance(self, seconds):
+    self._now += seconds
+
+# One state of the charge state machine. value is what get_state() returns
+# and what the journal saves.
+class ChargeState(object):
+  __slots__ = ("value", "name")
+
+  def __init__(self, value, name):
+    self.value = value
+    self.name = name
+
+  def __repr__(self):
+    return "ChargeState({0!r}, {1!r})".format(self.value, self.name)
+
+class TransitionNotAllowed(Exception):
+  def __init__(self, event, state):
+    self.event = event
+    self.state = state
+    super(TransitionNotAllowed, self).__init__("Can't {0} when in {1}.".format(event, state.name))
+
+# State machine class, handles state changes. Table driven, it replaces the
+# python-statemachine package this used before with the same states,
+# transitions and model callbacks: each event maps a source state to its
+# destination, on entering a state the model's on_enter_<state> is called.
+# The model's callbacks are looked up once, when the machine is created.
+class BMSChargeStateMachine(object):
+  idle = ChargeState("idle", "Idle")
+  bulk_chg = ChargeState("bulk_chg", "ConstCurChg")
+  absorb_chg = ChargeState("absorb_chg", "ConstVoltChg")
+  float_chg = ChargeState("float_chg", "FloatChg")
+  canceled = ChargeState("canceled", "CancelChg")
+
+  states = (idle, bulk_chg, absorb_chg, float_chg, canceled)
+
+  # event: {source: destination}
   # canceled is the final state and cannot be cycled back to idle
   # create a new state machine to restart the charge cycle
-  cycle = bulk | absorb | floating
-  
-  def on_enter_idle(self):
-    if (getattr(self.model, "on_enter_idle", None) != None):
-      self.model.on_enter_idle()
-
-  def on_enter_bulk_chg(self):
-    if (getattr(self.model, "on_enter_bulk_chg", None) != None):
-      self.model.on_enter_bulk_chg()
-
-  def on_enter_absorb_chg(self):
-    if (getattr(self.model, "on_enter_absorb_chg", None) != None):
-      self.model.on_enter_absorb_chg()
-      
-  def on_enter_float_chg(self):
-    if (getattr(self.model, "on_enter_float_chg", None) != None):
-      self.model.on_enter_float_chg()
+  transitions = {
+    "bulk": {idle: bulk_chg},
+    "absorb": {bulk_chg: absorb_chg},
+    "floating": {absorb_chg: float_chg},
+    "rebulk": {absorb_chg: bulk_chg, float_chg: bulk_chg},
+    "cancel": {bulk_chg: canceled, absorb_chg: canceled, float_chg: canceled},
+    "cycle": {idle: bulk_chg, bulk_chg: absorb_chg, absorb_chg: float_chg},
+  }
+
+  def __init__(self, model=None):
+    self.model = model
+    self.current_state = self.idle
+
+    # event: {source: (destination, bound on_enter callback or None)}
+    self._table = {}
+    for event, moves in self.transitions.items():
+      self._table[event] = dict((source, (destination, getattr(model, "on_enter_" + destination.value, None))) \
+        for source, destination in moves.items())
+
+  def _fire(self, event):
+    try:
+      destination, on_enter = self._table[event][self.current_state]
+    except KeyError:
+      raise TransitionNotAllowed(event, self.current_state)
+    self.current_state = destination
+    if (on_enter is not None):
+      on_enter()
+
+  def bulk(self):
+    self._fire("bulk")
+
+  def absorb(self):
+    self._fire("absorb")
+
+  def floating(self):
+    self._fire("floating")
+
+  def rebulk(self):
+    self._fire("rebulk")
+
+  def cancel(self):
+    self._fire("cancel")
+
+  def cycle(self):
+    self._fire("cycle")
 
 # Charge Model, contains the model of the bms charger
 class BMSChargeModel(object):
   def __init__(self, charge_bulk_current, charge_absorb_voltage, \
-     charge_float_voltage, time_min_absorb, rebulk_voltage):
+     charge_float_voltage, time_min_absorb, rebulk_voltage, \
+     current_p_gain=100.0, current_d_gain=20.0, control_period=2.0, clock=None):
     self.charge_absorb_voltage = charge_absorb_voltage
     self.charge_bulk_current = charge_bulk_current
     self.original_bulk_current = charge_bulk_current
@@ -66,6 +126,17 @@ class BMSChargeModel(object):
     self.time_min_absorb = time_min_absorb
     self.rebulk_voltage = rebulk_voltage
 
+    # time_min_absorb is timed on this clock
+    self.clock = clock if clock is not None else WallClock()
+    self.start_of_absorb_chg = None
+
+    # current loop gains, tuned for one update every control_period seconds
+    self.current_p_gain = current_p_gain
+    self.current_d_gain = current_d_gain
+    self.control_period = control_period
+    # seconds since the previous update, None: one control_period
+    self.dt = None
+
     self.actual_voltage = 0.0
     self.last_error = 0.0
     self.actual_current = 0.0
@@ -85,7 +156,7 @@ class BMSChargeModel(object):
 
   def on_enter_absorb_chg(self):
     self.check_state = self.check_absorb_chg_state
-    self.start_of_absorb_chg = datetime.now()
+    self.start_of_absorb_chg = self.clock.now()
         
   def on_enter_float_chg(self):
     self.check_state = self.check_float_chg_state
@@ -94,10 +165,11 @@ class BMSChargeModel(object):
   def check_idle_state(self):
     pass
 
-  def update_battery_data(self, voltage, current):
+  def update_battery_data(self, voltage, current, dt=None):
     # use rounded values in logic
     self.actual_voltage = round(voltage, 2)
     self.actual_current = round(current, 1)
+    self.dt = dt
 
   def check_bulk_chg_state(self):
     self.set_current = self.charge_bulk_current
@@ -119,11 +191,18 @@ class BMSChargeModel(object):
     #if (self.actual_voltage > set_voltage):
       # lower set current
       # Simple PD Loop
-    P = 100.0
-    D = 20.0
+    # This is the incremental form, P*Error accumulates every update, so it is
+    # scaled by the time since the last update. The D term is a difference
+    # of errors and needs no scaling. With dt None (or one control_period)
+    # this is the original fixed 2 s tick loop.
+    P = self.current_p_gain
+    D = self.current_d_gain
+    scale = 1.0
+    if (self.dt is not None):
+      scale = min(max(self.dt, 0.0), self.control_period) / self.control_period
     Error = set_voltage - self.actual_voltage
-    change = P*Error + D*(Error - self.last_error)
-    print( "Error: " + str(Error) + " Last Error: " + str(self.last_error) + " Change: " + str(change))
+    change = P*Error*scale + D*(Error - self.last_error)
+    logger.debug("Error: " + str(Error) + " Last Error: " + str(self.last_error) + " Change: " + str(change))
     self.set_current += change
     self.last_error = Error
       #self.set_current -= 0.2
@@ -153,7 +232,7 @@ class BMSChargeModel(object):
 
     self.set_current = round(self.set_current, 1)
 
-    logger.info("Actual Current: {0:.1f}A, Set Current: {1:.1f}A, Last Voltage: {2:.2f}V, Actual Voltage: {3:.2f}V"\
+    logger.debug("Actual Current: {0:.1f}A, Set Current: {1:.1f}A, Last Voltage: {2:.2f}V, Actual Voltage: {3:.2f}V"\
       .format(self.actual_current, self.set_current, self.last_voltage, self.actual_voltage))
 
     self.last_voltage = self.actual_voltage
@@ -168,7 +247,7 @@ class BMSChargeModel(object):
     if (self.actual_voltage <self.rebulk_voltage):
       return -1
 
-    if (datetime.now() - self.start_of_absorb_chg > timedelta(minutes=self.time_min_absorb)):
+    if (self.clock.now() - self.start_of_absorb_chg > self.time_min_absorb * 60):
       return 1
 
     self.do_current_logic( self.charge_absorb_voltage)
@@ -185,9 +264,11 @@ class BMSChargeModel(object):
 # Charge controller, external interface to the bms state machine charger
 class BMSChargeController(object):
   def __init__(self, charge_bulk_current, charge_absorb_voltage, \
-    charge_float_voltage, time_min_absorb, rebulk_voltage):
+    charge_float_voltage, time_min_absorb, rebulk_voltage, \
+    current_p_gain=100.0, current_d_gain=20.0, control_period=2.0, clock=None):
     self.model = BMSChargeModel(charge_bulk_current, charge_absorb_voltage, \
-      charge_float_voltage, time_min_absorb, rebulk_voltage)
+      charge_float_voltage, time_min_absorb, rebulk_voltage, \
+      current_p_gain, current_d_gain, control_period, clock)
     self.state_machine = BMSChargeStateMachine(self.model)
     
   def __str__(self):
@@ -195,8 +276,8 @@ class BMSChargeController(object):
       .format(self.model.charge_bulk_current, self.model.charge_absorb_voltage, \
         self.model.time_min_absorb, self.model.charge_float_voltage)
     
-  def update_battery_data(self, voltage, current):
-    self.model.update_battery_data(voltage, current)
+  def update_battery_data(self, voltage, current, dt=None):
+    self.model.update_battery_data(voltage, current, dt)
     return self.check_state()
 
   def update_req_bulk_current(self, current):
@@ -238,6 +319,28 @@ class BMSChargeController(object):
     
   def get_charge_current(self):
     return self.model.set_current
+
+  def get_absorb_elapsed(self):
+    # seconds spent in absorb, None when not absorbing
+    if (self.state_machine.current_state != self.state_machine.absorb_chg):
+      return None
+    return self.model.clock.now() - self.model.start_of_absorb_chg
+
+  def restore_state(self, state, absorb_elapsed=None, charge_current=None):
+    # resume a charge cycle in a saved state, e.g. after a driver restart
+    if (state not in ("bulk_chg", "absorb_chg", "float_chg")):
+      return False
+    self.start_charging()
+    if (state != "bulk_chg" and self.state_machine.current_state == self.state_machine.bulk_chg):
+      self.state_machine.cycle()
+    if (state == "float_chg" and self.state_machine.current_state == self.state_machine.absorb_chg):
+      self.state_machine.cycle()
+    if (state == "absorb_chg" and absorb_elapsed is not None):
+      self.model.start_of_absorb_chg = self.model.clock.now() - absorb_elapsed
+    # the absorb/float current loop continues from the last requested current
+    if (charge_current is not None):
+      self.model.set_current = charge_current
+    return self.get_state() == state
     
   def get_state(self):
     return self.state_machine.current_state.value
@@ -1,8 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import time
-from bms_state_machine import BMSChargeStateMachine, BMSChargeModel, BMSChargeController
+"""bms_test.py: Fast forward simulation of the BMS charge controller against
+                a simulated battery, on a simulated clock. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import argparse
+import os
+import sys
+from timeit import default_timer as timer
+
+import yaml
+
+from bms_state_machine import BMSChargeController, SimulatedClock
 
 # 48V 16S LiFePO4 Battery
 
@@ -11,56 +24,145 @@ from bms_state_machine import BMSChargeStateMachine, BMSChargeModel, BMSChargeCo
 # Restart bulk voltage: Float-0.8 (max of 54V)
 # Inverter Cut-off: 42.8V-48V (depending on size of load and voltage drop etc)
 
-bms_controller = BMSChargeController(charge_bulk_current=160, charge_absorb_voltage=58.4, \
-  charge_float_voltage=54.4, time_min_absorb=0.5, rebulk_voltage=53.6) # or 30 seconds for the simulation
-ret = bms_controller.start_charging()
-
-print ("{0}, Start Charging: {1}".format(bms_controller, ret))
-
-# simulated battery voltage
-bat_voltage = 42.8
-counter = 0
-
-while (True):
-
-  charge_current = 0.0
-  is_state_changed = bms_controller.update_battery_data(bat_voltage, charge_current)
-  state = bms_controller.get_state()
-  charge_current = bms_controller.get_charge_current()
-  
-  print ("Battery Voltage: {0}, Charge Current: {1}, Charge State: {2}, State Changed: {3}".format(bat_voltage, charge_current, state, is_state_changed))
-
-  time.sleep(1)
-  
-    
-  # update simulated values
-  if (is_state_changed):
-    if (state == "absorb_chg"):
-      bat_voltage = 58.2
-    elif (state == "float_chg"):
-      bat_voltage = 56.1
-
-  if (state == "bulk_chg"):
-    bat_voltage += 1.8
-  elif (state == "absorb_chg"):
-    if (charge_current > 0):
-      bat_voltage += charge_current * 0.1
-    elif (charge_current == 0):
-      bat_voltage -= 0.01
-    if (counter > 5):
-      counter += 1
-    if (counter > 15):
-      bat_voltage = 54
-      counter = 0
-  elif (state == "float_chg"):
-    counter += 1
-    if (counter > 5) :
-      bat_voltage = 53
-      
-    if (charge_current > 0):
-      bat_voltage += charge_current * 0.1
-    elif (charge_current == 0):
-      bat_voltage -= 0.03
-    
+# python bms_test.py                     (BMSData/BmsControl of dbus-sma.yaml)
+# python bms_test.py -o run.csv          (every step)
+# python bms_test.py --compare run.csv   (exit 1 when the trajectory changed)
+#
+# test/check_bms_trajectory.py runs --compare against the checked in reference,
+# recorded from the controller as it was on python-statemachine.
+#
+# Starts charging an empty bank and runs until the controller goes back to
+# bulk from float (--cycles times): bulk to charge_absorb_voltage,
+# time_min_absorb in absorb, float, then a load is switched on that pulls
+# the voltage below rebulk_voltage. Every step the controller gets the battery's voltage and
+# current like the 2 s tick in dbus-sma.py, the charger delivers what the
+# controller asks for. A 120 minute absorb takes a few thousand steps, well
+# under a second.
+
+# Battery: open circuit voltage from the state of charge, plus the voltage
+# over the internal resistance. Current is positive into the battery.
+class SimulatedBattery(object):
+  # (soc, open circuit voltage), linear in between
+  OCV_CURVE = ((0.0, 44.8), (0.1, 51.2), (0.3, 52.4), (0.7, 53.0), (0.9, 53.4), (0.97, 54.0), (0.99, 55.2), (1.0, 56.8))
+
+  def __init__(self, capacity_ah=280.0, soc=0.2, resistance=0.008):
+    self.capacity_ah = capacity_ah
+    self.soc = soc
+    self.resistance = resistance
+    self.current = 0.0
+    self.voltage = self.ocv()
+
+  def ocv(self):
+    for (soc_lo, volt_lo), (soc_hi, volt_hi) in zip(self.OCV_CURVE, self.OCV_CURVE[1:]):
+      if (self.soc <= soc_hi):
+        return volt_lo + (volt_hi - volt_lo) * (self.soc - soc_lo) / (soc_hi - soc_lo)
+    return self.OCV_CURVE[-1][1]
+
+  def step(self, charge_current, load_current, seconds):
+    self.current = charge_current - load_current
+    self.soc = min(max(self.soc + self.current * seconds / 3600.0 / self.capacity_ah, 0.0), 1.0)
+    self.voltage = self.ocv() + self.current * self.resistance
+
+def create_controller(cfg, clock):
+  """The controller as dbus-sma.py creates it from the config"""
+  bms = cfg['BMSData']
+  control = cfg.get('BmsControl', {})
+  return BMSChargeController(charge_bulk_current=bms['charge_bulk_amps'], \
+    charge_absorb_voltage=bms['charge_absorb_voltage'], charge_float_voltage=bms['charge_float_voltage'], \
+    time_min_absorb=bms['time_min_absorb'], rebulk_voltage=bms['rebulk_voltage'], \
+    current_p_gain=control.get('current_p_gain', 100.0), current_d_gain=control.get('current_d_gain', 20.0), \
+    clock=clock)
+
+def simulate(controller, battery, clock, step_s=2.0, load_a=60.0, load_after_float_min=30.0, max_hours=24.0, cycles=1):
+  """Runs until the controller has rebulked from float cycles times, or
+     max_hours. Returns one (seconds, state, voltage, current, charge current)
+     per step"""
+  trajectory = []
+  start = clock.now()
+  float_start = None
+  rebulks = 0
+  controller.start_charging()
+  while (clock.now() - start < max_hours * 3600):
+    controller.update_battery_data(battery.voltage, battery.current, step_s)
+    state = controller.get_state()
+    charge_current = controller.get_charge_current()
+    trajectory.append((clock.now() - start, state, battery.voltage, battery.current, charge_current))
+
+    if (state == "float_chg" and float_start is None):
+      float_start = clock.now()
+    elif (state == "bulk_chg" and float_start is not None):
+      # rebulk, the cycle is done and the load off until the next float
+      rebulks += 1
+      float_start = None
+      if (rebulks == cycles):
+        break
+
+    load = load_a if float_start is not None and clock.now() - float_start >= load_after_float_min * 60 else 0.0
+    battery.step(charge_current, load, step_s)
+    clock.advance(step_s)
+  return trajectory
+
+def transitions(trajectory):
+  """The steps where the state changed, the first one included"""
+  return [row for i, row in enumerate(trajectory) if i == 0 or row[1] != trajectory[i - 1][1]]
+
+def format_row(row):
+  return "{0:.0f},{1},{2:.3f},{3:.3f},{4:.1f}".format(*row)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Simulates a charge cycle of the BMS charge controller.')
+  parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "dbus-sma.yaml"), \
+    help='driver config, BMSData and BmsControl are used')
+  parser.add_argument('--capacity', type=float, default=280.0, help='battery capacity (Ah)')
+  parser.add_argument('--soc', type=float, default=0.2, help='state of charge at the start (0-1)')
+  parser.add_argument('--step', type=float, default=2.0, help='seconds per step')
+  parser.add_argument('--load', type=float, default=60.0, help='load switched on in float (A)')
+  parser.add_argument('--load-after', type=float, default=30.0, help='minutes in float before the load starts')
+  parser.add_argument('--max-hours', type=float, default=24.0, help='simulated time limit')
+  parser.add_argument('--cycles', type=int, default=1, help='stop after this many rebulks from float')
+  parser.add_argument('-o', '--output', help='write every step to this csv')
+  parser.add_argument('--compare', help='csv of an earlier run, exit 1 when this run differs')
+  args = parser.parse_args()
+
+  with open(args.config, "r") as yamlfile:
+    cfg = yaml.safe_load(yamlfile)
+
+  clock = SimulatedClock()
+  controller = create_controller(cfg, clock)
+  battery = SimulatedBattery(args.capacity, args.soc)
+  print(controller)
+
+  start = timer()
+  trajectory = simulate(controller, battery, clock, args.step, args.load, args.load_after, args.max_hours, args.cycles)
+  elapsed = timer() - start
+
+  for seconds, state, voltage, current, charge_current in transitions(trajectory):
+    print("{0:>3.0f}:{1:02.0f}:{2:02.0f} {3:<11} Battery Voltage: {4:.2f}V, Current: {5:.1f}A, Charge Current: {6:.1f}A" \
+      .format(seconds // 3600, seconds % 3600 // 60, seconds % 60, state, voltage, current, charge_current))
+  states = [row[1] for row in transitions(trajectory)]
+  complete = states[-4:] == ["bulk_chg", "absorb_chg", "float_chg", "bulk_chg"]
+  print("{0} steps, {1:.1f}h simulated in {2:.0f}ms, cycle {3}".format(len(trajectory), trajectory[-1][0] / 3600.0, \
+    elapsed * 1000, "complete" if complete else "NOT complete: " + " -> ".join(states)))
+
+  rows = [format_row(row) for row in trajectory]
+  if (args.output):
+    with open(args.output, "w") as csvfile:
+      csvfile.write("seconds,state,voltage,current,charge_current\n")
+      csvfile.write("\n".join(rows) + "\n")
 
+  changed = False
+  if (args.compare):
+    with open(args.compare, "r") as csvfile:
+      expected = csvfile.read().splitlines()[1:]
+    for i, (row, old) in enumerate(zip(rows, expected)):
+      if (row != old):
+        print("step {0} differs: {1} (was {2})".format(i, row, old))
+        changed = True
+        break
+    if (not changed and len(rows) != len(expected)):
+      print("{0} steps (was {1})".format(len(rows), len(expected)))
+      changed = True
+    if (not changed):
+      print("trajectory unchanged")
 
+  sys.exit(0 if complete and not changed else 1)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bus_stats.py: Per arbitration id CAN statistics and missing frame detection. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# bits on the wire for a standard frame without stuffing: SOF, id, RTR, IDE,
+# r0, DLC, CRC, delimiters, ACK, EOF and intermission
+FRAME_OVERHEAD_BITS = 47
+
+# Count, changes and last_seen are kept for the driver's lifetime. Rate and
+# gaps are taken over a window that roll() closes (every check), so they show
+# how the bus is doing now rather than on average since the start.
+class FrameStats(object):
+  __slots__ = ("count", "last_seen", "changes", "_last_data", "stale", \
+    "_gaps", "_gap_min", "_gap_max", "_gap_total", "window")
+
+  def __init__(self):
+    self.count = 0
+    self.last_seen = None
+    self.changes = 0
+    self._last_data = None
+    self.stale = False
+    self._gaps = 0
+    self._gap_min = None
+    self._gap_max = 0.0
+    self._gap_total = 0.0
+    # (gaps, gap_min, gap_max, gap_total) of the last closed window
+    self.window = (0, None, 0.0, 0.0)
+
+  def update(self, data, timestamp):
+    if (self.last_seen is not None):
+      gap = timestamp - self.last_seen
+      self._gaps += 1
+      self._gap_total += gap
+      if (self._gap_min is None or gap < self._gap_min):
+        self._gap_min = gap
+      if (gap > self._gap_max):
+        self._gap_max = gap
+    self.last_seen = timestamp
+    self.count += 1
+    if (data != self._last_data):
+      self.changes += 1
+      self._last_data = bytes(data)
+
+  def roll(self):
+    """Closes the window, the published rate and gaps are of the frames since
+       the previous roll"""
+    self.window = (self._gaps, self._gap_min, self._gap_max, self._gap_total)
+    self._gaps = 0
+    self._gap_min = None
+    self._gap_max = 0.0
+    self._gap_total = 0.0
+
+  def rate(self):
+    """frames per second in the last window, 0 without a time span (frames
+       with the same timestamp, e.g. a replayed log or a coarse clock)"""
+    gaps, gap_min, gap_max, gap_total = self.window
+    if (gaps == 0 or gap_total <= 0):
+      return 0.0
+    return gaps / gap_total
+
+  def gap_min(self):
+    return self.window[1] or 0.0
+
+  def gap_max(self):
+    return self.window[2]
+
+  def gap_mean(self):
+    gaps, gap_min, gap_max, gap_total = self.window
+    return gap_total / gaps if gaps else 0.0
+
+# Counters are updated in O(1) per frame, rates and staleness are worked out
+# when the stats are published. Only frames that pass the acceptance filter
+# are seen, so bus load is the load of the decoded frames unless raw capture
+# is on. Error frames are counted if the interface delivers them. With raw
+# capture any id can show up, at most max_ids get their own stats (the
+# watched ones always do), frames of the others are only counted.
+class BusStats(object):
+  def __init__(self, bitrate=500000, watch_timeouts=None, max_ids=64):
+    """watch_timeouts: {arbitration id: seconds}, ids expected to keep arriving"""
+    self.bitrate = bitrate
+    self.watch_timeouts = dict(watch_timeouts or {})
+    self.max_ids = max_ids
+    self.frames = {}
+    self.error_frames = 0
+    self.untracked_frames = 0
+    self._bits = 0
+    self._window_bits = 0
+    self._window_start = None
+    self.bus_load = 0.0
+
+  def update(self, msg, timestamp):
+    if (msg.is_error_frame):
+      self.error_frames += 1
+      return
+    self._bits += FRAME_OVERHEAD_BITS + 8 * msg.dlc
+    stats = self.frames.get(msg.arbitration_id)
+    if (stats is None):
+      if (len(self.frames) >= self.max_ids and msg.arbitration_id not in self.watch_timeouts):
+        self.untracked_frames += 1
+        return
+      stats = self.frames[msg.arbitration_id] = FrameStats()
+    stats.update(msg.data, timestamp)
+
+  def check(self, now):
+    """Updates the bus load, rates and gaps over the time since the last
+       check, returns the watched ids that went stale or recovered since the
+       last check"""
+    if (self._window_start is not None and now > self._window_start):
+      self.bus_load = (self._bits - self._window_bits) / ((now - self._window_start) * self.bitrate)
+    self._window_start = now
+    self._window_bits = self._bits
+    for stats in self.frames.values():
+      stats.roll()
+
+    changed = []
+    for can_id, timeout in self.watch_timeouts.items():
+      stats = self.frames.get(can_id)
+      stale = stats is None or stats.last_seen is None or now - stats.last_seen > timeout
+      if (stats is None):
+        stats = self.frames[can_id] = FrameStats()
+      if (stale != stats.stale):
+        stats.stale = stale
+        changed.append(can_id)
+    return changed
+
+  def any_stale(self):
+    return any(self.frames[can_id].stale for can_id in self.watch_timeouts if can_id in self.frames)
+
+  def paths(self, now):
+    """(dbus path, value) for the bus and every id seen or watched"""
+    yield "/Diagnostics/Bus/Load", round(self.bus_load * 100, 1)
+    yield "/Diagnostics/Bus/ErrorFrames", self.error_frames
+    yield "/Diagnostics/Bus/UntrackedFrames", self.untracked_frames
+    for can_id, stats in self.frames.items():
+      base = "/Diagnostics/Bus/0x{0:03X}/".format(can_id)
+      yield base + "Count", stats.count
+      yield base + "Rate", round(stats.rate(), 2)
+      yield base + "GapMinMs", round(stats.gap_min() * 1000, 1)
+      yield base + "GapMeanMs", round(stats.gap_mean() * 1000, 1)
+      yield base + "GapMaxMs", round(stats.gap_max() * 1000, 1)
+      yield base + "Age", round(now - stats.last_seen, 1) if stats.last_seen is not None else -1
+      yield base + "Changes", stats.changes
+      yield base + "Stale", int(stats.stale)
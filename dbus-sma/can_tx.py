@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""can_tx.py: Spaced CAN transmit without blocking the mainloop. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import logging
+import can
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+# The SunnyIsland wants the BMS frames spaced out (~100 msec), sleeping between
+# the sends stalls the whole mainloop, so each frame gets its own deadline.
+class TxScheduler(object):
+  def __init__(self, bus, spacing_ms, timeout_add):
+    """timeout_add: gobject.timeout_add (or compatible)"""
+    self._bus = bus
+    self._spacing_ms = spacing_ms
+    self._timeout_add = timeout_add
+    self._queue = []
+    self._timer_running = False
+
+    # kernel (BCM) cyclic tasks, keyed by arbitration id
+    self._tasks = {}
+    self._latest = {}
+    self._period = None
+    self._hold = None
+    self._refresh_time = 0.0
+    self.periodic_failed = False
+
+  def send_spaced(self, msgs):
+    """Sends the first frame now and the rest one per spacing. A batch still
+       in flight is replaced, the newer data wins."""
+    self._queue = list(msgs)
+    if (not self._timer_running):
+      if (self._send_next()):
+        self._timer_running = True
+        self._timeout_add(self._spacing_ms, self._send_timer)
+
+  def send_now(self, msg):
+    """Sends one frame right away, outside any batch"""
+    try:
+      self._bus.send(msg)
+      return True
+    except (can.CanError) as e:
+      logger.error("CAN BUS Transmit error (is controller missing?): %s" % e)
+    return False
+
+  def pending(self):
+    return len(self._queue)
+
+  def _send_next(self):
+    """Sends one queued frame, returns True if more are waiting"""
+    if (not self._queue):
+      return False
+    msg = self._queue.pop(0)
+    try:
+      self._bus.send(msg)
+    except (can.CanError) as e:
+      logger.error("CAN BUS Transmit error (is controller missing?): %s" % e)
+    return len(self._queue) > 0
+
+  def _send_timer(self):
+    if (self._send_next()):
+      return True # keep timer running
+    self._timer_running = False
+    return False
+
+  # -- kernel offload --------------------------------------------------------
+  # On socketcan, send_periodic() registers the frames with the kernel BCM,
+  # which keeps sending them on its own timer even if python stalls (gc,
+  # slow dbus call, swapping). The jobs belong to the bus socket, so they
+  # always end when the process exits and the socket is closed.
+
+  def start_periodic(self, msgs, period_s, hold_s=None):
+    """Starts one cyclic task per frame, staggered by the spacing.
+       hold_s None: the kernel repeats the last payload until stopped.
+       hold_s set: the kernel stops hold_s after the last update_periodic()."""
+    self._period = period_s
+    self._hold = hold_s
+    self._refresh_time = timer()
+    for i, msg in enumerate(msgs):
+      self._latest[msg.arbitration_id] = msg
+      if (i == 0):
+        self._start_task(msg.arbitration_id)
+      else:
+        self._timeout_add(i * self._spacing_ms, self._start_task, msg.arbitration_id)
+
+  def is_periodic(self):
+    return self._period is not None
+
+  def update_periodic(self, msgs, changed=None):
+    """Pushes new payloads to the running tasks. changed: ids whose payload
+       changed (None: all). Also refreshes the expire timer if one is set."""
+    refresh = self._hold is not None and timer() - self._refresh_time >= self._hold / 2.0
+    if (refresh):
+      self._refresh_time = timer()
+
+    for msg in msgs:
+      can_id = msg.arbitration_id
+      self._latest[can_id] = msg
+      task = self._tasks.get(can_id)
+      if (task is None):
+        continue # staggered start still pending, it picks up the latest payload
+      try:
+        if (changed is None or can_id in changed):
+          task.modify_data(msg)
+        if (refresh):
+          # a TX_SETUP for a task the kernel still has is refused (python-can
+          # 4.x: "already in progress"), delete it and set it up again. Restarts
+          # the kernel count, the next frame may slip by up to one period
+          task.stop()
+          task.start()
+      except (can.CanError) as e:
+        logger.error("CAN BCM update error 0x{0:x}: {1}".format(can_id, e))
+
+  def stop_periodic(self):
+    for task in self._tasks.values():
+      try:
+        task.stop()
+      except (can.CanError) as e:
+        logger.error("CAN BCM stop error: {0}".format(e))
+    self._tasks.clear()
+    self._period = None
+
+  def _start_task(self, can_id):
+    if (self._period is None):
+      return False # stopped before the staggered start came due
+    msg = self._latest[can_id]
+    try:
+      self._tasks[can_id] = self._bus.send_periodic(msg, self._period, duration=self._hold)
+    except (can.CanError, NotImplementedError) as e:
+      logger.error("CAN BCM setup error 0x{0:x}: {1}".format(can_id, e))
+      self.stop_periodic()
+      self.periodic_failed = True
+    return False # one shot
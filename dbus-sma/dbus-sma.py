@@ -10,32 +10,46 @@ __license__     = "MIT"
 __version__     = "1.1"
 
 import os
-import signal
 import sys
-import argparse
-import serial
-import socket
+
+# --profile-startup times the imports below, see startup_profile.py
+_import_timer = None
+if ('--profile-startup' in sys.argv):
+  from startup_profile import ImportTimer
+  _import_timer = ImportTimer()
+  _import_timer.install()
+
+import signal
 import logging
 import yaml
 
-from dbus.mainloop.glib import DBusGMainLoop
-import dbus
-import gobject
+try:
+  import gobject  # Python 2.x
+except ImportError:
+  from gi.repository import GLib as gobject  # Python 3.x
 
 import can
-from can.bus import BusState
 from timeit import default_timer as timer
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 
 # Victron packages
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'))
-from vedbus import VeDbusService
-from ve_utils import get_vrm_portal_id, exit_on_error
-from dbusmonitor import DbusMonitor
-from settingsdevice import SettingsDevice  # available in the velib_python repository
-
-from bms_state_machine import BMSChargeStateMachine, BMSChargeModel, BMSChargeController
+from ve_utils import exit_on_error
+# dbus, vedbus, dbusmonitor and settingsdevice (velib) are imported where the
+# dbus side is set up, after the first BMS frames went out (see _init_dbus)
+
+from bms_state_machine import BMSChargeController
+from sma_codec import FrameCodec
+from dbus_publisher import DbusPublisher
+from can_tx import TxScheduler
+from bms_frames import BmsFrameBuilder, CAN_tx_msg
+from sma_safety import SafetyMonitor
+from energy import EnergyCounters
+from state_journal import StateJournal
+from diagnostics import Diagnostics, PhaseTimer
+from bus_stats import BusStats
+from value_cache import ValueCache
 
 
 #from settingsdevice import SettingsDevice
@@ -43,6 +57,9 @@ from bms_state_machine import BMSChargeStateMachine, BMSChargeModel, BMSChargeCo
 #import delegates
 #from sc_utils import safeadd as _safeadd, safemax as _safemax
 
+if (_import_timer is not None):
+  _import_timer.uninstall()
+
 # ignore terminal resize signals (keeps exception from being thrown)
 signal.signal(signal.SIGWINCH, signal.SIG_IGN)
 
@@ -69,13 +86,16 @@ logger.setLevel(logging.INFO)
 # To capture CAN msgs on the bus:
 # tcpdump -w capture.pcap -i can5
 
-# TODO: change to input param
+# defaults, override in the CanBus section of dbus-sma.yaml
 #canBusChannel = "/dev/ttyACM0"
 canBusChannel = "can5"
 
 #canBusType = "slcan"
 canBusType = "socketcan"
 
+# max frames decoded per mainloop wakeup, keeps a busy bus from starving dbus
+CAN_RX_BATCH = 64
+
 # connect and register to dbus
 driver = {
 	'name'        : "SMA SunnyIsland",
@@ -87,15 +107,60 @@ driver = {
 	'connection'  : "com.victronenergy.vebus.smasunnyisland"
 }
 
-CAN_tx_msg = {"BatChg": 0x351, "BatSoC": 0x355, "BatVoltageCurrent" : 0x356, "AlarmWarning": 0x35a, "BMSOem": 0x35e, "BatData": 0x35f}
 CANFrames = {"ExtPwr": 0x300, "InvPwr": 0x301, "OutputVoltage": 0x304, "Battery": 0x305, "Relay": 0x306, "Bits": 0x307, "LoadPwr": 0x308, "ExtVoltage": 0x309}
 sma_line1 = {"OutputVoltage": 0, "ExtPwr": 0, "InvPwr": 0, "ExtVoltage": 0, "ExtFreq": 0.00, "OutputFreq": 0.00}
 sma_line2 = {"OutputVoltage": 0, "ExtPwr": 0, "InvPwr": 0, "ExtVoltage": 0}
 sma_battery = {"Voltage": 0, "Current": 0}
-sma_system = {"State": 0, "ExtRelay" : 0, "ExtOk" : 0, "Load" : 0}
+sma_system = {"State": 0, "ExtRelay" : 0, "ExtOk" : 0, "Load" : 0, "ExtFlags" : 0}
+
+# derived dbus values to recompute when a frame is decoded (see _derive_* methods)
+FRAME_DERIVES = {
+  "ExtPwr":        ("ac_in", "ac_out"),
+  "InvPwr":        ("ac_out",),
+  "LoadPwr":       ("ac_out",),
+  "OutputVoltage": ("ac_out", "state"),
+  "ExtVoltage":    ("ac_in",),
+  "Battery":       ("dc", "state"),
+  "Bits":          ("grid",),
+}
+DERIVE_ALL = ("ac_in", "ac_out", "dc", "grid", "state")
+
+# frames after which the grid loss / low SoC safety is re-evaluated
+SAFETY_FRAMES = frozenset(["Bits", "OutputVoltage", "Battery"])
 
 settings = 0
 
+# Add the AcInput1 setting if it doesn't exist so that the grid data is reported
+# to the system by dbus-systemcalc-py service
+SUPPORTED_SETTINGS = {
+  'acinput': ['/Settings/SystemSetup/AcInput1', 1, 0, 0],
+  'hub4mode': ['/Settings/CGwacs/Hub4Mode', 3, 0, 0],
+  'gridmeter': ['/Settings/CGwacs/RunWithoutGridMeter', 1, 0, 0],
+  'acsetpoint': ['/Settings/CGwacs/AcPowerSetPoint', 0, 0, 0],
+  'maxchargepwr': ['/Settings/CGwacs/MaxChargePower', 0, 0, 0],
+  'maxdischargepwr': ['/Settings/CGwacs/MaxDischargePower', 0, 0, 0],
+  'maxchargepercent': ['/Settings/CGwacs/MaxChargePercentage', 0, 0, 0],
+  'maxdischargepercent': ['/Settings/CGwacs/MaxDischargePercentage', 0, 0, 0],
+  'essMode': ['/Settings/CGwacs/BatteryLife/State', 0, 0, 0],
+}
+
+# Why this dummy? Because DbusMonitor expects these values to be there, even though we don't
+# need them. So just add some dummy data. This can go away when DbusMonitor is more generic.
+dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
+DBUS_TREE = {'com.victronenergy.system':
+  {'/Dc/Battery/Soc': dummy, '/Dc/Battery/Current': dummy, '/Dc/Battery/Voltage': dummy, \
+    '/Dc/Pv/Current': dummy, '/Ac/PvOnOutput/L1/Power': dummy, '/Ac/PvOnOutput/L2/Power': dummy, }}
+
+# Process roles (Process section of dbus-sma.yaml, or --role):
+#   both: one process does everything
+#   can:  CAN socket, decode, BMS frames and safety logic, no dbus at all
+#   dbus: the dbus service, monitor and settings, fed by the can process
+ROLES = ("both", "can", "dbus")
+
+# system values kept in the state journal, the BMS frames resume from them on a restart
+JOURNAL_SYSTEM_PATHS = {"soc": '/Dc/Battery/Soc', "voltage": '/Dc/Battery/Voltage', \
+  "current": '/Dc/Battery/Current', "pv_current": '/Dc/Pv/Current'}
+
 #command packets to turn SMAs on or off
 SMA_ON_MSG = can.Message(arbitration_id = 0x35C,    #on
       data=[0b00000001,0,0,0],
@@ -107,15 +172,9 @@ SMA_OFF_MSG = can.Message(arbitration_id = 0x35C,    #off
 
 
 
-def getSignedNumber(number, bitLength):
-    mask = (2 ** bitLength) - 1
-    if number & (1 << (bitLength - 1)):
-        return number | ~mask
-    else:
-        return number & mask
-
-def bytes(integer):
-    return divmod(integer, 0x100)
+# SocketCAN acceptance filters, one exact 11 bit match per id
+def can_filters(ids):
+  return [{"can_id": can_id, "can_mask": 0x7FF, "extended": False} for can_id in sorted(ids)]
 
 class BMSData:
   def __init__(self, max_battery_voltage, min_battery_voltage, low_battery_voltage, \
@@ -158,11 +217,15 @@ class BMSData:
 # SMA Driver Class
 class SmaDriver:
 
-  def __init__(self):
+  def __init__(self, config_file=None, role="both"):
+    self._startup = PhaseTimer()
+    self.started = False
     self.driver_start_time = datetime.now()
 
     # data from yaml config file
-    self._cfg = self.get_config_data()
+    self._cfg = self.get_config_data(config_file)
+    self._role = role
+    self._startup.mark("config")
     _cfg_bms = self._cfg['BMSData']
 
     # TODO: use venus settings to define these values
@@ -173,52 +236,150 @@ class SmaDriver:
       charge_absorb_voltage=_cfg_bms['charge_absorb_voltage'], charge_float_voltage=_cfg_bms['charge_float_voltage'], \
       time_min_absorb=_cfg_bms['time_min_absorb'], rebulk_voltage=_cfg_bms['rebulk_voltage'])
 
+    _cfg_control = self._cfg.get('BmsControl', {})
     self.bms_controller = BMSChargeController(charge_bulk_current=self._bms_data.charge_bulk_amps, \
       charge_absorb_voltage=self._bms_data.charge_absorb_voltage, charge_float_voltage=self._bms_data.charge_float_voltage, \
-        time_min_absorb=self._bms_data.time_min_absorb, rebulk_voltage=self._bms_data.rebulk_voltage)
-    ret = self.bms_controller.start_charging()
+        time_min_absorb=self._bms_data.time_min_absorb, rebulk_voltage=self._bms_data.rebulk_voltage, \
+        current_p_gain=_cfg_control.get('current_p_gain', 100.0), current_d_gain=_cfg_control.get('current_d_gain', 20.0))
+    self.bms_controller.start_charging()
 
-    # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
-    DBusGMainLoop(set_as_default=True)
+    # rate_hz > 0: the charge controller runs on 0x305 battery frames instead of the 2 s tick
+    _control_rate = float(_cfg_control.get('rate_hz', 0))
+    self._control_interval = 1.0 / _control_rate if _control_rate > 0 else None
+    self._control_time = None
 
     self._can_bus = False
 
-    self._safety_off = False   #flag to see if we every shut the inverters off due to low batt. 
+    # grid loss latch and low SoC shutdown, evaluated as frames arrive
+    _cfg_safety = self._cfg["SafetyLogic"]
+    self._safety = SafetyMonitor(min_soc_inv_off=_cfg_safety["min_soc_inv_off"], \
+      grid_loss_debounce_s=_cfg_safety.get('grid_loss_debounce_ms', 500) / 1000.0, \
+      cmd_resend_s=_cfg_safety.get('cmd_resend_s', 2.0))
+    self._last_rx_time = timer()
+
+    _cfg_can = self._cfg.get('CanBus', {})
+
+    # only the SunnyRemote frames are decoded, let the kernel drop the master/slave sync chatter
+    self._rx_ids = set(CANFrames.values()) | set(_cfg_can.get('extra_rx_ids') or [])
+    self._raw_capture = bool(_cfg_can.get('raw_capture', False))
+    # per id counters, SunnyRemote frames that stop arriving raise /Diagnostics/Bus/Stale
+    _cfg_stats = self._cfg.get('BusStats', {})
+    _stale_timeout = _cfg_stats.get('stale_timeout_s', 10)
+    self._bus_stats = BusStats(bitrate=_cfg_can.get('bitrate', 500000), \
+      watch_timeouts=dict((can_id, _stale_timeout) for can_id in _cfg_stats.get('watch_ids', [0x305, 0x307])), \
+      max_ids=_cfg_stats.get('max_ids', 64))
+    self._codec = FrameCodec({"line1": sma_line1, "line2": sma_line2, "battery": sma_battery, "system": sma_system})
+
+    # the BMS and safety logic read the monitored values from this cache, the
+    # monitor's change callback keeps it current
+    self._system = ValueCache(DBUS_TREE)
+
+    # handler timing, mainloop lag and receive to publish latency, see _diagnostics_handler
+    self._diag = Diagnostics()
+    self._rx_probe = self._diag.probe("CanRx", self._parse_can_data_handler)
+    self._derive_time = self._diag.histogram("Derive")
+
+    # dbus writes go through the publisher: only changed values, at most every publish_interval_ms.
+    # Values set before the dbus service exists are held until _init_dbus attaches it.
+    _cfg_dbus = self._cfg.get('Dbus', {})
+    self._publisher = DbusPublisher(None, _cfg_dbus.get('publish_interval_ms', 250), \
+      gobject.timeout_add, flush_time=self._diag.histogram("DbusFlush"), latency=self._diag.histogram("RxToPublish"))
+    self._derivers = {"ac_in": self._derive_ac_in, "ac_out": self._derive_ac_out, "dc": self._derive_dc, \
+      "grid": self._derive_grid, "state": self._derive_state}
+    self._frame_derives = dict((frame, tuple(self._derivers[group] for group in groups)) \
+      for frame, groups in FRAME_DERIVES.items())
+
+    # energy is integrated per power frame, the counters are only published every publish_interval_s
+    _cfg_energy = self._cfg.get('Energy', {})
+    self._energy = EnergyCounters(max_gap_s=_cfg_energy.get('max_gap_s', 30.0))
+    self._startup.mark("bms")
 
     logger.debug("Can bus init")
     try :
-      self._can_bus = can.interface.Bus(bustype=canBusType, channel=canBusChannel, bitrate=500000)
+      self._can_bus = self._create_can_bus(_cfg_can, None if self._raw_capture else can_filters(self._rx_ids))
     except can.CanError as e:
      logger.error(e)
 
     logger.debug("Can bus init done")
 
-    # Add the AcInput1 setting if it doesn't exist so that the grid data is reported
-    # to the system by dbus-systemcalc-py service
-    settings = SettingsDevice(
-       bus=dbus.SystemBus(),# if (platform.machine() == 'armv7l') else dbus.SessionBus(),
-       supportedSettings={
-           'acinput': ['/Settings/SystemSetup/AcInput1', 1, 0, 0],
-           'hub4mode': ['/Settings/CGwacs/Hub4Mode', 3, 0, 0], 
-           'gridmeter': ['/Settings/CGwacs/RunWithoutGridMeter', 1, 0, 0], 
-           'acsetpoint': ['/Settings/CGwacs/AcPowerSetPoint', 0, 0, 0],
-           'maxchargepwr': ['/Settings/CGwacs/MaxChargePower', 0, 0, 0],
-           'maxdischargepwr': ['/Settings/CGwacs/MaxDischargePower', 0, 0, 0],
-           'maxchargepercent': ['/Settings/CGwacs/MaxChargePercentage', 0, 0, 0],
-           'maxdischargepercent': ['/Settings/CGwacs/MaxDischargePercentage', 0, 0, 0],
-           'essMode': ['/Settings/CGwacs/BatteryLife/State', 0, 0, 0],
-           },
-       eventCallback=None)
-
-
-		# Why this dummy? Because DbusMonitor expects these values to be there, even though we don't
-		# need them. So just add some dummy data. This can go away when DbusMonitor is more generic.
-    dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
-    dbus_tree = {'com.victronenergy.system': 
-      {'/Dc/Battery/Soc': dummy, '/Dc/Battery/Current': dummy, '/Dc/Battery/Voltage': dummy, \
-        '/Dc/Pv/Current': dummy, '/Ac/PvOnOutput/L1/Power': dummy, '/Ac/PvOnOutput/L2/Power': dummy, }}
-
-    self._dbusmonitor = self._create_dbus_monitor(dbus_tree, valueChangedCallback=self._dbus_value_changed)
+    # BMS frames are spaced by mainloop deadlines, never by sleeping
+    self._tx = TxScheduler(self._can_bus, _cfg_can.get('tx_spacing_ms', 100), gobject.timeout_add)
+    self._bms_tx_mode = _cfg_can.get('bms_tx_mode', 'mainloop')
+    self._bms_frames = BmsFrameBuilder()
+
+    # 0x351 send-on-change, amps/time of the last 0x351 that went on the wire
+    self._fast_chg = bool(_cfg_can.get('fast_chg_update', True))
+    self._fast_chg_deadband = float(_cfg_can.get('fast_chg_deadband_a', 1.0))
+    self._fast_chg_interval = _cfg_can.get('fast_chg_min_interval_ms', 250) / 1000.0
+    self._chg_sent_amps = None
+    self._chg_sent_time = 0.0
+    # latest requested amps and the one-shot timer that sends them once the min interval is over
+    self._chg_request = None
+    self._chg_timer = None
+    self._keepalive_hold = None
+    if (_cfg_can.get('keepalive_policy', 'hold') == 'expire'):
+      self._keepalive_hold = float(_cfg_can.get('keepalive_hold_s', 120))
+
+    self._startup.mark("can")
+
+    # energy counters, charge state and the last system values survive restarts, see _restore_state
+    _cfg_journal = self._cfg.get('Journal', {})
+    self._journal = None
+    self._journal_pending = False
+    restored = False
+    # restored system values are dropped once this old, if the monitor has not replaced them
+    self._max_restored_age = _cfg_journal.get('max_bms_state_age_s', 600)
+    if (_cfg_journal.get('enabled', True)):
+      self._journal = StateJournal(_cfg_journal.get('path', '/data/etc/dbus-sma/state.journal'), \
+        compact_records=_cfg_journal.get('compact_records', 288))
+      restored = self._restore_state(self._max_restored_age)
+      _interval = int(_cfg_journal.get('sync_interval_s', 300) * 1000)
+      gobject.timeout_add(_interval, exit_on_error, self._diag.probe("Journal", self._journal_handler, _interval))
+    self._startup.mark("restore")
+
+    # The SunnyIsland shuts down when the BMS frames stop. Resume them from the
+    # restored values right away, before any dbus setup, and start the tick.
+    if (restored):
+      self._send_restored_frames()
+      logger.info("First BMS frame sent {0:.0f}ms after process start".format(self._startup.since_process_start() * 1000))
+    gobject.timeout_add(2000, exit_on_error, self._diag.probe("CanTx", self._can_bus_txmit_handler, 2000))
+    _interval = int(_cfg_energy.get('publish_interval_s', 10) * 1000)
+    gobject.timeout_add(_interval, exit_on_error, self._diag.probe("Energy", self._energy_handler, _interval))
+    self._start_can_receive(_cfg_can.get('rx_mode', 'watch'))
+    self._startup.mark("first_tx")
+
+    # fast_start: the dbus setup (settings, monitor scan, service and paths) runs
+    # from the mainloop once the first spaced BMS burst is out
+    _cfg_startup = self._cfg.get('Startup', {})
+    if (_cfg_startup.get('fast_start', True)):
+      _delay = len(self._bms_frames.frames) * _cfg_can.get('tx_spacing_ms', 100) if restored else 0
+      gobject.timeout_add(int(_delay), exit_on_error, self._init_dbus)
+    else:
+      self._init_dbus()
+
+#----
+  # everything that needs dbus, or the dbus process in the can role
+  def _init_dbus(self):
+    self._startup.mark("mainloop_wait")
+    # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
+    if (self._role != "can"):
+      import dbus
+      from dbus.mainloop.glib import DBusGMainLoop
+      from settingsdevice import SettingsDevice  # available in the velib_python repository
+      DBusGMainLoop(set_as_default=True)
+
+    # in the can role the dbus process owns the settings, monitor and service,
+    # the monitor and service used here are proxies over the IPC link
+    self._link = None
+    if (self._role == "can"):
+      self._link = create_link(self._cfg, self._role, self._link_message, self._link_state)
+    else:
+      SettingsDevice(bus=dbus.SystemBus(), supportedSettings=SUPPORTED_SETTINGS, eventCallback=None)
+
+    self._dbusmonitor = self._create_dbus_monitor(DBUS_TREE, valueChangedCallback=self._dbus_value_changed)
+    self._system.prime(self._dbusmonitor)
+    self._safety.soc = self._system.get('com.victronenergy.system', '/Dc/Battery/Soc')
+    self._startup.mark("dbus_monitor")
 
     self._dbusservice = self._create_dbus_service()
 
@@ -278,6 +439,11 @@ class SmaDriver:
     self._dbusservice.add_path('/Dc/0/Current',           -1)
     self._dbusservice.add_path('/Ac/NumberOfPhases',       2)
     self._dbusservice.add_path('/Alarms/GridLost',         0)
+    self._dbusservice.add_path('/Diagnostics/Safety/InverterOff',     0)
+    self._dbusservice.add_path('/Diagnostics/Safety/LastReactionMs', -1)
+    self._dbusservice.add_path('/Diagnostics/Safety/MaxReactionMs',  -1)
+    self._dbusservice.add_path('/Can/RawCapture', value=int(self._raw_capture), writeable=True, \
+      onchangecallback=self._handle_changed_raw_capture)
 
     # /VebusChargeState  <- 1. Bulk
     #                       2. Absorption
@@ -298,125 +464,180 @@ class SmaDriver:
     self._dbusservice.add_path('/Energy/InverterToAcOut',  0)
     self._dbusservice.add_path('/Energy/Time',       timer())
 
-    self._changed = True
+    # the histograms are published under /Diagnostics and logged on SIGUSR1
+    _cfg_diag = self._cfg.get('Diagnostics', {})
+    for path, value in self._diag.paths():
+      self._dbusservice.add_path(path, value)
+    _interval = int(_cfg_diag.get('publish_interval_s', 30) * 1000)
+    gobject.timeout_add(_interval, exit_on_error, self._diagnostics_handler)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: self._diag.dump())
 
-    # create timers (time in msec)
-    gobject.timeout_add(2000, exit_on_error, self._can_bus_txmit_handler)
-    gobject.timeout_add(2000, exit_on_error, self._energy_handler)
-    gobject.timeout_add(20, exit_on_error, self._parse_can_data_handler)
+    self._dbusservice.add_path('/Diagnostics/Bus/Stale', 0)
+    self._stats_paths = set()
+    _cfg_stats = self._cfg.get('BusStats', {})
+    _interval = int(_cfg_stats.get('check_interval_s', 2) * 1000)
+    gobject.timeout_add(_interval, exit_on_error, self._bus_stats_handler)
+
+    # the paths exist now, values published so far go out
+    self._publisher.attach(self._dbusservice)
+    self._startup.mark("dbus_service")
+
+    if (self._link is not None):
+      self._link.send({"type": "hello"})
+
+    logger.info("Startup: {0}".format(self._startup.summary()))
+    self.started = True
+    return False # one shot
 
 #----
   def __del__(self):
+    if (getattr(self, '_journal', None)):
+      self._journal_handler()
+      self._journal = None
+    if (getattr(self, '_link', None)):
+      self._link.close()
+      self._link = None
     if (self._can_bus):
+      self._tx.stop_periodic()
       self._can_bus.shutdown()
       self._can_bus = False
       logger.debug("bus shutdown")
 
 #----
-  def run(self):
+  # until_started: return once the deferred dbus setup is done (--profile-startup)
+  def run(self, until_started=False):
     # Start and run the mainloop
     logger.info("Starting mainloop, responding only on events")
     self._mainloop = gobject.MainLoop()
+    if (until_started):
+      gobject.timeout_add(10, self._quit_when_started)
 
     try:
       self._mainloop.run()
     except KeyboardInterrupt:
       self._mainloop.quit()
 
+#----
+  def _quit_when_started(self):
+    if (not self.started):
+      return True
+    self._mainloop.quit()
+    return False
+
+#----
+  def startup_report(self):
+    return self._startup.summary()
+
+#----
+  def _create_can_bus(self, cfg_can, filters):
+    return can.interface.Bus(bustype=cfg_can.get('type', canBusType), channel=cfg_can.get('channel', canBusChannel), \
+      bitrate=cfg_can.get('bitrate', 500000), can_filters=filters)
+
 #----
   def _create_dbus_monitor(self, *args, **kwargs):
-    return DbusMonitor(*args, **kwargs)  
+    if (self._link is not None):
+      from ipc_link import LinkMonitor
+      return LinkMonitor(*args, **kwargs)
+    return create_dbus_monitor(self._cfg, *args, **kwargs)
 
 #----	
   def _create_dbus_service(self):
-    dbusservice = VeDbusService(driver['connection'])
-    dbusservice.add_mandatory_paths(
-      processname=__file__,
-      processversion=softwareVersion,
-      connection=driver['connection'],
-      deviceinstance=driver['instance'],
-      productid=driver['id'],
-      productname=driver['name'],
-      firmwareversion=driver['version'],
-      hardwareversion=driver['version'],
-      connected=1)
-    return dbusservice
+    if (self._link is not None):
+      from ipc_link import LinkService
+      return LinkService(self._link, gobject.timeout_add)
+    return create_dbus_service()
+
+#----
+  # can role: messages from the dbus process
+  def _link_message(self, msg):
+    msg_type = msg.get("type")
+    if (msg_type == "hello"):
+      # the dbus process (re)started with an empty service
+      self._dbusservice.send_snapshot()
+    elif (msg_type == "monitor"):
+      self._dbusmonitor.update(msg["values"])
+    elif (msg_type == "write"):
+      self._dbusservice.client_write(msg["path"], msg["value"])
+
+#----
+  def _link_state(self, up):
+    if (not up):
+      logger.warning("dbus process not responding, BMS frames continue with the last system values")
+
+#----
+  # widen the kernel filter to every frame (raw capture / discovery), or narrow it back
+  def set_raw_capture(self, enable):
+    self._raw_capture = bool(enable)
+    if (self._can_bus):
+      self._can_bus.set_filters(None if self._raw_capture else can_filters(self._rx_ids))
+    logger.info("CAN raw capture: {0}".format(self._raw_capture))
+
+#----
+  # add ids to the decoded set at runtime, kernel filter follows
+  def add_rx_ids(self, ids):
+    self._rx_ids.update(ids)
+    self.set_raw_capture(self._raw_capture)
+
+#----
+  def _handle_changed_raw_capture(self, path, value):
+    self.set_raw_capture(value)
+    return True
 
 #----
   # callback that gets called ever time a dbus value has changed
   def _dbus_value_changed(self, dbusServiceName, dbusPath, dict, changes, deviceInstance):
-    self._changed = True
+    if (self._system.update(dbusServiceName, dbusPath, changes['Value']) and dbusPath == '/Dc/Battery/Soc'):
+      # low SoC shutdown is evaluated on the next frame, no need to wait for the tick
+      self._safety.soc = self._system.get(dbusServiceName, dbusPath)
+
+#----
+  # socketcan exposes a fd, let the mainloop wake us when frames are queued
+  # instead of polling. slcan (or a failed bus) falls back to a 20 msec timer.
+  def _start_can_receive(self, rx_mode):
+    fd = -1
+    if (rx_mode == "watch" and self._can_bus):
+      try:
+        fd = self._can_bus.fileno()
+      except (NotImplementedError, AttributeError):
+        fd = -1
+
+    if (fd >= 0):
+      logger.info("CAN receive: watching socket fd {0}".format(fd))
+      gobject.io_add_watch(fd, gobject.IO_IN | gobject.IO_PRI | gobject.IO_ERR | gobject.IO_HUP, \
+        self._can_fd_ready)
+    else:
+      logger.info("CAN receive: polling every 20 msec")
+      gobject.timeout_add(20, exit_on_error, self._rx_probe)
 
 #----
-  # called by timer every 20 msec
+  # called by the mainloop when the CAN socket is readable
+  def _can_fd_ready(self, fd, condition):
+    if (condition & (gobject.IO_ERR | gobject.IO_HUP)):
+      logger.error("CAN socket error (condition {0}), falling back to polling".format(condition))
+      self._start_can_receive("poll")
+      return False # remove the fd watch
+
+    return exit_on_error(self._rx_probe)
+
+#----
+  # drain the frames already queued on the bus, never blocks
   def _parse_can_data_handler(self):
 
     try:
-      msg = None
-      # read msgs until we get one we want
-      while True:
-        msg = self._can_bus.recv(1)
-        if (msg is None) :
-          sma_system["State"] = 0
-          #self._dbusservice["/State"] = 0
-          logger.info("No Message received from Sunny Island")
-          return True
-          
-        if (msg.arbitration_id == CANFrames["ExtPwr"] or msg.arbitration_id == CANFrames["InvPwr"] or \
-              msg.arbitration_id == CANFrames["LoadPwr"] or msg.arbitration_id == CANFrames["OutputVoltage"] or \
-              msg.arbitration_id == CANFrames["ExtVoltage"] or msg.arbitration_id == CANFrames["Battery"] or \
-              msg.arbitration_id == CANFrames["Relay"] or msg.arbitration_id == CANFrames["Bits"]):
+      for i in range(CAN_RX_BATCH):
+        msg = self._can_bus.recv(0)
+        if (msg is None):
           break
-        
-      if msg is not None:
-        if msg.arbitration_id == CANFrames["ExtPwr"]:
-          sma_line1["ExtPwr"] = (getSignedNumber(msg.data[0] + msg.data[1]*256, 16)*100)
-          sma_line2["ExtPwr"] = (getSignedNumber(msg.data[2] + msg.data[3]*256, 16)*100)
-          #self._updatedbus()
-          #print ("Ex Power L1: " + str(sma_line1["ExtPwr"]) + "  Power L2: " + str(sma_line2["ExtPwr"]))
-        elif msg.arbitration_id == CANFrames["InvPwr"]:
-          sma_line1["InvPwr"] = (getSignedNumber(msg.data[0] + msg.data[1]*256, 16)*100)
-          sma_line2["InvPwr"] = (getSignedNumber(msg.data[2] + msg.data[3]*256, 16)*100)
-          #calculate_pwr()
-          #print ("Power L1: " + str(sma_line1["InvPwr"]) + "  Power L2: " + str(sma_line2["InvPwr"]))
-          self._updatedbus()
-        elif msg.arbitration_id == CANFrames["LoadPwr"]:
-          sma_system["Load"] = (getSignedNumber(msg.data[0] + msg.data[1]*256, 16)*100)
-          self._updatedbus()
-        elif msg.arbitration_id == CANFrames["OutputVoltage"]:
-          sma_line1["OutputVoltage"] = (float(getSignedNumber(msg.data[0] + msg.data[1]*256, 16))/10)
-          sma_line2["OutputVoltage"] = (float(getSignedNumber(msg.data[2] + msg.data[3]*256, 16))/10)
-          sma_line1["OutputFreq"] = float(msg.data[6] + msg.data[7]*256) / 100
-          self._updatedbus()
-        elif msg.arbitration_id == CANFrames["ExtVoltage"]:
-          sma_line1["ExtVoltage"] = (float(getSignedNumber(msg.data[0] + msg.data[1]*256, 16))/10)
-          sma_line2["ExtVoltage"] = (float(getSignedNumber(msg.data[2] + msg.data[3]*256, 16))/10)
-          sma_line1["ExtFreq"] = float(msg.data[6] + msg.data[7]*256) / 100
-          self._updatedbus()
-        elif msg.arbitration_id == CANFrames["Battery"]:
-          sma_battery["Voltage"] = float(msg.data[0] + msg.data[1]*256) / 10
-          sma_battery["Current"] = float(getSignedNumber(msg.data[2] + msg.data[3]*256, 16)) / 10
-          self._updatedbus()   
-        elif msg.arbitration_id == CANFrames["Bits"]:
-          if msg.data[2]&128:
-            sma_system["ExtRelay"] = 1
-          else:
-            sma_system["ExtRelay"] = 0
-          if msg.data[2]&64:
-            sma_system["ExtOk"] = 0 
-            #print ("Grid OK")
-          else:
-            #it seems to always report grid down once during relay transfer, so lets wait for two messages to latch. 
-            if sma_system["ExtOk"] == 0:
-              sma_system["ExtOk"] = 1
-            elif sma_system["ExtOk"] == 1:
-              sma_system["ExtOk"] = 2
-            #print ("Grid Down")
-        
-          #print ("307 message" )
-          #print(msg) 
 
-    except (KeyboardInterrupt) as e:
+        self._last_rx_time = timer()
+        self._bus_stats.update(msg, msg.timestamp or time.time())
+
+        if (msg.arbitration_id in self._rx_ids):
+          self._process_can_msg(msg)
+        elif (self._raw_capture):
+          logger.debug("Raw: {0}".format(msg))
+
+    except (KeyboardInterrupt):
       self._mainloop.quit()
     except (can.CanError) as e:
       logger.error(e)
@@ -428,25 +649,108 @@ class SmaDriver:
     return True
 
 #----
-  def _updatedbus(self):
-    #self._dbusservice["/State"] = sma_system["State"]
-    self._dbusservice["/Ac/ActiveIn/L1/P"] = sma_line1["ExtPwr"]
-    self._dbusservice["/Ac/ActiveIn/L2/P"] = sma_line2["ExtPwr"]
-    self._dbusservice["/Ac/ActiveIn/L1/V"] = sma_line1["ExtVoltage"]
-    self._dbusservice["/Ac/ActiveIn/L2/V"] = sma_line2["ExtVoltage"]
-    self._dbusservice["/Ac/ActiveIn/L1/F"] = sma_line1["ExtFreq"]
-    self._dbusservice["/Ac/ActiveIn/L2/F"] = sma_line1["ExtFreq"]
-    if sma_system["ExtOk"] == 0 or sma_system["ExtOk"] == 2:
-      self._dbusservice["/Alarms/GridLost"] = sma_system["ExtOk"]
+  # decode one SunnyRemote frame into the sma_* state
+  def _process_can_msg(self, msg):
+    frame = self._codec.decode(msg.arbitration_id, msg.data)
+    timestamp = msg.timestamp or time.time()
+    grid_changed = False
+
+    if (frame == "Bits"):
+      grid_changed = self._update_ext_bits(sma_system["ExtFlags"])
+    elif (frame == "LoadPwr"):
+      self._energy.add_ac_out(sma_system["Load"], timestamp)
+    elif (frame == "Battery"):
+      # SMA current is negative into the battery
+      self._energy.add_dc(sma_battery["Current"] * sma_battery["Voltage"] *-1, timestamp)
+      # gated on the receive time, the frame timestamp is wall clock and steps with NTP
+      now = timer()
+      if (self._control_interval is not None and \
+          (self._control_time is None or now - self._control_time >= self._control_interval)):
+        self._run_charge_control(now)
+
+    # recompute only the dbus values that depend on this frame
+    start = timer()
+    self._publisher.note_source_time(timestamp)
+    for derive in self._frame_derives.get(frame, ()):
+      derive()
+    self._derive_time.record(timer() - start)
+
+    if (frame in SAFETY_FRAMES):
+      self._check_safety(timestamp)
+    if (grid_changed):
+      # don't hold a grid alarm back for the publish interval
+      self._publisher.flush()
+
+#----
+  # 0x307 byte 2: bit 7 AC2 relay closed, bit 6 valid voltage on AC2
+  # returns True when the latched grid state changed
+  def _update_ext_bits(self, flags):
+    if flags&128:
+      sma_system["ExtRelay"] = 1
+    else:
+      sma_system["ExtRelay"] = 0
+
+    #it seems to always report grid down once during relay transfer, the monitor debounces on receive time
+    changed = self._safety.update_grid(flags&64)
+    sma_system["ExtOk"] = self._safety.ext_ok
+    return changed
+
+#----
+  # send SMA_OFF_MSG / SMA_ON_MSG as soon as the safety logic asks for it
+  def _check_safety(self, timestamp):
+    cmd = self._safety.evaluate(sma_system["State"], timestamp)
+    if (cmd == "off"):
+      self._tx.send_now(SMA_OFF_MSG)
+      logger.info("Shut off inverters due to low SoC, reaction {0:.1f} ms".format(self._safety.last_reaction * 1000))
+    elif (cmd == "on"):
+      self._tx.send_now(SMA_ON_MSG)
+      logger.info("Start inverters due to grid restore or SoC increase")
+
+    self._publisher["/Diagnostics/Safety/InverterOff"] = int(self._safety.safety_off)
+    if (cmd is not None):
+      self._publisher["/Diagnostics/Safety/LastReactionMs"] = round(self._safety.last_reaction * 1000, 1)
+      self._publisher["/Diagnostics/Safety/MaxReactionMs"] = round(self._safety.max_reaction * 1000, 1)
+
+#----
+  # recompute every derived dbus value
+  def _updatedbus(self, groups=DERIVE_ALL):
+    for group in groups:
+      self._derivers[group]()
+
+#----
+  def _derive_ac_in(self):
+    self._publisher["/Ac/ActiveIn/L1/P"] = sma_line1["ExtPwr"]
+    self._publisher["/Ac/ActiveIn/L2/P"] = sma_line2["ExtPwr"]
+    self._publisher["/Ac/ActiveIn/L1/V"] = sma_line1["ExtVoltage"]
+    self._publisher["/Ac/ActiveIn/L2/V"] = sma_line2["ExtVoltage"]
+    self._publisher["/Ac/ActiveIn/L1/F"] = sma_line1["ExtFreq"]
+    self._publisher["/Ac/ActiveIn/L2/F"] = sma_line1["ExtFreq"]
     if sma_line1["ExtVoltage"] != 0:
-      self._dbusservice["/Ac/ActiveIn/L1/I"] = int(sma_line1["ExtPwr"] / sma_line1["ExtVoltage"])
+      self._publisher["/Ac/ActiveIn/L1/I"] = int(sma_line1["ExtPwr"] / sma_line1["ExtVoltage"])
     if sma_line2["ExtVoltage"] != 0:
-      self._dbusservice["/Ac/ActiveIn/L2/I"] = int(sma_line2["ExtPwr"] / sma_line2["ExtVoltage"])
-    self._dbusservice["/Ac/ActiveIn/P"] = sma_line1["ExtPwr"] + sma_line2["ExtPwr"]
-    self._dbusservice["/Dc/0/Voltage"] = sma_battery["Voltage"]
-    self._dbusservice["/Dc/0/Current"] = sma_battery["Current"] *-1
-    self._dbusservice["/Dc/0/Power"] = sma_battery["Current"] * sma_battery["Voltage"] *-1
-    
+      self._publisher["/Ac/ActiveIn/L2/I"] = int(sma_line2["ExtPwr"] / sma_line2["ExtVoltage"])
+    self._publisher["/Ac/ActiveIn/P"] = sma_line1["ExtPwr"] + sma_line2["ExtPwr"]
+
+#----
+  def _derive_dc(self):
+    self._publisher["/Dc/0/Voltage"] = sma_battery["Voltage"]
+    self._publisher["/Dc/0/Current"] = sma_battery["Current"] *-1
+    self._publisher["/Dc/0/Power"] = sma_battery["Current"] * sma_battery["Voltage"] *-1
+
+#----
+  def _derive_grid(self):
+    if sma_system["ExtOk"] == 0 or sma_system["ExtOk"] == 2:
+      self._publisher["/Alarms/GridLost"] = sma_system["ExtOk"]
+
+    if sma_system["ExtRelay"]:
+      self._publisher["/Ac/ActiveIn/Connected"] = 1
+      self._publisher["/Ac/ActiveIn/ActiveInput"] = 0
+    else:
+      self._publisher["/Ac/ActiveIn/Connected"] = 0
+      self._publisher["/Ac/ActiveIn/ActiveInput"] = 240
+
+#----
+  def _derive_ac_out(self):
     line1_inv_outpwr = sma_line1["ExtPwr"] + sma_line1["InvPwr"]
     line2_inv_outpwr = sma_line2["ExtPwr"] + sma_line2["InvPwr"]
 
@@ -461,29 +765,27 @@ class SmaDriver:
       line1_inv_outpwr-=50
       line2_inv_outpwr-=50
 
-    self._dbusservice["/Ac/Out/L1/P"] = line1_inv_outpwr
-    self._dbusservice["/Ac/Out/L2/P"] = line2_inv_outpwr
-    self._dbusservice["/Ac/Out/P"] =  sma_system["Load"] 
-    self._dbusservice["/Ac/Out/L1/F"] = sma_line1["OutputFreq"]
-    self._dbusservice["/Ac/Out/L2/F"] = sma_line1["OutputFreq"]
-    self._dbusservice["/Ac/Out/L1/V"] = sma_line1["OutputVoltage"]
-    self._dbusservice["/Ac/Out/L2/V"] = sma_line2["OutputVoltage"]
+    self._publisher["/Ac/Out/L1/P"] = line1_inv_outpwr
+    self._publisher["/Ac/Out/L2/P"] = line2_inv_outpwr
+    self._publisher["/Ac/Out/P"] =  sma_system["Load"] 
+    self._publisher["/Ac/Out/L1/F"] = sma_line1["OutputFreq"]
+    self._publisher["/Ac/Out/L2/F"] = sma_line1["OutputFreq"]
+    self._publisher["/Ac/Out/L1/V"] = sma_line1["OutputVoltage"]
+    self._publisher["/Ac/Out/L2/V"] = sma_line2["OutputVoltage"]
     
+    if sma_line1["OutputVoltage"] > 5:
+      self._publisher["/Ac/Out/L1/I"] = int(line1_inv_outpwr / sma_line1["OutputVoltage"])
+    if sma_line2["OutputVoltage"] > 5:
+      self._publisher["/Ac/Out/L2/I"] = int(line2_inv_outpwr / sma_line2["OutputVoltage"])
+
+#----
+  def _derive_state(self):
     inverter_on = 0
     if sma_line1["OutputVoltage"] > 5:
-      self._dbusservice["/Ac/Out/L1/I"] = int(line1_inv_outpwr / sma_line1["OutputVoltage"])
       inverter_on += 1
     if sma_line2["OutputVoltage"] > 5:
-      self._dbusservice["/Ac/Out/L2/I"] = int(line2_inv_outpwr / sma_line2["OutputVoltage"])
       inverter_on += 1
 
-    if sma_system["ExtRelay"]:
-      self._dbusservice["/Ac/ActiveIn/Connected"] = 1
-      self._dbusservice["/Ac/ActiveIn/ActiveInput"] = 0
-    else:
-      self._dbusservice["/Ac/ActiveIn/Connected"] = 0
-      self._dbusservice["/Ac/ActiveIn/ActiveInput"] = 240
-
     # state = 3:Bulk, 4:Absorb, 5:Float, 6:Storage, 7:Equalize, 8:Passthrough 9:Inverting 
     # push charging state to dbus
     vebusChargeState = 0
@@ -505,34 +807,124 @@ class SmaDriver:
           vebusChargeState = 3
           sma_system["State"] = 5
 
-    self._dbusservice["/VebusChargeState"] = vebusChargeState
-    self._dbusservice["/State"] = sma_system["State"]
+    self._publisher["/VebusChargeState"] = vebusChargeState
+    self._publisher["/State"] = sma_system["State"]
 
 #----
+  # publish the energy counters, they are integrated per frame in _process_can_msg
   def _energy_handler(self):
-    energy_sec = timer() - self._dbusservice["/Energy/Time"]
-    self._dbusservice["/Energy/Time"] = timer()
-    
-    if self._dbusservice["/Dc/0/Power"] > 0:
-      #Grid to battery
-      self._dbusservice["/Energy/GridToAcOut"] = self._dbusservice["/Energy/GridToAcOut"] + \
-        ((self._dbusservice["/Ac/Out/P"]) * energy_sec * 0.00000028)
+    for path, value in self._energy.paths():
+      self._publisher[path] = value
+    self._publisher["/Energy/Time"] = timer()
+    return True
+
+#----
+  # called by timer every check_interval_s
+  def _bus_stats_handler(self):
+    now = time.time()
+    for can_id in self._bus_stats.check(now):
+      if (self._bus_stats.frames[can_id].stale):
+        logger.warning("No 0x{0:03X} frame from Sunny Island for {1}s, its values are stale" \
+          .format(can_id, self._bus_stats.watch_timeouts[can_id]))
+      else:
+        logger.info("0x{0:03X} frames from Sunny Island are back".format(can_id))
+    self._publisher["/Diagnostics/Bus/Stale"] = int(self._bus_stats.any_stale())
+
+    # ids show up as they are first seen
+    for path, value in self._bus_stats.paths(now):
+      if (path not in self._stats_paths):
+        self._dbusservice.add_path(path, value)
+        self._stats_paths.add(path)
+      self._publisher[path] = value
+    return True
+
+#----
+  # called by timer every publish_interval_s
+  def _diagnostics_handler(self):
+    for path, value in self._diag.paths():
+      self._publisher[path] = value
+    return True
+
+#----
+  # returns True when the record is recent enough to send BMS frames from
+  def _restore_state(self, max_bms_state_age):
+    record = self._journal.load()
+    if (record is None):
+      logger.info("No saved state in {0}".format(self._journal.path))
+      return False
+
+    energy = record.get("energy", {})
+    self._energy.restore(energy.get("grid_to_dc", 0.0), energy.get("grid_to_acout", 0.0), \
+      energy.get("dc_to_acout", 0.0))
+
+    # a charge state from long ago says nothing about the battery now
+    age = time.time() - record.get("time", 0)
+    bms = record.get("bms", {})
+    if (age <= max_bms_state_age and bms.get("state")):
+      self.bms_controller.restore_state(bms["state"], bms.get("absorb_elapsed"), bms.get("charge_current"))
+      self._bms_data.charging_state = self.bms_controller.get_state()
+
+    logger.info("Restored state saved {0:.0f}s ago, charge state: {1}".format(age, self.bms_controller.get_state()))
+
+    # last known good system values, until the monitor has the current ones
+    system = record.get("system", {})
+    if (age > max_bms_state_age or system.get("soc") is None or system.get("voltage") is None):
+      return False
+    for key, path in JOURNAL_SYSTEM_PATHS.items():
+      self._system.update('com.victronenergy.system', path, system.get(key), age=age, restored=True)
+    self._safety.soc = self._system.get('com.victronenergy.system', '/Dc/Battery/Soc')
+    return True
 
-      self._dbusservice["/Energy/GridToDc"] = self._dbusservice["/Energy/GridToDc"] + \
-        (self._dbusservice["/Dc/0/Power"]  * energy_sec * 0.00000028)
+#----
+  # first BMS frames after a restart, from the restored values: no controller
+  # step, the SunnyIsland has sent no battery frame yet
+  def _send_restored_frames(self):
+    self._bms_data.state_of_charge = self._system.get('com.victronenergy.system', '/Dc/Battery/Soc')
+    charge_current = self.bms_controller.get_charge_current()
+    self._bms_frames.update_charge(self._bms_data.max_battery_voltage, charge_current, \
+      self._bms_data.req_discharge_amps, self._bms_data.min_battery_voltage)
+    self._bms_frames.update_soc(self._bms_data.state_of_charge)
+
+    if (self._bms_tx_mode == "kernel"):
+      self._tx.start_periodic(self._bms_frames.frames, 2.0, self._keepalive_hold)
     else:
-      #battery to out
-      self._dbusservice["/Energy/DcToAcOut"] = self._dbusservice["/Energy/DcToAcOut"] + \
-        ((self._dbusservice["/Ac/Out/P"])  * energy_sec * 0.00000028)
-  
-    #print(timer() - self._dbusservice["/Energy/Time"], ":", self._dbusservice["/Ac/Out/P"])
+      self._tx.send_spaced(self._bms_frames.frames)
+      self._chg_sent_amps = charge_current
+      self._chg_sent_time = timer()
 
-    self._dbusservice["/Energy/AcIn1ToAcOut"] = self._dbusservice["/Energy/GridToAcOut"]
-    self._dbusservice["/Energy/AcIn1ToInverter"] = self._dbusservice["/Energy/GridToDc"]
-    self._dbusservice["/Energy/InverterToAcOut"] = self._dbusservice["/Energy/DcToAcOut"]
-    self._dbusservice["/Energy/Time"] = timer()
+#----
+  # called by timer every sync_interval_s, one fsynced record per call
+  def _journal_handler(self):
+    record = {
+      "time": time.time(),
+      "energy": {"grid_to_dc": self._energy.grid_to_dc, "grid_to_acout": self._energy.grid_to_acout, \
+        "dc_to_acout": self._energy.dc_to_acout},
+      "bms": {"state": self.bms_controller.get_state(), "absorb_elapsed": self.bms_controller.get_absorb_elapsed(), \
+        "charge_current": self.bms_controller.get_charge_current()},
+      "system": dict((key, self._system.get('com.victronenergy.system', path)) for key, path in JOURNAL_SYSTEM_PATHS.items()),
+    }
+    try:
+      self._journal.append(record)
+    except (IOError, OSError) as e:
+      logger.error("Saving state to {0} failed: {1}".format(self._journal.path, e))
     return True
 
+#----
+  # A charge state change is journaled right away, so a restart resumes the new
+  # state instead of a record up to sync_interval_s old. The write (and fsync)
+  # runs from the mainloop once the current handler returns, not inside the
+  # CAN receive path.
+  def _journal_state_change(self):
+    if (self._journal and not self._journal_pending):
+      self._journal_pending = True
+      gobject.idle_add(exit_on_error, self._journal_idle)
+
+  def _journal_idle(self):
+    self._journal_pending = False
+    if (self._journal):
+      self._journal_handler()
+    return False # one shot
+
 #----
   # BMS charge logic since SMA is in dumb mode
   def _execute_grid_solar_charge_logic(self):
@@ -592,6 +984,11 @@ class SmaDriver:
 #----
  	# Called on a two second timer to send CAN messages
   def _can_bus_txmit_handler(self):
+
+    # receive no longer blocks waiting on the bus, so check for silence here
+    if (timer() - self._last_rx_time > 1.0):
+      sma_system["State"] = 0
+      logger.info("No Message received from Sunny Island")
   
     # log data received from SMA on CAN bus (doing it here since this timer is slower!)
     out_load_msg = "SMA: System Load: {0}, Driver runtime: {1}".format(sma_system["Load"], datetime.now() - self.driver_start_time)
@@ -610,18 +1007,25 @@ class SmaDriver:
     logger.info(out_inv_msg)
     logger.info(out_batt_msg)
     
-    #get some data from the Victron BUS, invalid data returns NoneType
-    soc = self._dbusmonitor.get_value('com.victronenergy.system', '/Dc/Battery/Soc')
-    volt = self._dbusmonitor.get_value('com.victronenergy.system', '/Dc/Battery/Voltage')
-    current = self._dbusmonitor.get_value('com.victronenergy.system', '/Dc/Battery/Current')
-    pv_current = self._dbusmonitor.get_value('com.victronenergy.system', '/Dc/Pv/Current')
-    if (pv_current == None):
-      pv_current = 0.0
+    #get some data from the Victron BUS (cached), invalid data returns NoneType
+    system = self._system
+
+    # journal values only bridge a restart, once too old the driver acts as without values
+    if (system.expire_restored(self._max_restored_age)):
+      logger.warning("Restored system values are older than {0}s and com.victronenergy.system has not " \
+        "replaced them, BMS frames stop until it does".format(self._max_restored_age))
+      self._safety.soc = system.get('com.victronenergy.system', '/Dc/Battery/Soc')
+      if (self._bms_tx_mode == "kernel" and self._tx.is_periodic()):
+        self._tx.stop_periodic()
+    soc = system.get('com.victronenergy.system', '/Dc/Battery/Soc')
+    volt = system.get('com.victronenergy.system', '/Dc/Battery/Voltage')
+    current = system.get('com.victronenergy.system', '/Dc/Battery/Current')
+    pv_current = system.get('com.victronenergy.system', '/Dc/Pv/Current', 0.0)
 
     # if we don't have these values, there is nothing to do!
     if (soc == None or volt == None):
-      logger.error("DBusMonitor returning None for one or more: SOC: {0}, Volt: {1}, Current: {2}, PVCurrent: {3}" \
-          .format(soc, volt, current, pv_current))
+      logger.error("DBusMonitor returning None for one or more: SOC: {0}, Volt: {1}, Current: {2}, PVCurrent: {3}, " \
+          "last changed {4}s ago".format(soc, volt, current, pv_current, system.age('com.victronenergy.system', '/Dc/Battery/Soc')))
       return True
 
     # update bms state data
@@ -636,10 +1040,14 @@ class SmaDriver:
     # update the battery voltage for the BMS to determine next state or charge current level
     # Note: Positive value for current means it is going INTO the battery. SMA will report as negative
     # so we change signs here
-    is_state_changed = self.bms_controller.update_battery_data(self._bms_data.actual_battery_voltage, \
-        -(sma_battery["Current"]))
+    if (self._control_interval is None):
+      is_state_changed = self.bms_controller.update_battery_data(self._bms_data.actual_battery_voltage, \
+          -(sma_battery["Current"]))
+      if (is_state_changed):
+        self._journal_state_change()
 
     self._bms_data.charging_state = self.bms_controller.get_state()
+    self._derive_state()
     charge_current = self.bms_controller.get_charge_current()
   
     logger.info("BMS Send, SoC: {0:.1f}%, Batt Voltage: {1:.2f}V, Batt Current: {2:.2f}A, Charge State: {3}, Req Charge: {4}A, Req Discharge: {5}A, PV Cur: {6} ". \
@@ -648,130 +1056,280 @@ class SmaDriver:
         self._bms_data.req_discharge_amps, self._bms_data.pv_current))
         
     #**************Low battery safety****************# 
-    
-    _cfg_safety = self._cfg["SafetyLogic"]
 
     #if grid is up but battery low voltage, issue with shunt calibration or SMA setting, pre-empt SoC with minimum value to force grid transfer
     if (sma_system["ExtOk"] == 0 and self._bms_data.actual_battery_voltage < self._bms_data.low_battery_voltage):
       self._bms_data.state_of_charge = 1.0
 
-    #if no grid and Soc is low, we are in blackout with dead batteries and need to shut off inverters
-    if(self._safety_off == False):
-      #normal running, check for grid not ok AND low Soc, send off message till inverters respond
-      if(sma_system["ExtOk"] == 2 and  soc < _cfg_safety["min_soc_inv_off"]):   
-        self._can_bus.send(SMA_OFF_MSG)
-        if(sma_system["State"] == 0):
-          self._safety_off = True
-        #print("Shut off due to low SoC")
-    else:
-      #if we saftey shutdown, keep checking for grid restore OR SoC increase, send on message till inverters respond
-      if(sma_system["ExtOk"] == 0 or soc >= _cfg_safety["min_soc_inv_off"]):  
-        self._can_bus.send(SMA_ON_MSG)
-        if(sma_system["State"] != 0): 
-          self._safety_off = False
-        #print("Start SMA due to grid restore or SoC increase")
-
-    #breakup some of the values for CAN packing
-    SoC_HD = int(self._bms_data.state_of_charge*100)
-    SoC_HD_H, SoC_HD_L = bytes(SoC_HD)
-
-    Req_Charge_H, Req_Charge_L = bytes(int(charge_current*10))
-
-    Req_Discharge_H, Req_Discharge_L = bytes(int(self._bms_data.req_discharge_amps*10))
-    Max_V_H, Max_V_L = bytes(int(self._bms_data.max_battery_voltage*10))
-    Min_V_H, Min_V_L = bytes(int(self._bms_data.min_battery_voltage*10))
+    #if no grid and Soc is low, we are in blackout with dead batteries and need to shut off inverters.
+    #also checked on every 0x307/0x304/0x305 frame, this catches SoC changes
+    self._safety.soc = soc
+    self._check_safety(time.time())
 
+    # only 0x351 and 0x355 carry live values, they are re-packed in place when an input changed
+    changed = set()
+    if (self._request_charge_current(charge_current, from_tick=True)):
+      changed.add(CAN_tx_msg["BatChg"])
+    if (self._bms_frames.update_soc(self._bms_data.state_of_charge)):
+      changed.add(CAN_tx_msg["BatSoC"])
 
-    msg = can.Message(arbitration_id = CAN_tx_msg["BatChg"], 
-      data=[Max_V_L, Max_V_H, Req_Charge_L, Req_Charge_H, Req_Discharge_L, Req_Discharge_H, Min_V_L, Min_V_H],
-      is_extended_id=False)
-
-    msg2 = can.Message(arbitration_id = CAN_tx_msg["BatSoC"],
-      data=[int(self._bms_data.state_of_charge), 0x00, 0x64, 0x0, SoC_HD_L, SoC_HD_H],
-      is_extended_id=False)
+    #logger.debug(self._can_bus)
 
-    msg3 = can.Message(arbitration_id = CAN_tx_msg["BatVoltageCurrent"],
-      data=[0x00, 0x00, 0x00, 0x0, 0xf0, 0x00],
-      is_extended_id=False)
+    bms_msgs = self._bms_frames.frames
+    if (self._bms_tx_mode == "kernel" and self._tx.periodic_failed):
+      logger.error("Kernel cyclic BMS transmit not available, sending from the mainloop")
+      self._bms_tx_mode = "mainloop"
 
-    msg4 = can.Message(arbitration_id = CAN_tx_msg["AlarmWarning"],
-      data=[0x00, 0x00, 0x00, 0x0, 0x00, 0x00, 0x00, 0x00],
-      is_extended_id=False)
+    if (self._bms_tx_mode == "kernel"):
+      # the kernel repeats the frames on its own, keep-alive no longer depends on this timer
+      if (self._tx.is_periodic()):
+        self._tx.update_periodic(bms_msgs, changed)
+      else:
+        self._tx.start_periodic(bms_msgs, 2.0, self._keepalive_hold)
+    else:
+      # first frame goes out now, the rest follow tx_spacing_ms apart from the mainloop
+      self._tx.send_spaced(bms_msgs)
+      self._chg_sent_amps = charge_current
+      self._chg_sent_time = timer()
 
-    msg5 = can.Message(arbitration_id = CAN_tx_msg["BMSOem"],
-      data=[0x42, 0x41, 0x54, 0x52, 0x49, 0x55, 0x4d, 0x20],
-      is_extended_id=False)
+    #logger.info("Sent to SI: {0}, {1}, {2}, {3}, {4}". \
+    #  format(self._bms_data.req_discharge_amps, self._bms_data.state_of_charge, \
+    #  self._bms_data.actual_battery_voltage, self._bms_data.battery_current, \
+    #  self._bms_data.pv_current))
 
-    msg6 = can.Message(arbitration_id = CAN_tx_msg["BatData"],
-      data=[0x03, 0x04, 0x0a, 0x04, 0x76, 0x02, 0x00, 0x00],
-      is_extended_id=False)
+    return True  # keep timer running
 
-    #logger.debug(self._can_bus)
+#----
+  # charge controller step on a 0x305 frame, using the SunnyIsland DC voltage/current
+  # and the real time (timer()) since the previous step
+  def _run_charge_control(self, now):
+    # like the tick: without system values no BMS frames, so no 0x351 either
+    if (not self._have_system_values()):
+      self._control_time = None
+      return
+    dt = None
+    if (self._control_time is not None):
+      dt = now - self._control_time
+    self._control_time = now
+
+    if (self.bms_controller.update_battery_data(sma_battery["Voltage"], -(sma_battery["Current"]), dt)):
+      self._journal_state_change()
+    self._bms_data.charging_state = self.bms_controller.get_state()
+    self._request_charge_current(self.bms_controller.get_charge_current())
 
-    try :
-      self._can_bus.send(msg)
-      #logger.debug("Message sent on {}".format(self._can_bus.channel_info))
-      time.sleep(.100)
+#----
+  # Re-packs 0x351 with a new requested charge current. A change of at least the
+  # deadband from the last 0x351 on the wire is sent at once (no more often than
+  # the min interval) instead of waiting for the next 2 s tick. Returns True if
+  # the payload changed.
+  def _request_charge_current(self, charge_current, from_tick=False):
+    changed = self._bms_frames.update_charge(self._bms_data.max_battery_voltage, charge_current, \
+      self._bms_data.req_discharge_amps, self._bms_data.min_battery_voltage)
+
+    kernel_tx = self._bms_tx_mode == "kernel" and self._tx.is_periodic()
+    if (changed and kernel_tx and not from_tick):
+      self._tx.update_periodic([self._bms_frames.bat_chg], set([CAN_tx_msg["BatChg"]]))
+
+    # on the tick in mainloop mode the batch sends 0x351 first anyway
+    self._chg_request = charge_current
+    if (self._fast_chg and (kernel_tx or not from_tick)):
+      self._send_charge_current()
+
+    return changed
+
+  # Sends the requested amps on the fast path when they are off by the deadband
+  # from what went on the wire. Within the min interval of the last send a timer
+  # is armed, it sends whatever is requested by then.
+  def _send_charge_current(self):
+    if (not self._have_system_values()):
+      return
+    charge_current = self._chg_request
+    if (self._chg_sent_amps is not None and abs(charge_current - self._chg_sent_amps) < self._fast_chg_deadband):
+      return
+    now = timer()
+    wait = self._chg_sent_time + self._fast_chg_interval - now
+    if (wait > 0):
+      if (self._chg_timer is None):
+        self._chg_timer = gobject.timeout_add(int(wait * 1000) + 1, exit_on_error, self._charge_current_timeout)
+      return
+    if (self._tx.send_now(self._bms_frames.bat_chg)):
+      self._chg_sent_amps = charge_current
+      self._chg_sent_time = now
+
+  def _charge_current_timeout(self):
+    self._chg_timer = None
+    self._send_charge_current()
+    return False
 
-      self._can_bus.send(msg2)
-      #logger.debug("Message sent on {}".format(self._can_bus.channel_info))
-      time.sleep(.100)
+#----
+  # the tick sends BMS frames only with these, the fast paths check the same
+  def _have_system_values(self):
+    return self._system.get('com.victronenergy.system', '/Dc/Battery/Soc') is not None and \
+      self._system.get('com.victronenergy.system', '/Dc/Battery/Voltage') is not None
 
-      self._can_bus.send(msg3)
-      #logger.debug("Message sent on {}".format(self._can_bus.channel_info))
+#----
+  # config_file: yaml to use instead of the dbus-sma.yaml next to the driver
+  def get_config_data(self, config_file=None):
+    return read_config(config_file)
+
+# The dbus side of a split driver (role dbus). Owns the VeDbusService,
+# monitor and settings; the paths and values come from the can process,
+# monitored values and client writes go back to it. Either process can
+# restart, the other one sends its full state when it sees the hello.
+class DbusBridge:
+
+  def __init__(self, cfg):
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop
+    from settingsdevice import SettingsDevice
+    DBusGMainLoop(set_as_default=True)
+    SettingsDevice(bus=dbus.SystemBus(), supportedSettings=SUPPORTED_SETTINGS, eventCallback=None)
 
-      time.sleep(.100)
+    self._link = create_link(cfg, "dbus", self._link_message, self._link_state)
+    self._dbusservice = create_dbus_service(connected=0)
+    self._paths = set()
+    self._dbusmonitor = create_dbus_monitor(cfg, DBUS_TREE, valueChangedCallback=self._dbus_value_changed)
 
-      self._can_bus.send(msg4)
-      #logger.debug("Message sent on {}".format(self._can_bus.channel_info))
+    self._link.send({"type": "hello"})
+    self._send_monitor_snapshot()
 
-      time.sleep(.100)
+#----
+  def __del__(self):
+    if (getattr(self, '_link', None)):
+      self._link.close()
+      self._link = None
 
-      self._can_bus.send(msg5)
-      #logger.debug("Message sent on {}".format(self._can_bus.channel_info))
+#----
+  def run(self):
+    logger.info("Starting mainloop, dbus side of the driver")
+    self._mainloop = gobject.MainLoop()
 
-      time.sleep(.100)
+    try:
+      self._mainloop.run()
+    except KeyboardInterrupt:
+      self._mainloop.quit()
 
-      self._can_bus.send(msg6)
-      #logger.debug("Message sent on {}".format(self._can_bus.channel_info))
+#----
+  def _dbus_value_changed(self, dbusServiceName, dbusPath, dict, changes, deviceInstance):
+    self._link.send({"type": "monitor", "values": [[dbusServiceName, dbusPath, changes['Value']]]})
 
-      #logger.info("Sent to SI: {0}, {1}, {2}, {3}, {4}". \
-      #  format(self._bms_data.req_discharge_amps, self._bms_data.state_of_charge, \
-      #  self._bms_data.actual_battery_voltage, self._bms_data.battery_current, \
-      #  self._bms_data.pv_current))
+#----
+  def _send_monitor_snapshot(self):
+    values = []
+    for service, paths in DBUS_TREE.items():
+      for path in paths:
+        values.append([service, path, self._dbusmonitor.get_value(service, path)])
+    self._link.send_batched("monitor", "values", values)
 
-      #logger.info("Sent 6 messages on {}".format(self._can_bus.channel_info))
-    except (can.CanError) as e:
-      logger.error("CAN BUS Transmit error (is controller missing?): %s" % e.message)
-    except KeyboardInterrupt:
-      pass
+#----
+  def _link_message(self, msg):
+    msg_type = msg.get("type")
+    if (msg_type == "hello"):
+      # the can process (re)started
+      self._send_monitor_snapshot()
+    elif (msg_type == "add"):
+      for path, value, writeable in msg["paths"]:
+        if (path in self._paths):
+          self._dbusservice[path] = value
+        else:
+          self._dbusservice.add_path(path, value, writeable=writeable, \
+            onchangecallback=self._handle_client_write if writeable else None)
+          self._paths.add(path)
+    elif (msg_type == "set"):
+      for path, value in msg["values"]:
+        if (path in self._paths):
+          self._dbusservice[path] = value
 
-    return True  # keep timer running
+#----
+  # writes from other dbus clients are applied by the can process
+  def _handle_client_write(self, path, value):
+    self._link.send({"type": "write", "path": path, "value": value})
+    return True
 
 #----
-  def get_config_data(self):
-    try :
-      dir_path = os.path.dirname(os.path.realpath(__file__))
-      with open(dir_path + "/dbus-sma.yaml", "r") as yamlfile:
-        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
-        return config
-    except :
-      logger.info("dbus-sma.yaml file not found or correct.")
-      sys.exit()
+  def _link_state(self, up):
+    self._dbusservice['/Connected'] = int(up)
+    if (not up):
+      logger.warning("can process not responding, /Connected cleared")
+
+def create_dbus_service(connected=1):
+  from vedbus import VeDbusService
+  dbusservice = VeDbusService(driver['connection'])
+  dbusservice.add_mandatory_paths(
+    processname=__file__,
+    processversion=softwareVersion,
+    connection=driver['connection'],
+    deviceinstance=driver['instance'],
+    productid=driver['id'],
+    productname=driver['name'],
+    firmwareversion=driver['version'],
+    hardwareversion=driver['version'],
+    connected=connected)
+  return dbusservice
+
+# system: only the DBUS_TREE paths are subscribed, velib: the full DbusMonitor scan
+def create_dbus_monitor(cfg, *args, **kwargs):
+  if (cfg.get('Dbus', {}).get('monitor', 'system') == 'velib'):
+    from dbusmonitor import DbusMonitor
+    return DbusMonitor(*args, **kwargs)
+  from system_monitor import SystemMonitor
+  return SystemMonitor(*args, **kwargs)
+
+# the link between the can and dbus processes, each binds its own socket
+def create_link(cfg, role, handler, on_state):
+  from ipc_link import IpcLink
+  _cfg_process = cfg.get('Process', {})
+  socket_dir = _cfg_process.get('socket_dir', '/var/run/dbus-sma')
+  paths = {"can": os.path.join(socket_dir, "can.sock"), "dbus": os.path.join(socket_dir, "dbus.sock")}
+  peer = "dbus" if role == "can" else "can"
+  return IpcLink(paths[role], paths[peer], handler, \
+    lambda fd, callback: gobject.io_add_watch(fd, gobject.IO_IN, callback), gobject.timeout_add, \
+    heartbeat_s=_cfg_process.get('heartbeat_s', 1.0), timeout_s=_cfg_process.get('link_timeout_s', 5.0), \
+    on_state=on_state)
+
+# config_file: yaml to use instead of the dbus-sma.yaml next to the driver
+def read_config(config_file=None):
+  if (config_file is None):
+    config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "dbus-sma.yaml")
+  try :
+    with open(config_file, "r") as yamlfile:
+      config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+      return config
+  except :
+    logger.info("{0} file not found or correct.".format(config_file))
+    sys.exit()
 
 if __name__ == "__main__":
+  import argparse
+
   # Argument parsing
   parser = argparse.ArgumentParser(description='Converts readings from AC-Sensors connected to a VE.Bus device in a pvinverter ' + 'D-Bus service.')
   parser.add_argument('-s', '--serial', help='tty')
   parser.add_argument("-d", "--debug", help="set logging level to debug",action="store_true")
+  parser.add_argument('-c', '--config', help='yaml config file (default: dbus-sma.yaml next to the driver)')
+  parser.add_argument('-r', '--role', choices=ROLES, help='process role (default: Process role in the config)')
+  parser.add_argument('--profile-startup', action='store_true', \
+    help='print import and startup phase timing once the driver is up, then exit')
 
   args = parser.parse_args()
 
   print("-------- dbus_SMADriver, v" + softwareVersion + " is starting up --------")
   #logger = setup_logging(args.debug)
 
-  # create SMA Driver
-  smadriver = SmaDriver()
+  role = args.role or read_config(args.config).get('Process', {}).get('role', 'both')
+
+  # create SMA Driver, or just its dbus side
+  if (role == "dbus"):
+    smadriver = DbusBridge(read_config(args.config))
+  else:
+    smadriver = SmaDriver(config_file=args.config, role=role)
+
+  if (args.profile_startup and role != "dbus"):
+    smadriver.run(until_started=True)
+    print(_import_timer.report())
+    print("startup phases: {0}".format(smadriver.startup_report()))
+    smadriver.__del__()
+    sys.exit(0)
 
   # run driver (starts mainloop and hangs until CTRL+C/SIGINT received)
   smadriver.run()
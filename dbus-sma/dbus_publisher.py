@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""dbus_publisher.py: Change tracking, rate limited writer in front of a
+                VeDbusService. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import logging
+import time
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+# Collects dbus path writes and pushes only the values that changed, at most
+# once per interval. Every VeDbusService write can emit a PropertiesChanged
+# signal, which systemcalc and the gui on the same device have to process.
+class DbusPublisher(object):
+  def __init__(self, dbusservice, interval_ms, timeout_add, flush_time=None, latency=None):
+    """timeout_add: gobject.timeout_add (or compatible), used to schedule
+       the flush. interval_ms of 0 writes through immediately.
+       dbusservice may be None until attach(), values are held until then.
+       flush_time, latency: optional diagnostics histograms, time spent in
+       flush and time from the CAN frame (note_source_time) to dbus."""
+    self._flush_time = flush_time
+    self._latency = latency
+    self._frame_time = None
+    self._source_time = None
+    self._dbusservice = dbusservice
+    self._interval_ms = interval_ms
+    self._timeout_add = timeout_add
+    self._published = {}
+    self._pending = {}
+    self._flush_scheduled = False
+
+  def __setitem__(self, path, value):
+    if (path in self._published and self._published[path] == value):
+      # back to what is already on dbus
+      self._pending.pop(path, None)
+      return
+
+    self._pending[path] = value
+    if (self._source_time is None):
+      self._source_time = self._frame_time
+    if (self._interval_ms <= 0):
+      self.flush()
+    elif (not self._flush_scheduled):
+      self._flush_scheduled = True
+      self._timeout_add(self._interval_ms, self._flush_timer)
+
+  def __getitem__(self, path):
+    """Latest value, including one that is not flushed yet. KeyError for a
+       path that was never set while there is no service (before attach())"""
+    if (path in self._pending):
+      return self._pending[path]
+    if (path in self._published):
+      return self._published[path]
+    if (self._dbusservice is None):
+      raise KeyError(path)
+    return self._dbusservice[path]
+
+  def attach(self, dbusservice):
+    """Sets the service of a publisher created without one, the values set
+       so far are written on the next flush"""
+    self._dbusservice = dbusservice
+    if (self._pending and not self._flush_scheduled):
+      self._flush_scheduled = True
+      self._timeout_add(max(self._interval_ms, 0), self._flush_timer)
+
+  def note_source_time(self, timestamp):
+    """Receive time of the frame behind the values set next. The oldest
+       frame that changed a value gives the receive to publish latency."""
+    self._frame_time = timestamp
+
+  def flush(self):
+    """Writes all pending values, returns the number of paths written"""
+    if (self._dbusservice is None):
+      return 0 # kept until attach()
+    start = timer()
+    count = len(self._pending)
+    for path, value in self._pending.items():
+      self._dbusservice[path] = value
+      self._published[path] = value
+    self._pending.clear()
+
+    if (self._flush_time is not None and count):
+      self._flush_time.record(timer() - start)
+    if (self._source_time is not None):
+      if (self._latency is not None and count):
+        self._latency.record(max(time.time() - self._source_time, 0.0))
+      self._source_time = None
+    return count
+
+  def _flush_timer(self):
+    self._flush_scheduled = False
+    try:
+      self.flush()
+    except Exception as e:
+      logger.error("dbus publish failed: {0}".format(e))
+    return False # one shot, rescheduled by the next change
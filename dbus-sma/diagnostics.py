@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""diagnostics.py: Low overhead latency histograms for the mainloop handlers. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import logging
+import os
+from bisect import bisect_right
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+# Fixed log2 buckets, 50 usec up to ~1.6 sec, the last bucket takes the rest.
+# The buckets are allocated once, a sample is one bisect and a few adds.
+class LatencyHistogram(object):
+  __slots__ = ("name", "buckets", "count", "total", "max", "_bounds")
+
+  def __init__(self, name, base=0.00005, nbuckets=16):
+    self.name = name
+    self._bounds = tuple(base * 2 ** i for i in range(nbuckets - 1))
+    self.buckets = [0] * nbuckets
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def record(self, seconds):
+    self.buckets[bisect_right(self._bounds, seconds)] += 1
+    self.count += 1
+    self.total += seconds
+    if (seconds > self.max):
+      self.max = seconds
+
+  def percentile(self, fraction):
+    """Upper bound (seconds) of the bucket holding the given fraction of samples"""
+    if (self.count == 0):
+      return 0.0
+    wanted = fraction * self.count
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if (seen >= wanted):
+        return min(self._bounds[i], self.max) if i < len(self._bounds) else self.max
+    return self.max
+
+  def mean(self):
+    return self.total / self.count if self.count else 0.0
+
+  def summary_ms(self):
+    return {"Count": self.count, "MeanMs": round(self.mean() * 1000, 2), \
+      "P50Ms": round(self.percentile(0.5) * 1000, 2), "P99Ms": round(self.percentile(0.99) * 1000, 2), \
+      "MaxMs": round(self.max * 1000, 2)}
+
+  def __str__(self):
+    s = self.summary_ms()
+    return "{0}: n={1} mean={2}ms p50<={3}ms p99<={4}ms max={5}ms buckets={6}".format(self.name, \
+      s["Count"], s["MeanMs"], s["P50Ms"], s["P99Ms"], s["MaxMs"], self.buckets)
+
+# Wraps a mainloop callback: execution time, and for timers how late the
+# mainloop fired it compared to its interval (mainloop lag).
+class HandlerProbe(object):
+  def __init__(self, name, func, interval_ms=None):
+    self.name = name
+    self._func = func
+    self._interval = interval_ms / 1000.0 if interval_ms else None
+    self._last_start = None
+    self.exec_time = LatencyHistogram(name)
+    self.lateness = LatencyHistogram(name + "Lag") if interval_ms else None
+
+  def __call__(self, *args):
+    start = timer()
+    if (self._interval is not None):
+      if (self._last_start is not None):
+        late = start - self._last_start - self._interval
+        self.lateness.record(late if late > 0 else 0.0)
+      self._last_start = start
+    try:
+      return self._func(*args)
+    finally:
+      self.exec_time.record(timer() - start)
+
+  def histograms(self):
+    if (self.lateness is None):
+      return (self.exec_time,)
+    return (self.exec_time, self.lateness)
+
+class Diagnostics(object):
+  def __init__(self):
+    self.probes = []
+    self.histograms = []
+
+  def probe(self, name, func, interval_ms=None):
+    probe = HandlerProbe(name, func, interval_ms)
+    self.probes.append(probe)
+    self.histograms.extend(probe.histograms())
+    return probe
+
+  def histogram(self, name):
+    histogram = LatencyHistogram(name)
+    self.histograms.append(histogram)
+    return histogram
+
+  def paths(self):
+    """(dbus path, value) for every summary value, under /Diagnostics/<name>/"""
+    for histogram in self.histograms:
+      for key, value in sorted(histogram.summary_ms().items()):
+        yield "/Diagnostics/{0}/{1}".format(histogram.name, key), value
+
+  def dump(self):
+    for histogram in self.histograms:
+      logger.info(str(histogram))
+
+def process_age():
+  """Seconds since the process started (interpreter and imports included),
+     None where there is no /proc. Resolution is one clock tick (10 msec)."""
+  try:
+    with open("/proc/self/stat", "r") as stat:
+      # the command name may hold spaces, the fields after it do not
+      start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+    with open("/proc/uptime", "r") as uptime:
+      now = float(uptime.read().split()[0])
+    return max(now - start_ticks / float(os.sysconf("SC_CLK_TCK")), 0.0)
+  except (IOError, OSError, ValueError, IndexError):
+    return None
+
+# Wall time of the named startup phases, each mark() closes the phase that
+# started at the previous mark.
+class PhaseTimer(object):
+  def __init__(self, clock=timer):
+    self._clock = clock
+    self._start = clock()
+    self._last = self._start
+    self._offset = process_age()
+    self.phases = []
+
+  def mark(self, name):
+    now = self._clock()
+    self.phases.append((name, now - self._last))
+    self._last = now
+    return now - self._start
+
+  def since_process_start(self):
+    """Seconds from process start to now, or from the PhaseTimer if unknown"""
+    return (self._offset or 0.0) + self._clock() - self._start
+
+  def summary(self):
+    phases = ", ".join("{0} {1:.1f}ms".format(name, seconds * 1000) for name, seconds in self.phases)
+    if (self._offset is None):
+      return phases
+    return "python+imports {0:.0f}ms, {1}".format(self._offset * 1000, phases)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""energy.py: Energy counters integrated from the SunnyIsland power frames. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# W * s -> kWh
+KWH_PER_WATT_SECOND = 1.0 / 3600000.0
+
+# Trapezoidal integration of one power stream on the frame timestamps.
+class TrapezoidIntegrator(object):
+  __slots__ = ("max_gap_s", "_last_ts", "_last_power")
+
+  def __init__(self, max_gap_s):
+    self.max_gap_s = max_gap_s
+    self._last_ts = None
+    self._last_power = 0.0
+
+  def add(self, power, timestamp):
+    """Returns the kWh between the previous sample and this one. A gap longer
+       than max_gap_s (or time going backwards) restarts the integration."""
+    energy = 0.0
+    if (self._last_ts is not None):
+      dt = timestamp - self._last_ts
+      if (dt > 0 and dt <= self.max_gap_s):
+        energy = 0.5 * (self._last_power + power) * dt * KWH_PER_WATT_SECOND
+    self._last_ts = timestamp
+    self._last_power = power
+    return energy
+
+# The SunnyIsland reports no energy, only power. Counters follow the vebus
+# /Energy/* layout: while the battery is charging the output is fed from the
+# grid, otherwise from the battery.
+class EnergyCounters(object):
+  def __init__(self, max_gap_s=30.0):
+    self.grid_to_dc = 0.0
+    self.grid_to_acout = 0.0
+    self.dc_to_acout = 0.0
+
+    self._ac_out = TrapezoidIntegrator(max_gap_s)
+    self._dc = TrapezoidIntegrator(max_gap_s)
+    self._dc_power = 0.0
+
+  def add_ac_out(self, power, timestamp):
+    """AC output power (W), from the 0x308 load frame"""
+    energy = self._ac_out.add(power, timestamp)
+    if (self._dc_power > 0):
+      self.grid_to_acout += energy
+    else:
+      self.dc_to_acout += energy
+
+  def add_dc(self, power, timestamp):
+    """DC power (W), positive into the battery, from the 0x305 frame"""
+    self._dc_power = power
+    # only charging counts towards GridToDc
+    self.grid_to_dc += self._dc.add(max(power, 0.0), timestamp)
+
+  def restore(self, grid_to_dc, grid_to_acout, dc_to_acout):
+    """Continue from counters saved before a restart"""
+    self.grid_to_dc = grid_to_dc
+    self.grid_to_acout = grid_to_acout
+    self.dc_to_acout = dc_to_acout
+
+  def paths(self):
+    """dbus paths and values"""
+    return (
+      ("/Energy/GridToDc", self.grid_to_dc),
+      ("/Energy/GridToAcOut", self.grid_to_acout),
+      ("/Energy/DcToAcOut", self.dc_to_acout),
+      ("/Energy/AcIn1ToInverter", self.grid_to_dc),
+      ("/Energy/AcIn1ToAcOut", self.grid_to_acout),
+      ("/Energy/InverterToAcOut", self.dc_to_acout))
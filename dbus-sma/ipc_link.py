@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ipc_link.py: Unix datagram link between the CAN process and the dbus
+                process, when the driver runs split (Process role can/dbus). """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import errno
+import json
+import logging
+import os
+import socket
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+# entries per datagram, keeps every datagram well below the socket buffer
+BATCH_ENTRIES = 64
+MAX_DATAGRAM = 65536
+
+# One JSON object per datagram, {"type": ...}. Each side binds its own
+# socket and sends to the other's path, there is no connection to lose: a
+# peer that is down or restarting just makes the sends fail, which is
+# counted and otherwise ignored. The socket never blocks, a stalled peer
+# costs dropped messages, never a late BMS frame.
+#   hello: sent at start, the peer answers with its full state
+#   ping:  heartbeat, the peer is considered down after timeout_s of silence
+class IpcLink(object):
+  def __init__(self, local_path, peer_path, handler, add_watch, timeout_add, heartbeat_s=1.0, timeout_s=5.0, \
+      on_state=None):
+    """handler(msg): every message except ping
+       add_watch(fd, callback): mainloop readable watch, callback(fd, condition)
+       timeout_add: gobject.timeout_add (or compatible)
+       on_state(up): peer came up / went down"""
+    self.local_path = local_path
+    self.peer_path = peer_path
+    self._handler = handler
+    self._on_state = on_state
+    self._timeout_s = timeout_s
+    self.peer_up = False
+    self._last_rx = None
+    self.dropped = 0
+    self._closed = False
+
+    directory = os.path.dirname(local_path)
+    if (directory and not os.path.isdir(directory)):
+      os.makedirs(directory)
+    if (os.path.exists(local_path)):
+      os.unlink(local_path) # left over from a previous run
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self._sock.setblocking(False)
+    self._sock.bind(local_path)
+
+    add_watch(self._sock.fileno(), self._readable)
+    timeout_add(int(heartbeat_s * 1000), self._heartbeat)
+
+  def send(self, msg):
+    """Returns False if the message could not be delivered (peer down or behind)"""
+    try:
+      self._sock.sendto(json.dumps(msg, separators=(",", ":")).encode("utf-8"), self.peer_path)
+      return True
+    except socket.error as e:
+      if (e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN, errno.ENOBUFS)):
+        logger.error("IPC send to {0} failed: {1}".format(self.peer_path, e))
+      self.dropped += 1
+      return False
+
+  def send_batched(self, msg_type, key, entries):
+    """Sends entries (list) split over as many datagrams as needed"""
+    for i in range(0, len(entries), BATCH_ENTRIES):
+      self.send({"type": msg_type, key: entries[i:i + BATCH_ENTRIES]})
+
+  def close(self):
+    self._closed = True
+    self._sock.close()
+    try:
+      os.unlink(self.local_path)
+    except OSError:
+      pass
+
+  def _set_peer_up(self, up):
+    if (up != self.peer_up):
+      self.peer_up = up
+      logger.info("IPC peer {0} {1}".format(self.peer_path, "up" if up else "down"))
+      if (self._on_state is not None):
+        self._on_state(up)
+
+  def _readable(self, fd, condition):
+    if (self._closed):
+      return False
+    for i in range(BATCH_ENTRIES):
+      try:
+        data = self._sock.recv(MAX_DATAGRAM)
+      except socket.error as e:
+        if (e.errno != errno.EAGAIN):
+          logger.error("IPC receive failed: {0}".format(e))
+        break
+      try:
+        msg = json.loads(data.decode("utf-8"))
+      except ValueError:
+        logger.error("IPC: dropped a malformed message")
+        continue
+
+      self._last_rx = timer()
+      self._set_peer_up(True)
+      if (msg.get("type") != "ping"):
+        try:
+          self._handler(msg)
+        except Exception as e:
+          logger.error("IPC message {0} failed: {1}".format(msg.get("type"), e))
+    return True
+
+  def _heartbeat(self):
+    if (self._closed):
+      return False
+    self.send({"type": "ping"})
+    if (self.peer_up and timer() - self._last_rx > self._timeout_s):
+      self._set_peer_up(False)
+    return True
+
+# The VeDbusService calls SmaDriver makes, in the CAN process. Values are
+# kept here and forwarded to the dbus process, which owns the real service.
+class LinkService(object):
+  def __init__(self, link, timeout_add):
+    self._link = link
+    self._timeout_add = timeout_add
+    self._values = {}
+    self._writeable = {}
+    self._callbacks = {}
+    self._pending_add = []
+    self._pending_set = {}
+    self._send_scheduled = False
+
+  def add_mandatory_paths(self, *args, **kwargs):
+    pass # the dbus process registers them
+
+  def add_path(self, path, value, description="", writeable=False, onchangecallback=None, gettextcallback=None):
+    self._values[path] = value
+    self._writeable[path] = bool(writeable)
+    if (onchangecallback is not None):
+      self._callbacks[path] = onchangecallback
+    self._pending_add.append([path, value, bool(writeable)])
+    self._schedule_send()
+
+  def __contains__(self, path):
+    return path in self._values
+
+  def __getitem__(self, path):
+    return self._values[path]
+
+  def __setitem__(self, path, value):
+    self._values[path] = value
+    self._pending_set[path] = value
+    self._schedule_send()
+
+  def client_write(self, path, value):
+    """A dbus client wrote a writeable path in the dbus process"""
+    if (not self._writeable.get(path)):
+      return
+    callback = self._callbacks.get(path)
+    if (callback is None or callback(path, value)):
+      self._values[path] = value
+    else:
+      self[path] = self._values[path] # rejected, put the old value back
+
+  def send_snapshot(self):
+    """Every path and value, for a dbus process that just (re)started"""
+    self._pending_add = [[path, value, self._writeable[path]] for path, value in self._values.items()]
+    self._pending_set.clear()
+    self._schedule_send()
+
+  def _schedule_send(self):
+    # writes made in one mainloop callback (a publisher flush) go out together
+    if (not self._send_scheduled):
+      self._send_scheduled = True
+      self._timeout_add(0, self._send)
+
+  def _send(self):
+    self._send_scheduled = False
+    if (self._pending_add):
+      self._link.send_batched("add", "paths", self._pending_add)
+      self._pending_add = []
+    if (self._pending_set):
+      self._link.send_batched("set", "values", [[path, value] for path, value in self._pending_set.items()])
+      self._pending_set.clear()
+    return False
+
+# The DbusMonitor calls SmaDriver makes, in the CAN process. The dbus
+# process forwards every monitored value change.
+class LinkMonitor(object):
+  def __init__(self, dbusTree, valueChangedCallback=None, **kwargs):
+    self._callback = valueChangedCallback
+    self._values = {}
+
+  def get_value(self, serviceName, objectPath, default_value=None):
+    return self._values.get((serviceName, objectPath), default_value)
+
+  def update(self, values):
+    """[[service, path, value], ...] from the dbus process"""
+    for service, path, value in values:
+      self._values[(service, path)] = value
+      if (self._callback is not None):
+        self._callback(service, path, {}, {"Value": value, "Text": str(value)}, 0)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""sma_codec.py: Table driven decoder for the SunnyRemote CAN frames
+                broadcast by the SMA SunnyIsland. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import logging
+import struct
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# One field of a frame. All values are little endian.
+#   target: name of the state dict the value is written to (see FrameCodec targets)
+#   key:    key in that dict
+#   offset: byte offset in the frame payload
+#   fmt:    struct format char, 'h' signed 16 bit, 'H' unsigned 16 bit, 'B' byte
+#   scale:  raw * scale, a scale below 1 is applied as a float division (0.1 -> / 10.0)
+Field = namedtuple("Field", "target key offset fmt scale")
+
+# Field layouts from NOTES_recvd_sma_can_msgs. To decode a newly found frame,
+# add it here (and its id to the driver's CANFrames so it passes the filter).
+SUNNY_REMOTE_FRAMES = {
+  # total external grid power, 0.1 kW
+  0x300: ("ExtPwr", (
+    Field("line1", "ExtPwr", 0, "h", 100),
+    Field("line2", "ExtPwr", 2, "h", 100))),
+  # total inverter power, 0.1 kW
+  0x301: ("InvPwr", (
+    Field("line1", "InvPwr", 0, "h", 100),
+    Field("line2", "InvPwr", 2, "h", 100))),
+  # output voltage 0.1 V master/slave, output frequency 0.01 Hz
+  0x304: ("OutputVoltage", (
+    Field("line1", "OutputVoltage", 0, "h", 0.1),
+    Field("line2", "OutputVoltage", 2, "h", 0.1),
+    Field("line1", "OutputFreq", 6, "H", 0.01))),
+  # DC voltage 0.1 V, DC current combined system 0.1 A
+  0x305: ("Battery", (
+    Field("battery", "Voltage", 0, "H", 0.1),
+    Field("battery", "Current", 2, "h", 0.1))),
+  # content unknown
+  0x306: ("Relay", ()),
+  # byte 2, bit 7: AC2 relay closed, bit 6: valid voltage on AC2
+  0x307: ("Bits", (
+    Field("system", "ExtFlags", 2, "B", 1),)),
+  # (guess) total load power, 0.1 kW
+  0x308: ("LoadPwr", (
+    Field("system", "Load", 0, "h", 100),)),
+  # input voltage 0.1 V master/slave, grid frequency 0.01 Hz
+  0x309: ("ExtVoltage", (
+    Field("line1", "ExtVoltage", 0, "h", 0.1),
+    Field("line2", "ExtVoltage", 2, "h", 0.1),
+    Field("line1", "ExtFreq", 6, "H", 0.01))),
+}
+
+# raw value range per struct format char, encode() clamps to it
+FMT_RANGE = {"h": (-0x8000, 0x7FFF), "H": (0, 0xFFFF), "B": (0, 0xFF), "b": (-0x80, 0x7F)}
+
+# SunnyRemote frames are always 8 bytes
+FRAME_LENGTH = 8
+
+def compile_frame(fields):
+  """Builds the struct unpacker for a frame, gaps become pad bytes"""
+  fmt = "<"
+  pos = 0
+  for field in sorted(fields, key=lambda f: f.offset):
+    if (field.offset < pos):
+      raise ValueError("overlapping field {0} at offset {1}".format(field.key, field.offset))
+    fmt += "x" * (field.offset - pos) + field.fmt
+    pos = field.offset + struct.calcsize("<" + field.fmt)
+  return struct.Struct(fmt), sorted(fields, key=lambda f: f.offset)
+
+class FrameCodec(object):
+  """Decodes frames straight into the state dicts given as targets,
+     e.g. {"line1": sma_line1, "battery": sma_battery}"""
+
+  def __init__(self, targets, frames=SUNNY_REMOTE_FRAMES):
+    self._decoders = {}
+    self._encoders = {}
+    for can_id, (name, fields) in frames.items():
+      unpacker, ordered = compile_frame(fields)
+      setters = []
+      for field in ordered:
+        if (field.scale < 1):
+          setters.append((targets[field.target], field.key, None, float(round(1.0 / field.scale))))
+        else:
+          setters.append((targets[field.target], field.key, field.scale, None))
+      self._decoders[can_id] = (name, unpacker, tuple(setters))
+      self._encoders[can_id] = (unpacker, tuple(setters), tuple(FMT_RANGE[field.fmt] for field in ordered))
+
+  def __contains__(self, can_id):
+    return can_id in self._decoders
+
+  def decode(self, can_id, data):
+    """Decodes one frame, returns the frame name or None if the id is unknown
+       or the payload is too short"""
+    decoder = self._decoders.get(can_id)
+    if (decoder is None):
+      return None
+
+    name, unpacker, setters = decoder
+    try:
+      values = unpacker.unpack_from(data)
+    except struct.error:
+      logger.debug("Short frame 0x{0:x}, {1} bytes".format(can_id, len(data)))
+      return None
+
+    for (target, key, mul, div), raw in zip(setters, values):
+      if (div is None):
+        target[key] = raw * mul
+      else:
+        target[key] = raw / div
+    return name
+
+  def encode(self, can_id):
+    """Packs the current target values into a frame payload, the inverse of
+       decode (the inverter side, used by the cluster simulator)"""
+    unpacker, setters, ranges = self._encoders[can_id]
+    raws = []
+    for (target, key, mul, div), (low, high) in zip(setters, ranges):
+      raw = int(round(target[key] / mul if div is None else target[key] * div))
+      raws.append(min(max(raw, low), high))
+    data = bytearray(max(FRAME_LENGTH, unpacker.size))
+    unpacker.pack_into(data, 0, *raws)
+    return data
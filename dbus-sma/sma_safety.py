@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""sma_safety.py: Grid loss latch and low SoC inverter shutdown, evaluated
+                as the SunnyIsland frames arrive. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import logging
+import time
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+# grid states, same values as sma_system["ExtOk"] and /Alarms/GridLost
+GRID_OK = 0
+GRID_DOWN_PENDING = 1
+GRID_LOST = 2
+
+class SafetyMonitor(object):
+  def __init__(self, min_soc_inv_off, grid_loss_debounce_s=0.5, cmd_resend_s=2.0, clock=timer):
+    """clock: monotonic time source for the debounce and the command resend.
+       The CAN frame timestamps are wall clock and step with NTP, they are
+       only used for the reaction time."""
+    self.min_soc_inv_off = min_soc_inv_off
+    self.grid_loss_debounce_s = grid_loss_debounce_s
+    self.cmd_resend_s = cmd_resend_s
+    self._clock = clock
+
+    self.ext_ok = GRID_OK
+    self.soc = None
+    self.safety_off = False   # inverters shut off due to low battery
+
+    self._grid_down_since = None
+    self._pending_cmd = None
+    self._last_cmd_time = 0.0
+
+    # reaction time, frame timestamp to command on the wire (seconds)
+    self.last_reaction = None
+    self.max_reaction = 0.0
+    self.reaction_count = 0
+
+  def update_grid(self, grid_ok):
+    """Latches grid loss once the SunnyIsland reports AC2 invalid for longer than
+       the debounce, it always reports one invalid frame during relay transfer.
+       Call as the frame is received. Returns True when the latched state changed."""
+    now = self._clock()
+    old = self.ext_ok
+    if (grid_ok):
+      self._grid_down_since = None
+      self.ext_ok = GRID_OK
+    else:
+      if (self._grid_down_since is None):
+        self._grid_down_since = now
+      if (now - self._grid_down_since >= self.grid_loss_debounce_s):
+        self.ext_ok = GRID_LOST
+      elif (self.ext_ok != GRID_LOST):
+        self.ext_ok = GRID_DOWN_PENDING
+    return self.ext_ok != old
+
+  def evaluate(self, inverter_state, timestamp):
+    """Returns the command to send: "off", "on" or None. inverter_state is the
+       derived /State, 0 when the inverters are off. timestamp: wall clock time
+       of the frame that caused the check."""
+    if (self.soc is None):
+      return None
+
+    cmd = None
+    if (not self.safety_off):
+      # no grid and low SoC, blackout with dead batteries: shut off inverters till they respond
+      if (self.ext_ok == GRID_LOST and self.soc < self.min_soc_inv_off):
+        cmd = "off"
+        if (inverter_state == 0):
+          self.safety_off = True
+    else:
+      # grid restored or SoC increased: turn inverters back on till they respond
+      if (self.ext_ok == GRID_OK or self.soc >= self.min_soc_inv_off):
+        cmd = "on"
+        if (inverter_state != 0):
+          self.safety_off = False
+
+    if (cmd is None):
+      self._pending_cmd = None
+      return None
+
+    now = self._clock()
+    if (cmd != self._pending_cmd):
+      # new condition, act right away and measure the time from the frame that caused it
+      self._pending_cmd = cmd
+      self.last_reaction = max(time.time() - timestamp, 0.0)
+      self.max_reaction = max(self.max_reaction, self.last_reaction)
+      self.reaction_count += 1
+    elif (now - self._last_cmd_time < self.cmd_resend_s):
+      return None
+
+    self._last_cmd_time = now
+    return cmd
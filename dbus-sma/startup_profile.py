@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""startup_profile.py: Import timing for dbus-sma.py --profile-startup. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import sys
+from timeit import default_timer as timer
+
+try:
+  import __builtin__ as builtins  # Python 2.x
+except ImportError:
+  import builtins  # Python 3.x
+
+# Wraps __import__ and times every import statement while installed. An
+# import's time includes the modules it pulls in, nested imports are kept
+# with their depth so the report can show the top level ones. Modules that
+# are already loaded cost a dict lookup and are not recorded.
+class ImportTimer(object):
+  def __init__(self):
+    self.imports = []
+    self._depth = 0
+    self._original = None
+    self._start = None
+    self.total = 0.0
+
+  def install(self):
+    self._original = builtins.__import__
+    self._start = timer()
+    builtins.__import__ = self._import
+
+  def uninstall(self):
+    if (self._original is not None):
+      builtins.__import__ = self._original
+      self._original = None
+      self.total = timer() - self._start
+
+  def _import(self, name, *args, **kwargs):
+    if (name in sys.modules):
+      return self._original(name, *args, **kwargs)
+    self._depth += 1
+    start = timer()
+    try:
+      return self._original(name, *args, **kwargs)
+    finally:
+      self._depth -= 1
+      self.imports.append((name, timer() - start, self._depth))
+
+  def top_level(self):
+    """(name, seconds) of the imports made directly by the profiled module, slowest first"""
+    return sorted(((name, seconds) for name, seconds, depth in self.imports if depth == 0), \
+      key=lambda item: item[1], reverse=True)
+
+  def report(self, limit=20):
+    lines = ["imports: {0:.1f}ms total".format(self.total * 1000)]
+    for name, seconds in self.top_level()[:limit]:
+      lines.append("  {0:<28} {1:8.1f}ms".format(name, seconds * 1000))
+    return "\n".join(lines)
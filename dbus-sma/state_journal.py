@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""state_journal.py: Append-only, crash safe journal for the state that has
+                to survive a driver restart (energy counters, charge state). """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import json
+import logging
+import os
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# One record per line: "<crc32 hex> <json>\n". The last line with a good
+# checksum wins, a record torn by a crash or power loss is skipped and the
+# next append starts on a new line after it. The file
+# is rewritten with only the latest record every compact_records appends, via
+# a temp file and rename so there is always one complete journal on disk.
+class StateJournal(object):
+  def __init__(self, path, compact_records=288):
+    self.path = path
+    self.compact_records = compact_records
+    self._records = 0
+    # the file ends in a torn record without its newline
+    self._torn_tail = False
+
+  def load(self):
+    """Returns the latest good record (dict), or None"""
+    latest = None
+    self._records = 0
+    self._torn_tail = False
+    try:
+      with open(self.path, "r") as journal:
+        for line in journal:
+          record = self._decode(line)
+          if (record is not None):
+            latest = record
+          self._records += 1
+          self._torn_tail = not line.endswith("\n")
+    except (IOError, OSError):
+      return None
+    if (self._torn_tail):
+      logger.warning("State journal {0} ends in a torn record, it is skipped".format(self.path))
+    return latest
+
+  def append(self, record):
+    """Writes and fsyncs one record, compacts the file when it got long"""
+    if (self._records + 1 >= self.compact_records):
+      self.compact(record)
+      return
+
+    line = self._encode(record)
+    if (self._torn_tail):
+      # not onto the torn record, that would tear this one too
+      line = "\n" + line
+      self._torn_tail = False
+    with open(self.path, "a") as journal:
+      journal.write(line)
+      journal.flush()
+      os.fsync(journal.fileno())
+    self._records += 1
+
+  def compact(self, record):
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, "w") as journal:
+      journal.write(self._encode(record))
+      journal.flush()
+      os.fsync(journal.fileno())
+    os.rename(tmp_path, self.path)
+    self._fsync_dir()
+    self._records = 1
+    self._torn_tail = False
+    logger.debug("Compacted state journal {0}".format(self.path))
+
+  def _fsync_dir(self):
+    try:
+      fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+    except (IOError, OSError) as e:
+      logger.debug("fsync of journal dir failed: {0}".format(e))
+
+  def _encode(self, record):
+    payload = json.dumps(record, sort_keys=True, separators=(",", ":"))
+    return "{0:08x} {1}\n".format(zlib.crc32(payload.encode("utf-8")) & 0xffffffff, payload)
+
+  def _decode(self, line):
+    if (not line.endswith("\n")):
+      return None # torn write
+    crc, sep, payload = line.rstrip("\n").partition(" ")
+    try:
+      if (int(crc, 16) != zlib.crc32(payload.encode("utf-8")) & 0xffffffff):
+        return None
+      return json.loads(payload)
+    except ValueError:
+      return None
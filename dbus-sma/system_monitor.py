@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""system_monitor.py: Watches just the dbus paths the driver reads, in place
+                of velib's DbusMonitor. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import logging
+import os
+
+import dbus
+
+from vedbus import unwrap_dbus_value
+
+logger = logging.getLogger(__name__)
+
+BUSITEM = 'com.victronenergy.BusItem'
+
+# DbusMonitor lists every name on the bus, introspects every service of a
+# monitored type and takes every PropertiesChanged signal on the bus. Here
+# each (service, path) of the tree gets its own match rule, so dbus-daemon
+# only wakes the driver for those paths. The value is read once when the
+# service appears and cleared when it goes away. An invalid value is always
+# passed on, it clears what the driver restored from its journal.
+#
+# Same interface as the DbusMonitor calls the driver makes: get_value() and
+# valueChangedCallback(service, path, options, changes, deviceInstance).
+class SystemMonitor(object):
+  def __init__(self, dbusTree, valueChangedCallback=None, bus=None):
+    # the same bus choice as DbusMonitor
+    if (bus is None):
+      bus = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+    self._bus = bus
+    self._tree = dbusTree
+    self._callback = valueChangedCallback
+    self._values = {}
+    # services seen on the bus, the ones that never were have nothing to clear
+    self._seen = set()
+
+    for service, paths in dbusTree.items():
+      for path in paths:
+        self._values[(service, path)] = None
+        self._bus.add_signal_receiver(self._make_handler(service, path), dbus_interface=BUSITEM, \
+          signal_name='PropertiesChanged', bus_name=service, path=path)
+      # called right away with the current owner, then on every change
+      self._bus.watch_name_owner(service, self._make_owner_handler(service))
+
+  def get_value(self, serviceName, objectPath, default_value=None):
+    value = self._values.get((serviceName, objectPath))
+    return default_value if value is None else value
+
+  def _make_handler(self, service, path):
+    def handler(changes):
+      if ('Value' in changes):
+        self._set(service, path, unwrap_dbus_value(changes['Value']), force=True)
+    return handler
+
+  def _make_owner_handler(self, service):
+    def handler(owner):
+      if (owner):
+        self._seen.add(service)
+        logger.info("{0} on dbus, reading {1} values".format(service, len(self._tree[service])))
+        for path in self._tree[service]:
+          try:
+            value = unwrap_dbus_value(self._bus.get_object(service, path, introspect=False) \
+              .GetValue(dbus_interface=BUSITEM))
+          except dbus.exceptions.DBusException as e:
+            logger.error("Reading {0}{1} failed: {2}".format(service, path, e))
+            value = None
+          self._set(service, path, value)
+      elif (service in self._seen):
+        logger.warning("{0} left dbus, its values are invalid".format(service))
+        for path in self._tree[service]:
+          self._set(service, path, None)
+    return handler
+
+  def _set(self, service, path, value, force=False):
+    if (value == self._values[(service, path)] and value is not None and not force):
+      return
+    self._values[(service, path)] = value
+    if (self._callback is not None):
+      self._callback(service, path, self._tree[service][path], {'Value': value, 'Text': str(value)}, None)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""value_cache.py: Local copy of the monitored dbus values, kept current by
+                the monitor's change callback. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+from timeit import default_timer as timer
+
+# One monitored value, already converted, and when it last changed.
+# restored: the value comes from the journal, not from the monitor
+class CachedValue(object):
+  __slots__ = ("value", "time", "restored")
+
+  def __init__(self):
+    self.value = None
+    self.time = None
+    self.restored = False
+
+# Values of the paths in a DbusMonitor tree, {service: {path: ...}}.
+# Numbers are stored as float (dbus.Double, dbus.Int32, ... converted once
+# per change instead of on every read), an invalid value is None. Reads are
+# dict lookups, nothing goes over dbus.
+class ValueCache(object):
+  def __init__(self, tree, clock=timer):
+    self._clock = clock
+    self._values = {}
+    for service, paths in tree.items():
+      for path in paths:
+        self._values[(service, path)] = CachedValue()
+
+  def prime(self, monitor):
+    """Initial values, the monitor only calls back on changes. A path the
+       monitor has no value for yet keeps the one it has (restored)."""
+    for service, path in self._values:
+      value = monitor.get_value(service, path)
+      if (value is not None):
+        self.update(service, path, value)
+
+  def update(self, service, path, value, age=0.0, restored=False):
+    """Returns False for paths that are not cached. age: seconds the value
+       is already old (restored from the journal)"""
+    entry = self._values.get((service, path))
+    if (entry is None):
+      return False
+    if (value is not None):
+      try:
+        value = float(value)
+      except (TypeError, ValueError):
+        value = None # empty dbus array and other invalid markers
+    entry.value = value
+    entry.time = self._clock() - age
+    entry.restored = restored
+    return True
+
+  def expire_restored(self, max_age):
+    """Invalidates restored values older than max_age seconds, returns how many"""
+    now = self._clock()
+    expired = 0
+    for entry in self._values.values():
+      if (entry.restored and now - entry.time > max_age):
+        entry.value = None
+        entry.time = now
+        entry.restored = False
+        expired += 1
+    return expired
+
+  def get(self, service, path, default=None):
+    value = self._values[(service, path)].value
+    return default if value is None else value
+
+  def age(self, service, path):
+    """Seconds since the value last changed, None before the first one"""
+    entry = self._values[(service, path)]
+    return None if entry.time is None else self._clock() - entry.time
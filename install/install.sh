@@ -40,7 +40,6 @@ then
     rm get-pip.py
 
     pip install python-can
-    pip install python-statemachine
     pip install pyyaml
   fi
 
@@ -98,6 +97,10 @@ then
 	chmod +x ${ROOT_DIR}/data/etc/${DBUS_NAME}/dbus-sma.py
 	chmod +x ${ROOT_DIR}/data/etc/${DBUS_NAME}/service/run
 	chmod +x ${ROOT_DIR}/data/etc/${DBUS_NAME}//service/log/run
+	# split driver (Process section of dbus-sma.yaml), link these two instead of service
+	mkdir -p ${ROOT_DIR}/var/log/${DBUS_NAME}-can ${ROOT_DIR}/var/log/${DBUS_NAME}-dbus
+	chmod +x ${ROOT_DIR}/data/etc/${DBUS_NAME}/service-can/run ${ROOT_DIR}/data/etc/${DBUS_NAME}/service-can/log/run
+	chmod +x ${ROOT_DIR}/data/etc/${DBUS_NAME}/service-dbus/run ${ROOT_DIR}/data/etc/${DBUS_NAME}/service-dbus/log/run
 	ln -s ${ROOT_DIR}/opt/victronenergy/vrmlogger/ext/ ${DBUS_SMA_DIR}/ext 
 	ln -s ${DBUS_SMA_DIR}/service ${ROOT_DIR}/service/${DBUS_NAME}
 
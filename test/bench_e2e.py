@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bench_e2e.py: End to end latency of the complete driver process, CAN
+                frame in to dbus signal out and SoC change to 0x355 on the
+                wire, on vcan and a private dbus-daemon. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# Needs dbus-python, GLib (gobject on python 2, PyGObject on 3), python-can,
+# a clone of velib_python and a vcan interface:
+#   sudo modprobe vcan
+#   sudo ip link add dev vcan0 type vcan && sudo ip link set vcan0 up
+#   git clone https://github.com/victronenergy/velib_python /tmp/velib_python
+#   python bench_e2e.py --velib /tmp/velib_python --loads 1,10,100 -o e2e.json
+#
+# The harness starts its own dbus-daemon and points both the system and the
+# session bus address at it, serves stand-ins for com.victronenergy.settings
+# and com.victronenergy.system on it, then starts dbus-sma.py with a copy of
+# dbus-sma.yaml pointed at the vcan interface.
+#
+# Frame to dbus: probe frames (0x309, line 1 grid voltage stepping through
+# 100.0..199.9 V) are timestamped as they are sent and matched against the
+# PropertiesChanged signal of /Ac/ActiveIn/L1/V. Probes that the publisher
+# coalesced with a later one are counted, not timed.
+# SoC to 0x355: /Dc/Battery/Soc on the system stand-in is toggled and timed
+# until the first 0x355 frame carrying the new SoC.
+# Each load step adds SunnyRemote and cluster sync frames at a multiple of
+# a normal cluster's rate, to find where the single mainloop saturates.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer as timer
+
+import can
+import yaml
+
+import dbus
+import dbus.bus
+import dbus.service
+from dbus.mainloop.glib import DBusGMainLoop
+try:
+  import gobject  # Python 2.x
+except ImportError:
+  from gi.repository import GLib as gobject  # Python 3.x
+
+import sma_fakes
+
+sys.path.insert(1, sma_fakes.DRIVER_DIR)
+from sma_codec import FrameCodec
+
+DRIVER_SERVICE = "com.victronenergy.vebus.smasunnyisland"
+PROBE_ID = 0x309
+PROBE_PATH = "/Ac/ActiveIn/L1/V"
+# SunnyRemote frames at 5 Hz per id plus sync chatter from a master and one slave
+BASE_REMOTE_HZ = 5.0
+BASE_SYNC_FPS = 40.0
+SYNC_IDS = (0x0A0, 0x0A1)
+
+# what a running split phase system reports, the background frames carry these
+STEADY_VALUES = {
+  "line1": {"ExtPwr": 1200, "InvPwr": -300, "OutputVoltage": 120.3, "OutputFreq": 60.0, "ExtVoltage": 120.0, "ExtFreq": 60.0},
+  "line2": {"ExtPwr": 1100, "InvPwr": -200, "OutputVoltage": 120.1, "ExtVoltage": 120.0},
+  "battery": {"Voltage": 53.2, "Current": -20.0},
+  "system": {"ExtFlags": 0xC0, "Load": 1800},
+}
+
+def percentile(values, fraction):
+  if (not values):
+    return None
+  ordered = sorted(values)
+  return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def summary_ms(values):
+  return {"count": len(values), "p50_ms": _ms(percentile(values, 0.5)), "p99_ms": _ms(percentile(values, 0.99)), \
+    "max_ms": _ms(max(values) if values else None)}
+
+def _ms(seconds):
+  return round(seconds * 1000, 2) if seconds is not None else None
+
+# -- dbus side, everything runs on the harness's own mainloop thread ---------
+
+class SettingsStub(dbus.service.Object):
+  """The part of localsettings velib's SettingsDevice uses: AddSetting on
+     /Settings, the settings themselves are VeDbusService items"""
+  def __init__(self, bus, dbusservice):
+    dbus.service.Object.__init__(self, bus, "/Settings")
+    self._dbusservice = dbusservice
+
+  @dbus.service.method("com.victronenergy.Settings", in_signature="ssvvv", out_signature="i")
+  def AddSetting(self, group, name, default, minimum, maximum):
+    path = "/Settings/" + (group + "/" if group else "") + name
+    try:
+      self._dbusservice[path]
+    except KeyError:
+      self._dbusservice.add_path(path, default, writeable=True)
+    return 0
+
+  @dbus.service.method("com.victronenergy.Settings", in_signature="ssvvv", out_signature="i")
+  def AddSilentSetting(self, group, name, default, minimum, maximum):
+    return self.AddSetting(group, name, default, minimum, maximum)
+
+class DbusSide(object):
+  def __init__(self, address):
+    from vedbus import VeDbusService
+    self.address = address
+    self.loop = gobject.MainLoop()
+    self._thread = threading.Thread(target=self.loop.run)
+    self._thread.daemon = True
+    self._thread.start()
+
+    def setup():
+      # one connection per service, each VeDbusService exports its own root object
+      self._settings_bus = dbus.bus.BusConnection(address)
+      self.settings = VeDbusService("com.victronenergy.settings", bus=self._settings_bus)
+      self._settings_stub = SettingsStub(self._settings_bus, self.settings)
+
+      self.system = VeDbusService("com.victronenergy.system", bus=dbus.bus.BusConnection(address))
+      self.system.add_path("/DeviceInstance", 0)
+      for path, value in (("/Dc/Battery/Soc", 50.0), ("/Dc/Battery/Voltage", 53.2), ("/Dc/Battery/Current", 20.0), \
+          ("/Dc/Pv/Current", 0.0), ("/Ac/PvOnOutput/L1/Power", 0), ("/Ac/PvOnOutput/L2/Power", 0)):
+        self.system.add_path(path, value, writeable=True)
+      self._watch_bus = dbus.bus.BusConnection(address)
+    self.call(setup)
+
+  def call(self, func, *args):
+    """Runs func on the mainloop thread and waits for its result"""
+    done = threading.Event()
+    result = []
+    def run():
+      try:
+        result.append((True, func(*args)))
+      except Exception as e:
+        result.append((False, e))
+      done.set()
+      return False
+    gobject.idle_add(run)
+    done.wait()
+    ok, value = result[0]
+    if (not ok):
+      raise value
+    return value
+
+  def has_name(self, name):
+    return self.call(lambda: name in self._watch_bus.list_names())
+
+  def watch(self, path, callback):
+    """callback(receive time, value) for every PropertiesChanged of a driver path"""
+    def handler(changes, path=None):
+      callback(timer(), changes.get("Value"))
+    self.call(lambda: self._watch_bus.add_signal_receiver(handler, signal_name="PropertiesChanged", \
+      dbus_interface="com.victronenergy.BusItem", bus_name=DRIVER_SERVICE, path=path, path_keyword="path"))
+
+  def set_system(self, path, value):
+    def set_value():
+      self.system[path] = value
+    self.call(set_value)
+
+  def stop(self):
+    self.loop.quit()
+
+# -- CAN side ---------------------------------------------------------------
+
+class LoadStep(object):
+  """One load level: background frames, probes and SoC toggles"""
+  def __init__(self, bus, dbus_side, load, probe_hz, soc_interval):
+    self.bus = bus
+    self.dbus_side = dbus_side
+    self.load = load
+    self.probe_hz = probe_hz
+    self.soc_interval = soc_interval
+
+    targets = dict((name, dict(values)) for name, values in STEADY_VALUES.items())
+    codec = FrameCodec(targets)
+    remote = [can.Message(arbitration_id=can_id, data=codec.encode(can_id), is_extended_id=False) \
+      for can_id in (0x300, 0x301, 0x304, 0x305, 0x306, 0x307, 0x308)]
+    sync = [can.Message(arbitration_id=can_id, data=bytearray(8), is_extended_id=False) for can_id in SYNC_IDS]
+    self._background = []
+    for i in range(int(round(BASE_SYNC_FPS / (BASE_REMOTE_HZ * len(remote))))):
+      self._background.extend(sync)
+    self._background.extend(remote)
+    self.background_fps = load * (BASE_REMOTE_HZ * len(remote) + BASE_SYNC_FPS)
+
+    self.probes = {}
+    self.latencies = []
+    self.coalesced = 0
+    self.soc_latencies = []
+    self.soc_timeouts = 0
+    self.sent = 0
+    self.tx_errors = 0
+    self._soc_pending = None
+    self._lock = threading.Lock()
+
+  def on_probe_signal(self, received, value):
+    if (value is None):
+      return
+    raw = int(round(float(value) * 10))
+    with self._lock:
+      sent = self.probes.pop(raw, None)
+      if (sent is None):
+        return
+      self.latencies.append(received - sent)
+      # anything older than the probe that just came through was coalesced
+      for key in [key for key, when in self.probes.items() if when < sent]:
+        del self.probes[key]
+        self.coalesced += 1
+
+  def on_frame(self, msg, received):
+    pending = self._soc_pending
+    if (pending is not None and msg.arbitration_id == 0x355 and len(msg.data) > 0 and msg.data[0] == pending[0]):
+      self.soc_latencies.append(received - pending[1])
+      self._soc_pending = None
+
+  def _send(self, msg):
+    try:
+      self.bus.send(msg)
+      self.sent += 1
+    except can.CanError:
+      self.tx_errors += 1
+
+  def run(self, duration):
+    seq = 0
+    start = timer()
+    next_probe = start
+    next_soc = start + 1.0
+    background_sent = 0
+    soc = 40
+    while (True):
+      now = timer()
+      if (now - start >= duration):
+        break
+
+      # background frames owed by now, in bursts
+      owed = int((now - start) * self.background_fps) - background_sent
+      for i in range(owed):
+        self._send(self._background[(background_sent + i) % len(self._background)])
+      background_sent += max(owed, 0)
+
+      if (now >= next_probe):
+        raw = 1000 + seq % 1000
+        seq += 1
+        targets = {"line1": dict(STEADY_VALUES["line1"], ExtVoltage=raw / 10.0), "line2": STEADY_VALUES["line2"], \
+          "battery": {}, "system": {}}
+        data = FrameCodec(targets).encode(PROBE_ID)
+        with self._lock:
+          self.probes[raw] = timer()
+        self._send(can.Message(arbitration_id=PROBE_ID, data=data, is_extended_id=False))
+        next_probe += 1.0 / self.probe_hz
+
+      if (now >= next_soc):
+        if (self._soc_pending is not None):
+          self.soc_timeouts += 1
+        soc = 41 if soc == 40 else 40
+        self.dbus_side.set_system("/Dc/Battery/Soc", float(soc))
+        self._soc_pending = (soc, timer())
+        next_soc += self.soc_interval
+
+      time.sleep(0.0005)
+
+    time.sleep(1.0) # let the last signals arrive
+    with self._lock:
+      self.coalesced += len(self.probes)
+      self.probes.clear()
+    return {"load": self.load, "background_fps": round(self.background_fps, 1), \
+      "sent_fps": round(self.sent / duration, 1), "tx_errors": self.tx_errors, "frame_to_dbus": summary_ms(self.latencies), \
+      "probes_coalesced": self.coalesced, "soc_to_0x355": summary_ms(self.soc_latencies), "soc_timeouts": self.soc_timeouts}
+
+def cpu_seconds(pid):
+  with open("/proc/{0}/stat".format(pid), "r") as stat:
+    fields = stat.read().rsplit(")", 1)[1].split()
+  return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+def start_dbus_daemon():
+  daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address=1"], stdout=subprocess.PIPE)
+  address = daemon.stdout.readline().decode("ascii").strip()
+  if (not address):
+    daemon.kill()
+    raise RuntimeError("dbus-daemon did not print an address")
+  return daemon, address
+
+def wait_for(check, timeout, what):
+  deadline = timer() + timeout
+  while (timer() < deadline):
+    if (check()):
+      return
+    time.sleep(0.1)
+  raise RuntimeError("timed out waiting for " + what)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Measures CAN to dbus and SoC to CAN latency of the running driver.')
+  parser.add_argument('-c', '--channel', default='vcan0', help='vcan interface')
+  parser.add_argument('--velib', default=os.environ.get('VELIB_PYTHON', os.path.join(sma_fakes.DRIVER_DIR, 'ext', 'velib_python')), \
+    help='velib_python checkout')
+  parser.add_argument('--python', default=sys.executable, help='interpreter for the driver')
+  parser.add_argument('--loads', default='1,10,100', help='bus load multiples, comma separated')
+  parser.add_argument('--step', type=float, default=20.0, help='seconds per load step')
+  parser.add_argument('--probe-hz', type=float, default=2.0, help='probe frames per second')
+  parser.add_argument('--soc-interval', type=float, default=5.0, help='seconds between SoC changes')
+  parser.add_argument('--set', action='append', default=[], metavar='Section.key=value', \
+    help='override a dbus-sma.yaml value, may be repeated')
+  parser.add_argument('-o', '--out', help='write the results as json')
+  args = parser.parse_args()
+
+  sys.path.insert(1, args.velib)
+  workdir = tempfile.mkdtemp(prefix="sma-e2e-")
+  daemon = driver = dbus_side = None
+  finished = False
+  try:
+    daemon, address = start_dbus_daemon()
+    os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = address
+    os.environ["DBUS_SESSION_BUS_ADDRESS"] = address
+    DBusGMainLoop(set_as_default=True)
+    dbus_side = DbusSide(address)
+
+    config = sma_fakes.load_config(["CanBus.channel=" + args.channel, "CanBus.type=socketcan"] + args.set)
+    config_file = os.path.join(workdir, "dbus-sma.yaml")
+    with open(config_file, "w") as out:
+      yaml.safe_dump(config, out)
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([args.velib, os.environ.get("PYTHONPATH", "")]))
+    log = open(os.path.join(workdir, "driver.log"), "w")
+    driver = subprocess.Popen([args.python, os.path.join(sma_fakes.DRIVER_DIR, "dbus-sma.py"), "--config", config_file], \
+      stdout=log, stderr=subprocess.STDOUT, env=env)
+    wait_for(lambda: driver.poll() is not None or dbus_side.has_name(DRIVER_SERVICE), 30, DRIVER_SERVICE)
+    if (driver.poll() is not None):
+      raise RuntimeError("driver exited, see {0}".format(log.name))
+
+    bus = can.interface.Bus(bustype="socketcan", channel=args.channel)
+    results = []
+    current = []
+    dbus_side.watch(PROBE_PATH, lambda received, value: current[0].on_probe_signal(received, value) if current else None)
+
+    # frames the driver sends, timed on arrival
+    running = [True]
+    def reader():
+      listener = can.interface.Bus(bustype="socketcan", channel=args.channel, \
+        can_filters=[{"can_id": 0x355, "can_mask": 0x7FF, "extended": False}])
+      while (running[0]):
+        msg = listener.recv(0.2)
+        if (msg is not None and current):
+          current[0].on_frame(msg, timer())
+      listener.shutdown()
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.daemon = True
+    reader_thread.start()
+
+    time.sleep(3.0) # driver settles, first BMS batch
+    for load in [float(x) for x in args.loads.split(",")]:
+      step = LoadStep(bus, dbus_side, load, args.probe_hz, args.soc_interval)
+      current[:] = [step]
+      cpu_start, wall_start = cpu_seconds(driver.pid), timer()
+      result = step.run(args.step)
+      result["driver_cpu_pct"] = round((cpu_seconds(driver.pid) - cpu_start) / (timer() - wall_start) * 100, 1)
+      results.append(result)
+      f, s = result["frame_to_dbus"], result["soc_to_0x355"]
+      print("load x{0:<6g} {1:>8} fps  frame->dbus p50 {2} p99 {3} max {4} ms ({5} coalesced)  " \
+        "soc->0x355 p50 {6} max {7} ms  driver cpu {8}%".format(load, result["sent_fps"], f["p50_ms"], f["p99_ms"], \
+        f["max_ms"], result["probes_coalesced"], s["p50_ms"], s["max_ms"], result["driver_cpu_pct"]))
+      if (driver.poll() is not None):
+        print("driver exited during the step, see {0}".format(log.name))
+        break
+
+    running[0] = False
+    bus.shutdown()
+    if (args.out):
+      with open(args.out, "w") as out:
+        json.dump({"channel": args.channel, "step_s": args.step, "config_overrides": args.set, "steps": results}, \
+          out, indent=2, sort_keys=True)
+    finished = True
+  finally:
+    if (driver is not None and driver.poll() is None):
+      driver.terminate()
+      driver.wait()
+    if (dbus_side is not None):
+      dbus_side.stop()
+    if (daemon is not None):
+      daemon.kill()
+    if (finished):
+      shutil.rmtree(workdir, ignore_errors=True)
+    else:
+      sys.stderr.write("driver config and log kept in {0}\n".format(workdir))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bench_pipeline.py: Per stage cost of the receive path (filter, decode,
+                derive, dbus publish), with the bus, dbus and velib faked. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# python bench_pipeline.py -o before.json
+# ... change the hot path ...
+# python bench_pipeline.py -o after.json --compare before.json
+#
+# Every stage runs the same work over a batch of frames, best of --repeat
+# runs. ns/frame and frames/s come from the wall clock. Memory is traced in
+# a separate run: "transient_bytes" is the peak traced memory above the
+# start of the run (the garbage a frame creates before it is freed), and
+# "blocks_per_frame" the memory blocks still held afterwards per frame
+# (leaks or caches that keep growing).
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+from timeit import default_timer as timer
+
+import can
+
+import sma_fakes
+
+# one SunnyIsland cycle, values as a running split phase system reports them
+CYCLE_VALUES = [
+  {"line1": {"ExtPwr": 1200, "InvPwr": -300, "OutputVoltage": 120.3, "OutputFreq": 60.01, "ExtVoltage": 119.8, "ExtFreq": 59.99},
+   "line2": {"ExtPwr": 1100, "InvPwr": -200, "OutputVoltage": 120.1, "ExtVoltage": 119.6},
+   "battery": {"Voltage": 53.2, "Current": -41.5}, "system": {"ExtFlags": 0xC0, "Load": 1800}},
+  {"line1": {"ExtPwr": 1300, "InvPwr": -400, "OutputVoltage": 120.5, "OutputFreq": 59.98, "ExtVoltage": 119.9, "ExtFreq": 60.02},
+   "line2": {"ExtPwr": 1000, "InvPwr": -100, "OutputVoltage": 120.0, "ExtVoltage": 119.7},
+   "battery": {"Voltage": 53.3, "Current": -40.1}, "system": {"ExtFlags": 0xC0, "Load": 1800}},
+]
+
+# cluster sync chatter that the acceptance filter has to drop, per SunnyRemote frame
+SYNC_PER_FRAME = 4
+
+def build_frames(codec_class, frame_ids, count):
+  """count SunnyRemote frames, alternating between the CYCLE_VALUES so the
+     derived values really change"""
+  cycles = []
+  for values in CYCLE_VALUES:
+    targets = dict((name, dict(fields)) for name, fields in values.items())
+    codec = codec_class(targets)
+    cycles.append([can.Message(arbitration_id=can_id, data=codec.encode(can_id), is_extended_id=False) \
+      for can_id in frame_ids])
+  frames = []
+  while (len(frames) < count):
+    frames.extend(cycles[(len(frames) // len(frame_ids)) % len(cycles)])
+  return frames[:count]
+
+def build_mixed(frames):
+  mixed = []
+  for msg in frames:
+    mixed.append(msg)
+    for unit in range(SYNC_PER_FRAME):
+      mixed.append(can.Message(arbitration_id=0x0A0 + unit, data=bytearray(8), is_extended_id=False))
+  return mixed
+
+def measure(run, items, repeat):
+  """Best wall time per item over repeat runs, then one traced run"""
+  run(items[:100]) # warm up caches and lazily built paths
+  best = None
+  for i in range(repeat):
+    gc.collect()
+    start = timer()
+    run(items)
+    elapsed = timer() - start
+    best = elapsed if best is None or elapsed < best else best
+
+  gc.collect()
+  blocks = sys.getallocatedblocks() if hasattr(sys, "getallocatedblocks") else None
+  tracemalloc.start()
+  base = tracemalloc.get_traced_memory()[0]
+  run(items)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  gc.collect()
+  result = {"ns_per_frame": round(best / len(items) * 1e9, 1), "frames_per_s": int(len(items) / best), \
+    "transient_bytes": peak - base}
+  if (blocks is not None):
+    result["blocks_per_frame"] = round((sys.getallocatedblocks() - blocks) / float(len(items)), 4)
+  return result
+
+def run_benchmarks(count, repeat, only=None):
+  clock = sma_fakes.VirtualClock(time.time())
+  fake_gobject = sma_fakes.install(clock, patch_time=False)
+  driver_module = sma_fakes.load_driver()
+  logging.getLogger().setLevel(logging.WARNING)
+  import sma_codec # on the path once the driver is loaded
+
+  recorder = sma_fakes.Recorder(clock)
+  system = "com.victronenergy.system"
+  monitor_values = {(system, "/Dc/Battery/Soc"): 50.0, (system, "/Dc/Battery/Voltage"): 53.2, \
+    (system, "/Dc/Battery/Current"): 40.0, (system, "/Dc/Pv/Current"): 0.0}
+  driver = sma_fakes.create_driver(driver_module, clock, fake_gobject, recorder, sma_fakes.load_config([]), \
+    monitor_values)
+  publisher = driver._publisher
+  codec = driver._codec
+
+  frame_ids = sorted(sma_codec.SUNNY_REMOTE_FRAMES)
+  frames = build_frames(sma_codec.FrameCodec, frame_ids, count)
+  mixed = build_mixed(frames)
+  stages = {}
+
+  def stage(name, run, items):
+    if (only is None or any(name.startswith(prefix) for prefix in only)):
+      stages[name] = measure(run, items, repeat)
+
+  # the check every received frame goes through when the kernel filter is off (raw capture)
+  rx_ids = driver._rx_ids
+  def run_filter(items):
+    for msg in items:
+      if (msg.arbitration_id in rx_ids):
+        pass
+  stage("filter", run_filter, mixed)
+
+  for can_id in frame_ids:
+    payloads = [(msg.arbitration_id, msg.data) for msg in frames if msg.arbitration_id == can_id] * len(frame_ids)
+    def run_decode(items, decode=codec.decode):
+      for can_id, data in items:
+        decode(can_id, data)
+    stage("decode/0x{0:03X}".format(can_id), run_decode, payloads)
+
+  # the derived values, mostly unchanged from one frame to the next like on a steady system
+  for group in driver_module.DERIVE_ALL:
+    def run_derive(items, derive=driver._derivers[group]):
+      for i in items:
+        derive()
+    stage("derive/" + group, run_derive, range(count))
+    publisher.flush()
+
+  # VeDbusService item assignment (faked), every write a change
+  paths = [path for path in sorted(driver._dbusservice._values) if path.startswith("/Ac/")]
+  writes = [(paths[i % len(paths)], i) for i in range(count)]
+  dbusservice = driver._dbusservice
+  def run_assign(items):
+    for path, value in items:
+      dbusservice[path] = value
+  stage("publish/assign", run_assign, writes)
+
+  # publisher: change tracking plus a flush per SunnyIsland cycle
+  def run_publish(items):
+    for n, (path, value) in enumerate(items):
+      publisher[path] = value
+      if (n % len(frame_ids) == 0):
+        publisher.flush()
+    publisher.flush()
+  stage("publish/tracked", run_publish, writes)
+
+  # decode + derive + safety, per frame like the fd watch sees them
+  def run_pipeline(items, process=driver._process_can_msg):
+    for msg in items:
+      process(msg)
+    publisher.flush()
+  stage("pipeline", run_pipeline, frames)
+
+  # the whole receive handler from the fd watch, the kernel filter has dropped the sync chatter
+  bus = driver._can_bus
+  def run_rx(items):
+    for msg in items:
+      bus.inject(msg)
+    publisher.flush()
+  stage("rx", run_rx, frames)
+
+  driver.__del__()
+  return stages
+
+def compare(stages, baseline):
+  print("{0:<18} {1:>12} {2:>12} {3:>8}".format("stage", "before ns", "after ns", "change"))
+  for name in sorted(stages):
+    after = stages[name]["ns_per_frame"]
+    before = baseline.get(name, {}).get("ns_per_frame")
+    change = "{0:+.1f}%".format((after - before) / before * 100) if before else "new"
+    print("{0:<18} {1:>12} {2:>12} {3:>8}".format(name, before if before is not None else "-", after, change))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Benchmarks the stages of the SMA driver receive path.')
+  parser.add_argument('-n', '--frames', type=int, default=20000, help='frames per stage')
+  parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per stage, the best counts')
+  parser.add_argument('-s', '--stage', action='append', help='only stages starting with this (may be repeated)')
+  parser.add_argument('-o', '--out', help='write the results as json')
+  parser.add_argument('--compare', help='results json of an earlier run to compare against')
+  args = parser.parse_args()
+
+  stages = run_benchmarks(args.frames, args.repeat, args.stage)
+  results = {"python": platform.python_version(), "implementation": platform.python_implementation(), \
+    "machine": platform.machine(), "time": int(time.time()), "frames": args.frames, "repeat": args.repeat, \
+    "stages": stages}
+
+  if (args.compare):
+    with open(args.compare, "r") as before:
+      compare(stages, json.load(before)["stages"])
+  else:
+    print("{0:<18} {1:>10} {2:>12} {3:>10} {4:>8}".format("stage", "ns/frame", "frames/s", "transient", "blocks"))
+    for name in sorted(stages):
+      s = stages[name]
+      print("{0:<18} {1:>10} {2:>12} {3:>10} {4:>8}".format(name, s["ns_per_frame"], s["frames_per_s"], \
+        s["transient_bytes"], s.get("blocks_per_frame", "-")))
+
+  if (args.out):
+    with open(args.out, "w") as out:
+      json.dump(results, out, indent=2, sort_keys=True)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bench_state_machine.py: Import time and per check_state cost of the BMS
+                charge controller, against an older bms_state_machine.py. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# python bench_state_machine.py                       (working tree only)
+# python bench_state_machine.py --baseline-rev auto   (also the last version on python-statemachine)
+# python bench_state_machine.py --baseline-rev <rev>  (any git revision of the file)
+#
+# The baseline is taken from git and needs what it imports installed (the
+# python-statemachine versions need: pip install "python-statemachine<0.9").
+# Both run the same voltage sequences and must end up with the same state
+# and charge current trajectory, a mismatch fails the run.
+#
+# import_ms: importing the module in a fresh interpreter, best of --repeat
+# us/check:  controller.update_battery_data() per call, best of --repeat
+#   bulk:    stays in bulk, no transition
+#   float:   stays in float, the current loop runs
+#   cycle:   bulk -> absorb -> float -> bulk, a transition on most calls
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+REPO = os.path.dirname(HERE)
+MODULE_PATH = "dbus-sma/bms_state_machine.py"
+
+CONFIG = dict(charge_bulk_current=160.0, charge_absorb_voltage=56.2, charge_float_voltage=54.4, \
+  time_min_absorb=0, rebulk_voltage=54.0)
+
+# (voltage, current) per call for each workload
+def workloads(count):
+  bulk = [(50.0 + (i % 50) * 0.01, 150.0) for i in range(count)]
+  float_ = [(54.4 + ((i % 20) - 10) * 0.01, 20.0 + (i % 7)) for i in range(count)]
+  # 56.5 ends bulk, absorb ends right away (time_min_absorb 0), 53.5 rebulks from float
+  cycle = [((56.5, 150.0), (56.3, 40.0), (53.5, 10.0))[i % 3] for i in range(count)]
+  return {"bulk": bulk, "float": float_, "cycle": cycle}
+
+def baseline_source(rev):
+  if (rev == "auto"):
+    # the last revision that still imported python-statemachine
+    removed = subprocess.check_output(["git", "log", "-1", "--format=%H", "-S", "from statemachine import", \
+      "--", MODULE_PATH], cwd=REPO).decode("utf-8").strip()
+    if (not removed):
+      raise RuntimeError("no python-statemachine version of {0} in git".format(MODULE_PATH))
+    rev = removed + "~1"
+  return subprocess.check_output(["git", "show", "{0}:{1}".format(rev, MODULE_PATH)], cwd=REPO)
+
+def load_module(directory, name):
+  import importlib.util
+  spec = importlib.util.spec_from_file_location(name, os.path.join(directory, "bms_state_machine.py"))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def import_ms(directory, repeat):
+  code = "import sys; sys.path.insert(0, {0!r}); from timeit import default_timer as timer; " \
+    "start = timer(); import bms_state_machine; print((timer() - start) * 1000)".format(directory)
+  return min(float(subprocess.check_output([sys.executable, "-c", code]).decode("utf-8").strip()) \
+    for i in range(repeat))
+
+def start_in(module, state):
+  controller = module.BMSChargeController(**CONFIG)
+  controller.start_charging()
+  if (state == "float"):
+    controller.update_battery_data(56.5, 150.0) # bulk -> absorb
+    controller.update_battery_data(56.3, 40.0)  # absorb -> float
+    assert controller.get_state() == "float_chg"
+  return controller
+
+def run(module, name, samples, repeat):
+  """best us per call and the (state, charge current) trajectory"""
+  state = "float" if name == "float" else "bulk"
+  best = None
+  for i in range(repeat):
+    controller = start_in(module, state)
+    update = controller.update_battery_data
+    start = timer()
+    for voltage, current in samples:
+      update(voltage, current)
+    elapsed = timer() - start
+    best = elapsed if best is None else min(best, elapsed)
+
+  controller = start_in(module, state)
+  trajectory = []
+  for voltage, current in samples[:1000]:
+    controller.update_battery_data(voltage, current)
+    trajectory.append((controller.get_state(), controller.get_charge_current()))
+  return best * 1e6 / len(samples), trajectory
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Benchmarks the BMS charge state machine.')
+  parser.add_argument('--baseline-rev', help='git revision of {0} to compare against, auto: the last one on ' \
+    'python-statemachine'.format(MODULE_PATH))
+  parser.add_argument('-n', '--count', type=int, default=20000, help='calls per workload')
+  parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best counts')
+  args = parser.parse_args()
+
+  # do_current_logic logs every call (at INFO in the older versions)
+  logging.disable(logging.CRITICAL)
+
+  candidates = [("current", os.path.join(REPO, "dbus-sma"))]
+  work_dir = tempfile.mkdtemp(prefix="sma-sm-bench-")
+  try:
+    if (args.baseline_rev):
+      with open(os.path.join(work_dir, "bms_state_machine.py"), "wb") as module_file:
+        module_file.write(baseline_source(args.baseline_rev))
+      candidates.insert(0, ("baseline", work_dir))
+
+    loads = workloads(args.count)
+    results = {}
+    for label, directory in candidates:
+      module = load_module(directory, "bms_state_machine_" + label)
+      results[label] = {"import_ms": import_ms(directory, args.repeat)}
+      for name, samples in sorted(loads.items()):
+        results[label][name] = run(module, name, samples, args.repeat)
+  finally:
+    shutil.rmtree(work_dir)
+
+  labels = [label for label, directory in candidates]
+  print("{0:<14}".format("") + "".join("{0:>12}".format(label) for label in labels) + \
+    ("{0:>10}".format("speedup") if len(labels) == 2 else ""))
+  rows = [("import_ms", lambda result: result["import_ms"])] + \
+    [("{0} us/check".format(name), (lambda name: lambda result: result[name][0])(name)) for name in sorted(loads)]
+  for title, value in rows:
+    values = [value(results[label]) for label in labels]
+    line = "{0:<14}".format(title) + "".join("{0:>12.3f}".format(v) for v in values)
+    if (len(values) == 2):
+      line += "{0:>9.1f}x".format(values[0] / values[1])
+    print(line)
+
+  failed = False
+  if (len(labels) == 2):
+    for name in sorted(loads):
+      if (results["baseline"][name][1] != results["current"][name][1]):
+        print("{0}: state/current trajectory differs from the baseline".format(name))
+        failed = True
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""check_batch_sim.py: Fails when the numpy batch simulation in
+                bms_batch_sim.py differs from the scalar charge controller. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# python check_batch_sim.py
+#
+# Runs small parameter grids through BatchSimulation and, set by set, through
+# bms_test.simulate() with the real BMSChargeController. Every step's state,
+# battery voltage, battery current and charge current has to be the same
+# float, and so do the metrics. The grids cover both ends of the gains, no
+# minimum absorb time, a nearly full battery, two cycles, sets that stop at
+# the time limit and a 1 s step (the P term scaled by dt).
+
+import argparse
+import os
+import sys
+from timeit import default_timer as timer
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "dbus-sma"))
+
+import numpy as np
+
+from bms_batch_sim import BatchSimulation, METRICS, build, parameter_sets, same, trajectory_metrics
+from bms_test import simulate
+
+BASE = {"charge_bulk_amps": 164.0, "charge_absorb_voltage": 56.2, "charge_float_voltage": 54.4, \
+  "time_min_absorb": 30, "rebulk_voltage": 54.0, "current_p_gain": 100.0, "current_d_gain": 20.0, \
+  "capacity": 280.0, "soc": 0.2, "resistance": 0.008}
+
+# (simulation settings, swept parameters)
+GRIDS = (
+  (dict(step_s=2.0, cycles=2), {"charge_absorb_voltage": [55.8, 56.2], "current_p_gain": [25.0, 200.0], \
+    "current_d_gain": [0.0, 40.0], "time_min_absorb": [0, 30]}),
+  (dict(step_s=2.0, cycles=1), {"soc": [0.2, 0.95], "capacity": [100.0, 280.0], "resistance": [0.002, 0.02]}),
+  (dict(step_s=1.0, cycles=1), {"current_p_gain": [50.0, 100.0], "charge_float_voltage": [54.0, 54.4]}),
+)
+
+def check(cfg, simulation, sweeps, max_hours):
+  """Returns the number of sets that differ"""
+  sets = parameter_sets(BASE, sweeps)
+  step_s, cycles = simulation["step_s"], simulation["cycles"]
+  built = [build(cfg, params) for params in sets]
+  batch = BatchSimulation([controller for controller, clock, battery in built], \
+    [battery for controller, clock, battery in built], step_s, max_hours=max_hours, cycles=cycles, record=True)
+  start = timer()
+  metrics = batch.run()
+  batch_time = timer() - start
+
+  mismatches = 0
+  scalar_time = 0.0
+  for i, params in enumerate(sets):
+    controller, clock, battery = build(cfg, params)
+    start = timer()
+    trajectory = simulate(controller, battery, clock, step_s, max_hours=max_hours, cycles=cycles)
+    scalar_time += timer() - start
+
+    problems = []
+    batch_trajectory = batch.trajectory(i)
+    if (len(batch_trajectory) != len(trajectory)):
+      problems.append("{0} steps, scalar {1}".format(len(batch_trajectory), len(trajectory)))
+    for step, (row, expected) in enumerate(zip(batch_trajectory, trajectory)):
+      if (row != expected):
+        problems.append("step {0}: {1}, scalar {2}".format(step, row, expected))
+        break
+    expected = trajectory_metrics(trajectory, controller.model.charge_absorb_voltage, step_s, cycles)
+    for metric in METRICS:
+      if (not same(metrics[metric][i].item(), expected[metric])):
+        problems.append("{0}: {1}, scalar {2}".format(metric, metrics[metric][i].item(), expected[metric]))
+    if (problems):
+      mismatches += 1
+      print("MISMATCH {0}".format(dict((name, params[name]) for name in sorted(sweeps))))
+      for problem in problems:
+        print("  " + problem)
+
+  states = set(row[1] for i in range(len(sets)) for row in batch.trajectory(i))
+  print("{0} sets, step {1}s, cycles {2}: {3} differ, {4} complete, states {5}, batch {6:.2f}s, scalar {7:.2f}s" \
+    .format(len(sets), step_s, cycles, mismatches, int(np.count_nonzero(metrics["complete"])), \
+      "/".join(sorted(states)), batch_time, scalar_time))
+  return mismatches
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Checks the batch simulation against the scalar charge controller.')
+  parser.add_argument('--max-hours', type=float, default=8.0, help='simulated time limit per set')
+  args = parser.parse_args()
+
+  # only the sections build() replaces values in
+  cfg = {"BMSData": {}, "BmsControl": {}}
+  failed = sum(check(cfg, simulation, sweeps, args.max_hours) for simulation, sweeps in GRIDS)
+  sys.exit(1 if failed else 0)
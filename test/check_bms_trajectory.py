@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""check_bms_trajectory.py: Fails when the BMS charge controller's simulated
+                trajectory differs from the reference in bms_trajectory.csv. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# python check_bms_trajectory.py                    (compare, exit 1 on a difference)
+# python check_bms_trajectory.py --regenerate auto  (rewrite the reference)
+#
+# Runs dbus-sma/bms_test.py --compare with the settings in
+# bms_trajectory.yaml: an empty 280 Ah bank charged through bulk, absorb and
+# float, loaded until it rebulks, twice. Every 2 s step has to match the
+# reference, state and charge current included.
+#
+# The reference comes from the controller as it was on python-statemachine
+# (--regenerate auto, needs: pip install "python-statemachine<0.9"), so the
+# table driven rewrite and everything after it is checked against the
+# original behaviour. --regenerate <rev> takes bms_state_machine.py from any
+# git revision. Regenerate only for an intended change of the charge logic.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import yaml
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+REPO = os.path.dirname(HERE)
+DRIVER_DIR = os.path.join(REPO, "dbus-sma")
+MODULE_PATH = "dbus-sma/bms_state_machine.py"
+CONFIG = os.path.join(HERE, "bms_trajectory.yaml")
+REFERENCE = os.path.join(HERE, "bms_trajectory.csv")
+
+# bms_test.py options, the regenerated reference uses the same
+SIMULATION = dict(capacity=280.0, soc=0.2, step=2.0, load=60.0, load_after=30.0, max_hours=24.0, cycles=2)
+
+def compare():
+  """bms_test.py --compare against the reference, returns its exit code"""
+  command = [sys.executable, os.path.join(DRIVER_DIR, "bms_test.py"), "-c", CONFIG, "--compare", REFERENCE]
+  for name, value in sorted(SIMULATION.items()):
+    command += ["--" + name.replace("_", "-"), str(value)]
+  return subprocess.call(command)
+
+def revision_source(rev):
+  if (rev == "auto"):
+    # the last revision that still imported python-statemachine
+    removed = subprocess.check_output(["git", "log", "-1", "--format=%H", "-S", "from statemachine import", \
+      "--", MODULE_PATH], cwd=REPO).decode("utf-8").strip()
+    if (not removed):
+      raise RuntimeError("no python-statemachine version of {0} in git".format(MODULE_PATH))
+    rev = removed + "~1"
+  return subprocess.check_output(["git", "show", "{0}:{1}".format(rev, MODULE_PATH)], cwd=REPO)
+
+# the older controllers take the absorb time from datetime.now(), this one
+# follows the simulated clock
+def clock_datetime(clock):
+  epoch = datetime(2020, 1, 1)
+  class ClockDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+      return epoch + timedelta(seconds=clock.now())
+  return ClockDatetime
+
+def regenerate(rev):
+  import importlib.util
+  sys.path.insert(0, DRIVER_DIR)
+  import bms_test
+  from bms_state_machine import SimulatedClock
+
+  with open(CONFIG, "r") as yamlfile:
+    cfg = yaml.safe_load(yamlfile)
+  bms = cfg['BMSData']
+  control = cfg.get('BmsControl', {})
+
+  work_dir = tempfile.mkdtemp(prefix="sma-trajectory-")
+  try:
+    module_file = os.path.join(work_dir, "bms_state_machine.py")
+    with open(module_file, "wb") as out:
+      out.write(revision_source(rev))
+    spec = importlib.util.spec_from_file_location("bms_state_machine_reference", module_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  finally:
+    shutil.rmtree(work_dir)
+
+  clock = SimulatedClock()
+  module.datetime = clock_datetime(clock)
+  controller = module.BMSChargeController(charge_bulk_current=bms['charge_bulk_amps'], \
+    charge_absorb_voltage=bms['charge_absorb_voltage'], charge_float_voltage=bms['charge_float_voltage'], \
+    time_min_absorb=bms['time_min_absorb'], rebulk_voltage=bms['rebulk_voltage'], \
+    current_p_gain=control.get('current_p_gain', 100.0), current_d_gain=control.get('current_d_gain', 20.0))
+  battery = bms_test.SimulatedBattery(SIMULATION['capacity'], SIMULATION['soc'])
+  trajectory = bms_test.simulate(controller, battery, clock, SIMULATION['step'], SIMULATION['load'], \
+    SIMULATION['load_after'], SIMULATION['max_hours'], SIMULATION['cycles'])
+
+  with open(REFERENCE, "w") as csvfile:
+    csvfile.write("seconds,state,voltage,current,charge_current\n")
+    csvfile.write("\n".join(bms_test.format_row(row) for row in trajectory) + "\n")
+  states = [row[1] for row in bms_test.transitions(trajectory)]
+  print("{0}: {1} steps, {2}".format(REFERENCE, len(trajectory), " -> ".join(states)))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Checks the BMS charge controller against a reference trajectory.')
+  parser.add_argument('--regenerate', metavar='REV', help='rewrite the reference with {0} from this git ' \
+    'revision, auto: the last one on python-statemachine'.format(MODULE_PATH))
+  args = parser.parse_args()
+
+  if (args.regenerate):
+    regenerate(args.regenerate)
+    sys.exit(0)
+  sys.exit(compare())
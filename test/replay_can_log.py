@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""replay_can_log.py: Feeds a recorded CAN capture through the driver's real
+                decode, derive and publish pipeline, off-target and on the
+                capture's own clock. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# Output is one row per dbus value change and per frame the driver sent:
+#   time,kind,name,value
+#   1598000000.123456,dbus,/Ac/Out/L1/P,1210
+#   1598000000.200000,tx,0x351,"40 02 e8 03 b8 0b c0 01"
+#
+# python replay_can_log.py capture.pcap > run.csv
+# python replay_can_log.py candump-2020-08-21.log --speed 10 --set CanBus.bms_tx_mode=kernel
+#
+# Formats: pcap from "tcpdump -w capture.pcap -i can5" (also -i any), candump
+# -l logs (.log), Vector .asc/.blf and the other python-can log formats.
+# Time only moves with the capture: timers fire at the capture time they are
+# due, so hours of traffic replay in seconds. The replay drives the charge
+# controller's clock as well (its WallClock reads the patched timer), so the
+# absorb timer runs on capture time. Only the grid logic's hour of day
+# (datetime.now()) still reads the wall clock.
+
+import argparse
+import csv
+import json
+import logging
+import os
+import struct
+import sys
+import time
+from timeit import default_timer as wall_timer
+
+import can
+
+import sma_fakes
+
+# pcap link types that carry socketcan frames
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_CAN_SOCKETCAN = 227
+LINKTYPE_LINUX_SLL2 = 276
+ETH_P_CAN = 0x000C
+ETH_P_CANFD = 0x000D
+
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+
+PCAP_MAGIC = {
+  b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+  b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+  b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+  b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+
+def _socketcan_frame(timestamp, frame, id_endian):
+  """struct can_frame / canfd_frame -> can.Message"""
+  if (len(frame) < 8):
+    return None
+  can_id, length, fd_flags = struct.unpack(id_endian + "IBB", frame[:6])
+  is_fd = len(frame) > 16
+  extended = bool(can_id & CAN_EFF_FLAG)
+  return can.Message(timestamp=timestamp, arbitration_id=can_id & (0x1FFFFFFF if extended else 0x7FF), \
+    is_extended_id=extended, is_remote_frame=bool(can_id & CAN_RTR_FLAG), is_error_frame=bool(can_id & CAN_ERR_FLAG), \
+    is_fd=is_fd, dlc=length, data=bytearray(frame[8:8 + length]), check=False)
+
+def read_pcap(path):
+  """Frames from a classic pcap file. LINKTYPE_CAN_SOCKETCAN has the CAN id in
+     network order, the cooked (SLL/SLL2) captures of "-i any" in host order."""
+  with open(path, "rb") as pcap:
+    header = pcap.read(24)
+    if (header[:4] == b"\x0a\x0d\x0d\x0a"):
+      raise ValueError("{0} is pcapng, convert it first: editcap -F pcap {0} out.pcap".format(path))
+    if (len(header) < 24 or header[:4] not in PCAP_MAGIC):
+      raise ValueError("{0} is not a pcap file".format(path))
+    endian, resolution = PCAP_MAGIC[header[:4]]
+    linktype = struct.unpack(endian + "I", header[20:24])[0] & 0x0FFFFFFF
+    if (linktype not in (LINKTYPE_CAN_SOCKETCAN, LINKTYPE_LINUX_SLL, LINKTYPE_LINUX_SLL2)):
+      raise ValueError("{0}: link type {1} carries no CAN frames".format(path, linktype))
+
+    record = struct.Struct(endian + "IIII")
+    while True:
+      data = pcap.read(record.size)
+      if (len(data) < record.size):
+        return
+      ts_sec, ts_frac, incl_len, orig_len = record.unpack(data)
+      packet = pcap.read(incl_len)
+      if (len(packet) < incl_len):
+        return # capture cut short
+      timestamp = ts_sec + ts_frac * resolution
+
+      if (linktype == LINKTYPE_CAN_SOCKETCAN):
+        msg = _socketcan_frame(timestamp, packet, ">")
+      else:
+        if (linktype == LINKTYPE_LINUX_SLL):
+          protocol, frame = struct.unpack(">H", packet[14:16])[0], packet[16:]
+        else:
+          protocol, frame = struct.unpack(">H", packet[0:2])[0], packet[20:]
+        msg = _socketcan_frame(timestamp, frame, "<") if protocol in (ETH_P_CAN, ETH_P_CANFD) else None
+      if (msg is not None):
+        yield msg
+
+def read_log(path):
+  """Frames from any capture format, by file extension"""
+  if (os.path.splitext(path)[1].lower() in (".pcap", ".cap", ".dmp")):
+    return read_pcap(path)
+  # candump -l (.log), .asc, .blf, .trc, .csv, ...
+  return iter(can.LogReader(path))
+
+# Output sinks, one row per event
+class CsvSink(object):
+  def __init__(self, out):
+    self._writer = csv.writer(out, lineterminator="\n")
+    self._writer.writerow(("time", "kind", "name", "value"))
+
+  def dbus(self, t, path, value):
+    self._writer.writerow(("{0:.6f}".format(t), "dbus", path, value))
+
+  def tx(self, t, msg):
+    self._writer.writerow(("{0:.6f}".format(t), "tx", "0x{0:03X}".format(msg.arbitration_id), \
+      " ".join("{0:02x}".format(b) for b in msg.data)))
+
+class JsonSink(object):
+  def __init__(self, out):
+    self._out = out
+
+  def dbus(self, t, path, value):
+    self._out.write(json.dumps({"t": round(t, 6), "dbus": path, "value": value}) + "\n")
+
+  def tx(self, t, msg):
+    self._out.write(json.dumps({"t": round(t, 6), "tx": "0x{0:03X}".format(msg.arbitration_id), \
+      "data": " ".join("{0:02x}".format(b) for b in msg.data)}) + "\n")
+
+def replay(frames, sink, config, soc=50.0, speed=0.0, tail_s=5.0):
+  """Runs the capture through a driver, returns a summary dict"""
+  frames = iter(frames)
+  first = next(frames, None)
+  if (first is None):
+    raise ValueError("capture holds no CAN frames")
+
+  clock = sma_fakes.VirtualClock(first.timestamp)
+  fake_gobject = sma_fakes.install(clock)
+  level = logging.getLogger().level
+  driver_module = sma_fakes.load_driver()
+  logging.getLogger().setLevel(level) # the driver sets INFO on import
+  recorder = sma_fakes.Recorder(clock, dbus_sink=sink.dbus, tx_sink=sink.tx)
+
+  # the system service values the driver reads every tick, battery voltage
+  # and current follow the SunnyIsland's own 0x305 frame
+  battery = driver_module.sma_battery
+  system = "com.victronenergy.system"
+  monitor_values = {
+    (system, "/Dc/Battery/Soc"): soc,
+    (system, "/Dc/Battery/Voltage"): lambda: battery["Voltage"],
+    (system, "/Dc/Battery/Current"): lambda: -battery["Current"],
+    (system, "/Dc/Pv/Current"): 0.0,
+  }
+  driver = sma_fakes.create_driver(driver_module, clock, fake_gobject, recorder, config, monitor_values)
+  bus = driver._can_bus
+
+  count = 0
+  accepted = 0
+  start_time = first.timestamp
+  last_time = start_time
+  wall_start = wall_timer()
+  msg = first
+  while (msg is not None):
+    timestamp = max(msg.timestamp, last_time) # a capture may step back a little across interfaces
+    if (speed > 0):
+      delay = wall_start + (timestamp - start_time) / speed - wall_timer()
+      if (delay > 0):
+        time.sleep(delay)
+    fake_gobject.run_until(timestamp)
+    if (bus.inject(msg)):
+      accepted += 1
+    count += 1
+    last_time = timestamp
+    msg = next(frames, None)
+
+  # let the publisher, energy and journal timers catch up with the last frame
+  fake_gobject.run_until(last_time + tail_s)
+  wall = wall_timer() - wall_start
+  driver.__del__()
+
+  duration = last_time - start_time
+  return {"frames": count, "accepted": accepted, "capture_s": round(duration, 3), "wall_s": round(wall, 3), \
+    "speedup": round(duration / wall, 1) if wall > 0 else None, "frames_per_s": round(count / wall) if wall > 0 else None, \
+    "dbus_updates": recorder.dbus_count, "tx_frames": recorder.tx_count}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Replays a CAN capture through the SMA driver and prints ' + \
+    'every dbus value change and transmitted frame.')
+  parser.add_argument('capture', help='pcap, candump -l log, asc, blf, ...')
+  parser.add_argument('-o', '--out', help='output file (default stdout)')
+  parser.add_argument('-f', '--format', choices=('csv', 'jsonl'), default='csv')
+  parser.add_argument('--speed', type=float, default=0.0, help='multiple of real time, 0: as fast as possible')
+  parser.add_argument('--soc', type=float, default=50.0, help='battery SoC reported by the system service')
+  parser.add_argument('--tail', type=float, default=5.0, help='seconds to run the timers after the last frame')
+  parser.add_argument('--journal', help='state journal to use (default: none)')
+  parser.add_argument('--set', action='append', default=[], metavar='Section.key=value', \
+    help='override a dbus-sma.yaml value, may be repeated')
+  parser.add_argument("-d", "--debug", help="log the driver at debug level", action="store_true")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, stream=sys.stderr)
+  out = open(args.out, "w") if args.out else sys.stdout
+  try:
+    sink = JsonSink(out) if args.format == "jsonl" else CsvSink(out)
+    summary = replay(read_log(args.capture), sink, sma_fakes.load_config(args.set, args.journal), soc=args.soc, \
+      speed=args.speed, tail_s=args.tail)
+  finally:
+    if (out is not sys.stdout):
+      out.close()
+
+  sys.stderr.write("replayed {frames} frames ({accepted} accepted), {capture_s}s of capture in {wall_s}s " \
+    "({speedup}x, {frames_per_s} frames/s): {dbus_updates} dbus updates, {tx_frames} frames sent\n".format(**summary))
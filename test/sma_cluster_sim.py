@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""sma_cluster_sim.py: Virtual SunnyIsland cluster (master plus slaves) on a
+                python-can virtual bus or vcan, the inverter side for
+                bench and load testing the driver. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# sudo modprobe vcan
+# sudo ip link add dev vcan0 type vcan && sudo ip link set vcan0 up
+# python sma_cluster_sim.py --channel vcan0 --slaves 1 --load-factor 10
+# (driver with CanBus.channel: vcan0, CanBus.type: socketcan)
+#
+# The master broadcasts the SunnyRemote frames 0x300-0x309 from a simple
+# model: battery with an SoC and internal resistance, constant AC load,
+# grid that can be dropped on a schedule. Every unit adds cluster sync
+# traffic, which the driver's acceptance filter has to keep away from it.
+#
+# It reacts like the SunnyIsland to the BMS frames it receives:
+#   0x35C  SMA_ON_MSG / SMA_OFF_MSG start and stop the inverters
+#   0x351  charge voltage limit and charge current on grid, min voltage
+#          below which the inverters fault off
+#   no 0x351 for --bms-timeout seconds: hard shutdown, everything stops and
+#          only a power cycle (a restart of the simulator) brings it back
+# The report at the end holds the keep-alive gaps per BMS frame id.
+
+import argparse
+import heapq
+import json
+import os
+import signal
+import sys
+import struct
+from timeit import default_timer as timer
+
+import can
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dbus-sma"))
+from sma_codec import FrameCodec, SUNNY_REMOTE_FRAMES
+from bms_frames import CAN_tx_msg
+from diagnostics import LatencyHistogram
+
+# The sync ids between cluster units are not documented, these are stand-ins
+# outside the SunnyRemote and BMS ranges, one per unit.
+SYNC_BASE_ID = 0x0A0
+
+BMS_IDS = sorted(CAN_tx_msg.values())
+SMA_CMD_ID = 0x35C
+
+# 8 byte frames at 500 kbit/s with worst case stuffing
+FRAME_BITS = 135
+
+_BAT_CHG = struct.Struct("<HHHH")
+
+class SimBattery(object):
+  def __init__(self, capacity_ah=200.0, soc=50.0, ocv_empty=48.0, ocv_full=54.4, resistance=0.01):
+    self.capacity_ah = capacity_ah
+    self.soc = soc
+    self.ocv_empty = ocv_empty
+    self.ocv_full = ocv_full
+    self.resistance = resistance
+    self.current = 0.0 # positive into the battery
+
+  def ocv(self):
+    return self.ocv_empty + (self.ocv_full - self.ocv_empty) * self.soc / 100.0
+
+  def voltage(self):
+    return self.ocv() + self.current * self.resistance
+
+  def cv_current(self, voltage_limit):
+    """Largest charge current that keeps the terminal voltage at the limit"""
+    return max((voltage_limit - self.ocv()) / self.resistance, 0.0)
+
+  def step(self, current, dt):
+    self.current = current
+    self.soc = min(max(self.soc + current * dt / (self.capacity_ah * 36.0), 0.0), 100.0)
+
+class SunnyIslandCluster(object):
+  def __init__(self, bus, slaves=1, period_s=0.2, sync_rate=20.0, load_factor=1.0, load_w=1500.0, \
+      charger_max_a=100.0, bms_timeout_s=300.0, gap_warn_s=3.0, battery=None, grid_schedule=None):
+    """sync_rate: sync frames per second and unit, load_factor multiplies it.
+       grid_schedule: [(seconds from start, grid ok), ...]"""
+    self.bus = bus
+    self.units = 1 + slaves
+    self.period_s = period_s
+    self.sync_period = 1.0 / (sync_rate * load_factor) if sync_rate > 0 and load_factor > 0 else None
+    self.load_w = load_w
+    self.charger_max_a = charger_max_a
+    self.bms_timeout_s = bms_timeout_s
+    self.gap_warn_s = gap_warn_s
+    self.battery = battery or SimBattery()
+    self.grid_schedule = sorted(grid_schedule or [])
+
+    self.line1 = {"OutputVoltage": 0, "ExtPwr": 0, "InvPwr": 0, "ExtVoltage": 0, "ExtFreq": 0.0, "OutputFreq": 0.0}
+    self.line2 = {"OutputVoltage": 0, "ExtPwr": 0, "InvPwr": 0, "ExtVoltage": 0}
+    self.dc = {"Voltage": 0, "Current": 0}
+    self.system = {"ExtFlags": 0, "Load": 0}
+    self._codec = FrameCodec({"line1": self.line1, "line2": self.line2, "battery": self.dc, "system": self.system})
+
+    self.inverter_on = True
+    self.grid_ok = True
+    self.hard_shutdown = False
+    self.fault = None
+    # from 0x351, until the first one arrives the SunnyIsland has no limits
+    self.chg_voltage = None
+    self.chg_current = 0.0
+    self.dischg_current = None
+    self.min_voltage = None
+
+    self.start_time = None
+    self.events = []
+    self.sent = {}
+    self.tx_errors = 0
+    self.sync_behind = 0
+    self.received = dict((can_id, 0) for can_id in BMS_IDS + [SMA_CMD_ID])
+    self.gaps = dict((can_id, LatencyHistogram("0x{0:03X}".format(can_id), base=0.01)) for can_id in BMS_IDS)
+    self.late = dict((can_id, 0) for can_id in BMS_IDS)
+    self._last_rx = {}
+    self._last_chg_time = None
+    self._schedule = []
+    self._sync_counter = 0
+
+  def log(self, now, text):
+    self.events.append((round(now - self.start_time, 3), text))
+    sys.stderr.write("{0:10.3f} {1}\n".format(now - self.start_time, text))
+
+  # -- model ------------------------------------------------------------------
+
+  def _update_model(self, now, dt):
+    while (self.grid_schedule and self.grid_schedule[0][0] <= now - self.start_time):
+      grid_ok = self.grid_schedule.pop(0)[1]
+      if (grid_ok != self.grid_ok):
+        self.grid_ok = grid_ok
+        self.log(now, "grid {0}".format("restored" if grid_ok else "lost"))
+
+    battery = self.battery
+    running = self.inverter_on and not self.hard_shutdown
+    relay = running and self.grid_ok
+    load = self.load_w if running else 0.0
+
+    if (relay):
+      # grid carries the load and charges at the requested current, the
+      # charger goes constant voltage at the 0x351 limit
+      current = min(self.chg_current, self.charger_max_a)
+      if (self.chg_voltage is not None):
+        current = min(current, battery.cv_current(self.chg_voltage))
+    elif (running):
+      current = -load / max(battery.voltage(), 1.0)
+    else:
+      current = 0.0
+    battery.step(current, dt)
+
+    voltage = battery.voltage()
+    if (running and not relay and self.min_voltage is not None and voltage < self.min_voltage):
+      self.inverter_on = False
+      self.fault = "battery voltage {0:.1f}V below 0x351 minimum {1:.1f}V".format(voltage, self.min_voltage)
+      self.log(now, "inverters fault off: " + self.fault)
+
+    # the master reports line 1, the first slave line 2 (split phase)
+    nlines = 2 if self.units > 1 else 1
+    charge_w = current * voltage if relay else 0.0
+    for i, line in enumerate((self.line1, self.line2)):
+      share = 1.0 / nlines if i < nlines else 0.0
+      line["OutputVoltage"] = 120.0 if running and share else 0.0
+      line["ExtVoltage"] = 120.0 if self.grid_ok and share else 0.0
+      line["ExtPwr"] = (load + charge_w) * share if relay else 0.0
+      line["InvPwr"] = load * share - line["ExtPwr"]
+    self.line1["OutputFreq"] = 60.0 if running else 0.0
+    self.line1["ExtFreq"] = 60.0 if self.grid_ok else 0.0
+    self.dc["Voltage"] = voltage
+    self.dc["Current"] = -current # SMA reports current into the battery as negative
+    self.system["Load"] = load
+    self.system["ExtFlags"] = (128 if relay else 0) | (64 if self.grid_ok else 0)
+
+  # -- BMS side ----------------------------------------------------------------
+
+  def handle(self, msg, now):
+    can_id = msg.arbitration_id
+    if (can_id not in self.received):
+      return
+    self.received[can_id] += 1
+    if (self.hard_shutdown):
+      return
+
+    if (can_id in self.gaps):
+      last = self._last_rx.get(can_id)
+      if (last is not None):
+        gap = now - last
+        self.gaps[can_id].record(gap)
+        if (gap > self.gap_warn_s):
+          self.late[can_id] += 1
+          self.log(now, "keep-alive gap 0x{0:03X}: {1:.3f}s".format(can_id, gap))
+      self._last_rx[can_id] = now
+
+    if (can_id == CAN_tx_msg["BatChg"] and len(msg.data) >= _BAT_CHG.size):
+      chg_v, chg_a, dischg_a, min_v = _BAT_CHG.unpack_from(bytes(msg.data))
+      if (chg_a / 10.0 != self.chg_current):
+        self.log(now, "charge current request {0:.1f}A".format(chg_a / 10.0))
+      self.chg_voltage, self.chg_current = chg_v / 10.0, chg_a / 10.0
+      self.dischg_current, self.min_voltage = dischg_a / 10.0, min_v / 10.0
+      self._last_chg_time = now
+    elif (can_id == SMA_CMD_ID and len(msg.data) > 0):
+      if (msg.data[0] & 0b10 and self.inverter_on):
+        self.inverter_on = False
+        self.log(now, "inverters off (SMA_OFF_MSG)")
+      elif (msg.data[0] & 0b01 and not self.inverter_on):
+        self.inverter_on = True
+        self.fault = None
+        self.log(now, "inverters on (SMA_ON_MSG)")
+
+  def _check_bms_timeout(self, now):
+    since = self._last_chg_time if self._last_chg_time is not None else self.start_time
+    if (not self.hard_shutdown and now - since > self.bms_timeout_s):
+      self.hard_shutdown = True
+      self.inverter_on = False
+      self.log(now, "no 0x351 for {0:.0f}s: BMS timeout, hard shutdown".format(now - since))
+
+  # -- transmit ----------------------------------------------------------------
+
+  def _send(self, can_id, data):
+    try:
+      self.bus.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=False))
+      self.sent[can_id] = self.sent.get(can_id, 0) + 1
+    except can.CanError:
+      # vcan/virtual queue full at high load factors
+      self.tx_errors += 1
+
+  def _push(self, due, kind, arg):
+    heapq.heappush(self._schedule, (due, kind, arg))
+
+  def offered_load(self):
+    """Bus load the schedule asks for, fraction of 500 kbit/s"""
+    fps = len(SUNNY_REMOTE_FRAMES) / self.period_s
+    if (self.sync_period is not None):
+      fps += self.units / self.sync_period
+    return fps * FRAME_BITS / 500000.0
+
+  def run(self, duration=None):
+    """Runs until duration (seconds) or hard shutdown / interrupt"""
+    self.start_time = now = timer()
+    self._update_model(now, 0.0)
+    self._push(now, "model", 0.1)
+    # SunnyRemote frames spread across the period
+    for i, can_id in enumerate(sorted(SUNNY_REMOTE_FRAMES)):
+      self._push(now + i * self.period_s / len(SUNNY_REMOTE_FRAMES), "remote", can_id)
+    if (self.sync_period is not None):
+      for unit in range(self.units):
+        self._push(now + unit * self.sync_period / self.units, "sync", SYNC_BASE_ID + unit)
+    self.log(now, "cluster of {0} running, offered bus load {1:.1f}% of 500 kbit/s".format(self.units, \
+      self.offered_load() * 100))
+
+    try:
+      while (duration is None or timer() - self.start_time < duration):
+        now = timer()
+        while (self._schedule and self._schedule[0][0] <= now):
+          due, kind, arg = heapq.heappop(self._schedule)
+          if (kind == "model"):
+            self._update_model(now, arg)
+            self._check_bms_timeout(now)
+            self._push(due + arg, kind, arg)
+          elif (self.hard_shutdown):
+            continue # a dead cluster sends nothing
+          elif (kind == "remote"):
+            self._send(arg, self._codec.encode(arg))
+            self._push(due + self.period_s, kind, arg)
+          else:
+            self._sync_counter = (self._sync_counter + 1) & 0xFFFFFFFF
+            self._send(arg, bytearray(struct.pack("<II", self._sync_counter, 0)))
+            if (now - due > 1.0):
+              # can't keep up with the rate, drop the backlog instead of bursting
+              self.sync_behind += 1
+              due = now
+            self._push(due + self.sync_period, kind, arg)
+
+        timeout = max(self._schedule[0][0] - timer(), 0.0) if self._schedule else 0.1
+        msg = self.bus.recv(timeout)
+        while (msg is not None):
+          self.handle(msg, timer())
+          msg = self.bus.recv(0)
+    except KeyboardInterrupt:
+      pass
+    return self.report(timer())
+
+  def report(self, now):
+    gaps = {}
+    for can_id in BMS_IDS:
+      histogram = self.gaps[can_id]
+      last = self._last_rx.get(can_id)
+      gaps["0x{0:03X}".format(can_id)] = {"received": self.received[can_id], \
+        "mean_s": round(histogram.mean(), 3), "p99_s": round(histogram.percentile(0.99), 3), \
+        "max_s": round(histogram.max, 3), "over_warn": self.late[can_id], \
+        "silent_s": round(now - last, 3) if last is not None else None}
+    return {"runtime_s": round(now - self.start_time, 3), "units": self.units, \
+      "offered_load_pct": round(self.offered_load() * 100, 1), "hard_shutdown": self.hard_shutdown, \
+      "inverter_on": self.inverter_on, "fault": self.fault, "soc": round(self.battery.soc, 2), \
+      "bms_limits": {"chg_voltage": self.chg_voltage, "chg_current": self.chg_current, \
+        "dischg_current": self.dischg_current, "min_voltage": self.min_voltage}, \
+      "sent": dict(("0x{0:03X}".format(k), v) for k, v in sorted(self.sent.items())), "tx_errors": self.tx_errors, \
+      "sync_behind": self.sync_behind, "commands": self.received[SMA_CMD_ID], "keepalive": gaps, "events": self.events}
+
+def parse_schedule(text):
+  """"60:off,120:on" -> [(60.0, False), (120.0, True)]"""
+  schedule = []
+  for item in (text or "").split(","):
+    if (item):
+      at, sep, state = item.partition(":")
+      schedule.append((float(at), state.strip().lower() in ("on", "ok", "1")))
+  return schedule
+
+def _terminate(signum, frame):
+  # stop like CTRL+C, the report still gets written
+  raise KeyboardInterrupt()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Simulates a SunnyIsland cluster on a CAN bus.')
+  parser.add_argument('-i', '--interface', default='socketcan', help='python-can interface (socketcan, virtual)')
+  parser.add_argument('-c', '--channel', default='vcan0')
+  parser.add_argument('--slaves', type=int, default=1, choices=(0, 1, 2))
+  parser.add_argument('--period', type=float, default=0.2, help='seconds between SunnyRemote frames (per id)')
+  parser.add_argument('--sync-rate', type=float, default=20.0, help='sync frames per second and unit')
+  parser.add_argument('--load-factor', type=float, default=1.0, help='multiplies the sync traffic')
+  parser.add_argument('--load', type=float, default=1500.0, help='AC load (W)')
+  parser.add_argument('--soc', type=float, default=50.0, help='initial battery SoC (%%)')
+  parser.add_argument('--capacity', type=float, default=200.0, help='battery capacity (Ah)')
+  parser.add_argument('--grid', default='', help='grid schedule, seconds:on|off, e.g. 60:off,300:on')
+  parser.add_argument('--bms-timeout', type=float, default=300.0, help='seconds without 0x351 to hard shutdown')
+  parser.add_argument('--gap-warn', type=float, default=3.0, help='log BMS keep-alive gaps above this (s)')
+  parser.add_argument('--duration', type=float, help='stop after this many seconds')
+  parser.add_argument('--json', help='write the report as json to this file')
+  args = parser.parse_args()
+
+  signal.signal(signal.SIGTERM, _terminate)
+
+  bus = can.interface.Bus(bustype=args.interface, channel=args.channel, \
+    can_filters=[{"can_id": can_id, "can_mask": 0x7FF, "extended": False} for can_id in BMS_IDS + [SMA_CMD_ID]])
+  cluster = SunnyIslandCluster(bus, slaves=args.slaves, period_s=args.period, sync_rate=args.sync_rate, \
+    load_factor=args.load_factor, load_w=args.load, bms_timeout_s=args.bms_timeout, gap_warn_s=args.gap_warn, \
+    battery=SimBattery(capacity_ah=args.capacity, soc=args.soc), grid_schedule=parse_schedule(args.grid))
+  try:
+    report = cluster.run(args.duration)
+  finally:
+    bus.shutdown()
+
+  if (args.json):
+    with open(args.json, "w") as out:
+      json.dump(report, out, indent=2, sort_keys=True)
+  print("runtime {runtime_s}s, {units} units, offered load {offered_load_pct}%, hard shutdown: {hard_shutdown}, " \
+    "inverters on: {inverter_on}, SoC {soc}%, tx errors {tx_errors}".format(**report))
+  for can_id, gap in sorted(report["keepalive"].items()):
+    print("  {0}: {received} received, gap mean {mean_s}s p99 {p99_s}s max {max_s}s, {over_warn} over warn" \
+      .format(can_id, **gap))
+  sys.exit(2 if report["hard_shutdown"] else 0)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""sma_fakes.py: Stand-ins for gobject, dbus, velib and the CAN bus, so the
+                driver can run off-target on a virtual clock. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+import heapq
+import os
+import sys
+import time
+import timeit
+import types
+
+import can
+import yaml
+
+DRIVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dbus-sma")
+
+# Virtual time. install() points time.time and timeit.default_timer at it
+# before the driver modules are imported, so frame timestamps, timers, the
+# publisher latency and the safety reaction all run on capture time.
+class VirtualClock(object):
+  def __init__(self, start=0.0):
+    self._now = start
+
+  def now(self):
+    return self._now
+
+  def set(self, now):
+    if (now > self._now):
+      self._now = now
+
+# gobject replacement: timers on the virtual clock, fd watches are fired by
+# whoever feeds the bus (see FakeBus.inject)
+class FakeGobject(object):
+  IO_IN = 1
+  IO_OUT = 4
+  IO_PRI = 2
+  IO_ERR = 8
+  IO_HUP = 16
+
+  def __init__(self, clock):
+    self._clock = clock
+    self._timers = []
+    self._removed = set()
+    self._next_id = 1
+    self.watches = {}
+
+  def _add(self, delay_s, interval_s, callback, args):
+    source_id = self._next_id
+    self._next_id += 1
+    heapq.heappush(self._timers, (self._clock.now() + delay_s, source_id, interval_s, callback, args))
+    return source_id
+
+  def timeout_add(self, interval_ms, callback, *args):
+    return self._add(interval_ms / 1000.0, interval_ms / 1000.0, callback, args)
+
+  def timeout_add_seconds(self, interval, callback, *args):
+    return self._add(interval, interval, callback, args)
+
+  def idle_add(self, callback, *args):
+    # idle callbacks that keep returning True are re-run every msec of virtual time
+    return self._add(0.0, 0.001, callback, args)
+
+  def io_add_watch(self, fd, condition, callback, *args):
+    source_id = self._next_id
+    self._next_id += 1
+    self.watches[source_id] = (fd, condition, callback, args)
+    return source_id
+
+  def source_remove(self, source_id):
+    if (self.watches.pop(source_id, None) is None):
+      self._removed.add(source_id)
+    return True
+
+  def fire_watches(self, fd, condition=IO_IN):
+    for source_id, (watch_fd, watch_cond, callback, args) in list(self.watches.items()):
+      if (watch_fd == fd and watch_cond & condition):
+        if (not callback(fd, condition, *args)):
+          self.watches.pop(source_id, None)
+
+  def next_due(self):
+    return self._timers[0][0] if self._timers else None
+
+  def run_until(self, until):
+    """Runs every timer due up to (and including) until, in order, with the
+       clock set to each due time, then leaves the clock at until"""
+    while (self._timers and self._timers[0][0] <= until):
+      due, source_id, interval, callback, args = heapq.heappop(self._timers)
+      if (source_id in self._removed):
+        self._removed.discard(source_id)
+        continue
+      self._clock.set(due)
+      if (callback(*args)):
+        heapq.heappush(self._timers, (due + interval, source_id, interval, callback, args))
+    self._clock.set(until)
+
+  def MainLoop(self):
+    return FakeMainLoop()
+
+class FakeMainLoop(object):
+  def run(self):
+    raise RuntimeError("no mainloop off-target, drive the fake gobject timers instead")
+
+  def quit(self):
+    pass
+
+# Every value written to a fake dbus service (that changed what a client
+# would see) and every frame put on the fake bus ends up here
+class Recorder(object):
+  def __init__(self, clock, dbus_sink=None, tx_sink=None):
+    """dbus_sink(t, path, value), tx_sink(t, msg): optional callbacks"""
+    self._clock = clock
+    self._dbus_sink = dbus_sink
+    self._tx_sink = tx_sink
+    self.dbus_count = 0
+    self.tx_count = 0
+
+  def dbus(self, path, value):
+    self.dbus_count += 1
+    if (self._dbus_sink is not None):
+      self._dbus_sink(self._clock.now(), path, value)
+
+  def tx(self, msg):
+    self.tx_count += 1
+    if (self._tx_sink is not None):
+      self._tx_sink(self._clock.now(), msg)
+
+class FakeDbusService(object):
+  def __init__(self, servicename, recorder=None):
+    self.servicename = servicename
+    self.recorder = recorder
+    self._values = {}
+    self._callbacks = {}
+
+  def add_mandatory_paths(self, processname, processversion, connection, deviceinstance, productid, \
+      productname, firmwareversion, hardwareversion, connected):
+    self.add_path('/Mgmt/ProcessName', processname)
+    self.add_path('/Mgmt/ProcessVersion', processversion)
+    self.add_path('/Mgmt/Connection', connection)
+    self.add_path('/DeviceInstance', deviceinstance)
+    self.add_path('/ProductId', productid)
+    self.add_path('/ProductName', productname)
+    self.add_path('/FirmwareVersion', firmwareversion)
+    self.add_path('/HardwareVersion', hardwareversion)
+    self.add_path('/Connected', connected)
+
+  def add_path(self, path, value, description="", writeable=False, onchangecallback=None, \
+      gettextcallback=None, valuetype=None):
+    if (path in self._values):
+      raise Exception("adding a path that already exists: {0}".format(path))
+    self._values[path] = value
+    if (onchangecallback is not None):
+      self._callbacks[path] = onchangecallback
+    if (self.recorder is not None):
+      self.recorder.dbus(path, value)
+
+  def __contains__(self, path):
+    return path in self._values
+
+  def __getitem__(self, path):
+    return self._values[path]
+
+  def __setitem__(self, path, value):
+    # VeDbusService only signals PropertiesChanged when the value differs
+    if (self._values[path] == value):
+      return
+    self._values[path] = value
+    if (self.recorder is not None):
+      self.recorder.dbus(path, value)
+
+  def set_from_client(self, path, value):
+    """A write from another dbus client, runs the onchangecallback"""
+    callback = self._callbacks.get(path)
+    if (callback is not None and not callback(path, value)):
+      return False
+    self[path] = value
+    return True
+
+  def __delitem__(self, path):
+    del self._values[path]
+
+class FakeDbusMonitor(object):
+  def __init__(self, dbusTree, valueChangedCallback=None, deviceAddedCallback=None, \
+      deviceRemovedCallback=None, values=None, gobject=None, **kwargs):
+    """values: {(service, path): value or callable}, callables are read on
+       every get_value and, given a gobject, once a second to call back on
+       changes like systemcalc publishes them"""
+    self.dbusTree = dbusTree
+    self.valueChangedCallback = valueChangedCallback
+    self.values = dict(values or {})
+    self._polled = {}
+    if (gobject is not None and any(callable(value) for value in self.values.values())):
+      gobject.timeout_add(1000, self._poll)
+
+  def get_value(self, serviceName, objectPath, default_value=None):
+    value = self.values.get((serviceName, objectPath), default_value)
+    return value() if callable(value) else value
+
+  def set_value(self, serviceName, objectPath, value):
+    """Changes a monitored value and calls back like the real monitor"""
+    self.values[(serviceName, objectPath)] = value
+    if (self.valueChangedCallback is not None):
+      self.valueChangedCallback(serviceName, objectPath, {}, {'Value': value, 'Text': str(value)}, 0)
+
+  def _poll(self):
+    for (serviceName, objectPath), value in self.values.items():
+      if (callable(value)):
+        value = value()
+        if (value != self._polled.get((serviceName, objectPath)) and self.valueChangedCallback is not None):
+          self._polled[(serviceName, objectPath)] = value
+          self.valueChangedCallback(serviceName, objectPath, {}, {'Value': value, 'Text': str(value)}, 0)
+    return True
+
+class FakeSettingsDevice(object):
+  def __init__(self, bus, supportedSettings, eventCallback, name='com.victronenergy.settings', timeout=0):
+    self._values = dict((key, setting[1]) for key, setting in supportedSettings.items())
+
+  def __getitem__(self, key):
+    return self._values[key]
+
+  def __setitem__(self, key, value):
+    self._values[key] = value
+
+# BCM cyclic task, repeats on the fake gobject timers
+class FakeCyclicTask(object):
+  def __init__(self, bus, msg, period, duration):
+    self._bus = bus
+    self.msg = msg
+    self.period = period
+    self.duration = duration
+    self._running = False
+    self._exists = False
+    self._started = 0.0
+    self._generation = 0
+    self.start()
+
+  def _tick(self, generation):
+    if (not self._running or generation != self._generation):
+      return False
+    if (self.duration is not None and self._bus.clock.now() - self._started >= self.duration):
+      self._running = False
+      return False
+    self._bus.record(self.msg)
+    return True
+
+  def start(self):
+    # like the kernel: first frame now, then every period. The BCM keeps a task
+    # until TX_DELETE, also once its count ran out, and refuses to set it up again
+    if (self._exists):
+      raise can.CanOperationError("A periodic task for task ID {0} is already in progress " \
+        "by the SocketCAN Linux layer".format(self.msg.arbitration_id))
+    self._exists = True
+    self._running = True
+    self._started = self._bus.clock.now()
+    self._generation += 1
+    self._bus.record(self.msg)
+    self._bus.gobject.timeout_add(int(self.period * 1000), self._tick, self._generation)
+
+  def modify_data(self, msg):
+    self.msg = msg
+
+  def stop(self):
+    self._running = False
+    self._exists = False
+
+# Takes frames from inject(), records every send. Acceptance filters are
+# applied in software like the kernel would.
+class FakeBus(object):
+  FILENO = 1000
+
+  def __init__(self, clock, gobject, recorder, filters=None):
+    self.clock = clock
+    self.gobject = gobject
+    self._recorder = recorder
+    self._rx = []
+    self._rx_pos = 0
+    self.set_filters(filters)
+
+  def set_filters(self, filters):
+    self._filters = [(f["can_id"], f["can_mask"]) for f in filters] if filters else None
+
+  def _accepts(self, msg):
+    if (self._filters is None):
+      return True
+    for can_id, mask in self._filters:
+      if (msg.arbitration_id & mask == can_id & mask):
+        return True
+    return False
+
+  def inject(self, msg):
+    """Queues a received frame and wakes the fd watch, if it passes the filters"""
+    if (not self._accepts(msg)):
+      return False
+    self._rx.append(msg)
+    self.gobject.fire_watches(self.FILENO)
+    return True
+
+  def recv(self, timeout=None):
+    if (self._rx_pos >= len(self._rx)):
+      if (self._rx):
+        del self._rx[:]
+        self._rx_pos = 0
+      return None
+    msg = self._rx[self._rx_pos]
+    self._rx_pos += 1
+    return msg
+
+  def record(self, msg):
+    # the driver re-packs its frames in place, keep what went on the wire
+    self._recorder.tx(can.Message(timestamp=self.clock.now(), arbitration_id=msg.arbitration_id, \
+      data=bytearray(msg.data), is_extended_id=msg.is_extended_id))
+
+  def send(self, msg, timeout=None):
+    self.record(msg)
+
+  def send_periodic(self, msg, period, duration=None):
+    return FakeCyclicTask(self, msg, period, duration)
+
+  def fileno(self):
+    return self.FILENO
+
+  def shutdown(self):
+    pass
+
+def _exit_on_error(func, *args, **kwargs):
+  # the real one kills the process, off-target the traceback is more useful
+  return func(*args, **kwargs)
+
+def install(clock, patch_time=True):
+  """Registers the fake gobject/dbus/velib modules and, with patch_time,
+     puts time on the virtual clock. Call before load_driver(). Returns the
+     fake gobject."""
+  if (patch_time):
+    time.time = clock.now
+    timeit.default_timer = clock.now
+
+  fake_gobject = FakeGobject(clock)
+  gobject_module = types.ModuleType("gobject")
+  for name in ("IO_IN", "IO_OUT", "IO_PRI", "IO_ERR", "IO_HUP"):
+    setattr(gobject_module, name, getattr(FakeGobject, name))
+  for name in ("timeout_add", "timeout_add_seconds", "idle_add", "io_add_watch", "source_remove", "MainLoop"):
+    setattr(gobject_module, name, getattr(fake_gobject, name))
+
+  dbus_module = types.ModuleType("dbus")
+  dbus_module.SystemBus = lambda *args, **kwargs: object()
+  dbus_module.SessionBus = lambda *args, **kwargs: object()
+  mainloop_module = types.ModuleType("dbus.mainloop")
+  glib_module = types.ModuleType("dbus.mainloop.glib")
+  glib_module.DBusGMainLoop = lambda *args, **kwargs: None
+  dbus_module.mainloop = mainloop_module
+  mainloop_module.glib = glib_module
+
+  vedbus_module = types.ModuleType("vedbus")
+  vedbus_module.VeDbusService = FakeDbusService
+  vedbus_module.unwrap_dbus_value = lambda value: value
+  ve_utils_module = types.ModuleType("ve_utils")
+  ve_utils_module.exit_on_error = _exit_on_error
+  ve_utils_module.get_vrm_portal_id = lambda: "000000000000"
+  dbusmonitor_module = types.ModuleType("dbusmonitor")
+  dbusmonitor_module.DbusMonitor = FakeDbusMonitor
+  settingsdevice_module = types.ModuleType("settingsdevice")
+  settingsdevice_module.SettingsDevice = FakeSettingsDevice
+
+  sys.modules.update({"gobject": gobject_module, "dbus": dbus_module, "dbus.mainloop": mainloop_module, \
+    "dbus.mainloop.glib": glib_module, "vedbus": vedbus_module, "ve_utils": ve_utils_module, \
+    "dbusmonitor": dbusmonitor_module, "settingsdevice": settingsdevice_module})
+  return fake_gobject
+
+def load_driver():
+  """Imports dbus-sma.py (not a valid module name) as module dbus_sma"""
+  path = os.path.join(DRIVER_DIR, "dbus-sma.py")
+  if (DRIVER_DIR not in sys.path):
+    sys.path.insert(0, DRIVER_DIR)
+  if (sys.version_info[0] < 3):
+    import imp
+    return imp.load_source("dbus_sma", path)
+
+  import importlib.util
+  spec = importlib.util.spec_from_file_location("dbus_sma", path)
+  module = importlib.util.module_from_spec(spec)
+  sys.modules["dbus_sma"] = module
+  spec.loader.exec_module(module)
+  return module
+
+def load_config(overrides, journal_path=None):
+  """dbus-sma.yaml with "Section.key=value" overrides, the journal is off
+     unless a path is given so a run never touches /data"""
+  with open(os.path.join(DRIVER_DIR, "dbus-sma.yaml"), "r") as yamlfile:
+    config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+  config.setdefault("Journal", {})["enabled"] = journal_path is not None
+  if (journal_path is not None):
+    config["Journal"]["path"] = journal_path
+  config.setdefault("CanBus", {})["rx_mode"] = "watch"
+  for override in overrides:
+    key, sep, value = override.partition("=")
+    section, sep2, name = key.partition(".")
+    if (not sep or not sep2):
+      raise ValueError("override must look like Section.key=value: {0}".format(override))
+    config.setdefault(section, {})[name] = yaml.safe_load(value)
+  return config
+
+def create_driver(driver_module, clock, fake_gobject, recorder, config, monitor_values):
+  """SmaDriver with the bus, dbus service and monitor swapped for fakes"""
+  class FakeDriver(driver_module.SmaDriver):
+    def get_config_data(self, config_file=None):
+      return config
+
+    def _create_can_bus(self, cfg_can, filters):
+      return FakeBus(clock, fake_gobject, recorder, filters)
+
+    def _create_dbus_monitor(self, *args, **kwargs):
+      return FakeDbusMonitor(*args, values=monitor_values, gobject=fake_gobject, **kwargs)
+
+    def _create_dbus_service(self):
+      dbusservice = driver_module.SmaDriver._create_dbus_service(self)
+      dbusservice.recorder = recorder
+      return dbusservice
+
+  driver = FakeDriver()
+  # fast_start leaves the dbus setup to the mainloop, finish it
+  while (not hasattr(driver, "_dbusservice")):
+    fake_gobject.run_until(fake_gobject.next_due())
+  return driver
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""startup_check.py: Fails when the driver's import or startup time goes past
+                the budget in startup_budget.yaml. """
+
+__copyright__   = "Copyright 2020"
+__license__     = "MIT"
+__version__     = "0.1"
+
+# python startup_check.py                 (desktop, budget as is)
+# python startup_check.py --scale 10      (Pi 3)
+#
+# Each run is a fresh interpreter, so every import is really loaded. The bus,
+# dbus and velib are faked (sma_fakes), python-can, yaml and the driver's own
+# modules are real. Measured, best of --runs:
+#   import_ms:   loading dbus-sma.py
+#   first_tx_ms: SmaDriver() (config parse included) to the first BMS frame,
+#                restored from a journal
+#   init_ms:     SmaDriver() to the deferred dbus setup being done
+# On the target, dbus-sma.py --profile-startup gives the same breakdown
+# with the real dbus and velib.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+METRICS = ("import_ms", "first_tx_ms", "init_ms")
+
+def measure():
+  """One run in this interpreter, returns the metrics and the slowest imports"""
+  sys.path.insert(0, os.path.join(os.path.dirname(HERE), "dbus-sma"))
+  from startup_profile import ImportTimer
+
+  # python-can and yaml are the driver's heaviest imports and the fakes need
+  # them too, they are timed as driver imports before the fakes load them
+  import_timer = ImportTimer()
+  import_timer.install()
+  import can
+  import yaml
+  import sma_fakes
+  clock = sma_fakes.VirtualClock(time.time())
+  fake_gobject = sma_fakes.install(clock, patch_time=False)
+  driver_module = sma_fakes.load_driver()
+  import_timer.uninstall()
+  from state_journal import StateJournal
+
+  work_dir = tempfile.mkdtemp(prefix="sma-startup-")
+  try:
+    journal_path = os.path.join(work_dir, "state.journal")
+    StateJournal(journal_path).append({"time": time.time(), "bms": {"state": "bulk_chg", "charge_current": 100.0}, \
+      "system": {"soc": 60.0, "voltage": 53.0, "current": 0.0, "pv_current": 0.0}})
+
+    first_tx = []
+    recorder = sma_fakes.Recorder(clock, tx_sink=lambda t, msg: first_tx.append(timer()) if not first_tx else None)
+    start = timer()
+    driver = sma_fakes.create_driver(driver_module, clock, fake_gobject, recorder, \
+      sma_fakes.load_config([], journal_path), {})
+    init = timer() - start
+    driver.__del__()
+  finally:
+    shutil.rmtree(work_dir)
+
+  return {"import_ms": import_timer.total * 1000, "first_tx_ms": (first_tx[0] - start) * 1000 if first_tx else None, \
+    "init_ms": init * 1000, "imports": [(name, round(seconds * 1000, 2)) for name, seconds in import_timer.top_level()[:10]]}
+
+def run_child():
+  proc = subprocess.Popen([sys.executable, os.path.realpath(__file__), "--child"], stdout=subprocess.PIPE, cwd=HERE)
+  out = proc.communicate()[0]
+  if (proc.returncode != 0):
+    raise RuntimeError("startup measurement failed (exit {0})".format(proc.returncode))
+  return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Checks the SMA driver startup time against a budget.')
+  parser.add_argument('-b', '--budget', default=os.path.join(HERE, "startup_budget.yaml"), help='budget yaml')
+  parser.add_argument('-n', '--runs', type=int, default=3, help='fresh interpreter runs, the best counts')
+  parser.add_argument('--scale', type=float, default=1.0, help='multiply the budget (slower machine)')
+  parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if (args.child):
+    import logging
+    logging.disable(logging.CRITICAL) # the driver logs at INFO, keep stdout for the result
+    print(json.dumps(measure()))
+    sys.exit(0)
+
+  import yaml # not before the child's measurement
+  with open(args.budget, "r") as budget_file:
+    budget = yaml.safe_load(budget_file)
+
+  runs = [run_child() for i in range(args.runs)]
+  best = dict((metric, min(run[metric] for run in runs if run[metric] is not None)) for metric in METRICS \
+    if any(run[metric] is not None for run in runs))
+
+  failed = False
+  print("{0:<12} {1:>10} {2:>10}".format("", "best ms", "budget ms"))
+  for metric in METRICS:
+    limit = budget.get(metric)
+    limit = limit * args.scale if limit is not None else None
+    value = best.get(metric)
+    over = value is None or (limit is not None and value > limit)
+    failed = failed or over
+    print("{0:<12} {1:>10} {2:>10} {3}".format(metric, "-" if value is None else "{0:.1f}".format(value), \
+      "-" if limit is None else "{0:.0f}".format(limit), "OVER" if over else "ok"))
+
+  print("slowest imports (last run):")
+  for name, ms in runs[-1]["imports"]:
+    print("  {0:<28} {1:8.1f}ms".format(name, ms))
+  sys.exit(1 if failed else 0)